@@ -129,19 +129,36 @@ async function sendImageToLocalServer(imageData, originalUrl, pageInfo) {
       pageInfo 
     });
     
-    const response = await fetch(`${serverUrl}/api/receive-image`, {
-      method: "POST",
-      headers: {
-        "Content-Type": "application/json",
-      },
-      body: JSON.stringify({
-        imageData: imageData,
-        originalUrl: originalUrl,
-        pageInfo: pageInfo,
-        timestamp: Date.now(),
-        source: "browser-extension"
-      })
-    });
+    let response;
+    if (typeof imageData === "string" && imageData.startsWith("data:image")) {
+      // 已取得图片内容时发送原始字节，元数据放在请求头中（URL编码以支持中文）
+      const imageBlob = await (await fetch(imageData)).blob();
+      response = await fetch(`${serverUrl}/api/receive-image/binary`, {
+        method: "POST",
+        headers: {
+          "Content-Type": imageBlob.type || "application/octet-stream",
+          "X-Image-Source": "browser-extension",
+          "X-Original-Url": encodeURIComponent(originalUrl || ""),
+          "X-Page-Info": encodeURIComponent(JSON.stringify(pageInfo || {}))
+        },
+        body: imageBlob
+      });
+    } else {
+      // 只有图片URL时由服务器下载
+      response = await fetch(`${serverUrl}/api/receive-image`, {
+        method: "POST",
+        headers: {
+          "Content-Type": "application/json",
+        },
+        body: JSON.stringify({
+          imageData: imageData,
+          originalUrl: originalUrl,
+          pageInfo: pageInfo,
+          timestamp: Date.now(),
+          source: "browser-extension"
+        })
+      });
+    }
 
     if (response.ok) {
       const result = await response.json();
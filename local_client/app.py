@@ -1,4 +1,5 @@
-from flask import Flask, request, jsonify, render_template, send_file, url_for, session
+from flask import Flask, Request, request, jsonify, render_template, send_file, url_for, session
+from flask.json.provider import DefaultJSONProvider
 import os
 import json
 import base64
@@ -7,14 +8,30 @@ import datetime
 from pathlib import Path
 import sqlite3
 from werkzeug.utils import secure_filename
+from werkzeug.http import is_resource_modified
+from werkzeug.serving import WSGIRequestHandler
+from werkzeug.exceptions import RequestEntityTooLarge
+import mimetypes
 import requests
-from urllib.parse import urlparse
+from urllib.parse import urlparse, unquote
 import threading
 import time
 import hashlib
+import shutil
+import tempfile
 import secrets
 import traceback
 from functools import wraps
+from contextlib import contextmanager
+import queue
+import atexit
+import heapq
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+
+from derivatives import build_derivatives, compute_dhash, render_thumbnails
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = secrets.token_hex(32)
@@ -27,19 +44,744 @@ ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
 CLOUD_SERVER_URL = "http://localhost:6006/api"  # 修改为本地测试服务器
 ENABLE_CLOUD_SYNC = True  # 启用云端同步进行测试
 
+# 按用户分库：开启后users表保留在DB_PATH中，每个用户的图片、收藏、任务和试穿历史
+# 保存在 saved_images/<user_id>/USER_DB_FILENAME 中。从单文件数据库切换前先运行 migrate_to_shards.py
+DB_SHARDED = False
+USER_DB_FILENAME = "user_data.db"
+# 只有注册和登录会创建用户库；没有数据库文件的用户读取这个只读的空库，查询结果为空
+EMPTY_SHARD_FILENAME = ".empty_user_data.db"
+# 同时打开的用户库连接池上限，超出时关闭最久未使用的
+MAX_OPEN_SHARDS = 64
+# 分库模式下保存在用户库中的表（按依赖顺序）
+USER_SHARD_TABLES = ('images', 'favorites', 'tasks', 'vton_history', 'blobs')
+
+# 缩略图：可选尺寸（最长边像素）、默认尺寸和格式，缓存在 saved_images/<user_id>/thumbnails/<category>/<size>/ 下
+THUMBNAIL_SIZES = (128, 256, 512)
+DEFAULT_THUMBNAIL_SIZE = 256
+THUMBNAIL_FORMAT = 'WEBP'
+THUMBNAIL_EXTENSION = '.webp'
+THUMBNAIL_QUALITY = 80
+# 新图片入库后在后台进程池中预生成缩略图，进程数上限
+DERIVATIVE_WORKERS = 2
+# 图片文件名包含时间戳和UUID，内容不会变化，浏览器可长期缓存（秒）
+IMAGE_CACHE_MAX_AGE = 365 * 24 * 3600
+# 无法零拷贝发送时，每次从图片文件读取的块大小
+FILE_BLOCK_SIZE = 1024 * 1024
+# 感知哈希（dHash）边长，哈希位数为其平方
+IMAGE_HASH_SIZE = 8
+# 相似图片接口默认的最大汉明距离
+SIMILAR_MAX_DISTANCE = 10
+# 入库时与已有图片的汉明距离不超过该值则标记为重复
+DUPLICATE_MAX_DISTANCE = 4
+# 内容寻址存储目录名（位于每个用户目录下），分类目录中的图片是指向其中文件的硬链接
+BLOB_DIR_NAME = 'blobs'
+# 文件名到分类目录的LRU缓存容量
+IMAGE_PATH_CACHE_SIZE = 4096
+# 图片文件所在的分类目录
+IMAGE_CATEGORY_DIRS = ('clothes', 'char', 'vton_results')
+# 单张上传图片的大小上限；整个请求体（含base64编码的JSON）的上限
+MAX_UPLOAD_SIZE = 10 * 1024 * 1024
+MAX_REQUEST_SIZE = 32 * 1024 * 1024
+# 上传文件在保存目录下的暂存目录，与blobs在同一文件系统上，保存时直接重命名
+UPLOAD_STAGING_DIR_NAME = '.uploads'
+
+app.config['MAX_CONTENT_LENGTH'] = MAX_REQUEST_SIZE
+
 # IDM-VTON API 配置
 VTON_API_BASE_URL = "http://localhost:7860"  # Gradio服务地址
 
 # 确保保存目录存在
 BASE_SAVE_DIR.mkdir(exist_ok=True)
 
+# 任务状态配置：内存中保留的时间、是否异步写回数据库、数据库中保留的天数、后台处理线程数
+TASK_TTL_SECONDS = 3600
+TASK_PERSIST = True
+TASK_FLUSH_INTERVAL = 5
+TASK_RETENTION_DAYS = 7
+TASK_MAX_WORKERS = 2
+
+# 登录时间先记录在内存中，每隔LOGIN_FLUSH_INTERVAL秒批量写入数据库
+LOGIN_FLUSH_INTERVAL = 30
+
+# IN (...) 批量查询每批的参数数量，低于SQLite的变量数上限
+SQLITE_IN_BATCH_SIZE = 500
+
+# 导出（云端同步）时每批读取的记录数
+EXPORT_BATCH_SIZE = 500
+
+def extract_page_domain(url):
+    """从页面URL中提取域名（小写，去掉www.前缀），无法解析时返回None"""
+    if not url:
+        return None
+    try:
+        hostname = urlparse(url).hostname
+    except ValueError:
+        return None
+    if not hostname:
+        return None
+    return hostname[4:] if hostname.startswith('www.') else hostname
+
+def backfill_page_domains(conn):
+    """为已有图片记录填充page_domain"""
+    rows = conn.execute('SELECT id, page_url FROM images WHERE page_url IS NOT NULL').fetchall()
+    conn.executemany(
+        'UPDATE images SET page_domain = ? WHERE id = ?',
+        [(extract_page_domain(page_url), image_id) for image_id, page_url in rows]
+    )
+
+# 全文索引中的context_info只取JSON中的文本值（替代文字、周边文字等），不索引键名
+FTS_CONTEXT_SQL = '''CASE WHEN json_valid({row}.context_info)
+    THEN (SELECT group_concat(value, ' ') FROM json_tree({row}.context_info) WHERE type = 'text')
+    ELSE {row}.context_info END'''
+
+# 全文检索按列加权：页面标题 > 周边文字 > 页面URL > 图片URL（第一列是不参与检索的图片ID）
+FTS_RANK_SQL = 'bm25(images_fts, 0.0, 10.0, 2.0, 1.0, 5.0)'
+
+# trigram分词至少需要3个字符；更短的关键词（衬衫、裙子等）在用户自己的图片范围内逐条匹配这些列
+FTS_MIN_TERM_LENGTH = 3
+FTS_TEXT_COLUMNS = ('page_title', 'page_url', 'original_url', 'context_info')
+
+# 数据库结构迁移（索引、计数表等），按版本号递增追加，已应用的版本记录在 PRAGMA user_version 中。
+# 基础表由 ImageDatabase.create_base_schema 创建，启动时版本已是最新则不执行任何DDL。
+# 迁移项为SQL语句，需要Python处理的数据迁移可以是接收连接的函数
+SCHEMA_MIGRATIONS = [
+    (1, [
+        # 图片列表：按用户和分类过滤，按保存时间倒序
+        'CREATE INDEX IF NOT EXISTS idx_images_user_category_saved ON images (user_id, category, saved_at DESC)',
+        'CREATE INDEX IF NOT EXISTS idx_images_user_saved ON images (user_id, saved_at DESC)',
+        'CREATE INDEX IF NOT EXISTS idx_images_user_filename ON images (user_id, filename)',
+        # 收藏列表以及删除图片时的级联清理
+        'CREATE INDEX IF NOT EXISTS idx_favorites_user_type_created ON favorites (user_id, favorite_type, created_at DESC)',
+        'CREATE INDEX IF NOT EXISTS idx_favorites_image ON favorites (image_id)',
+        # 试穿历史列表以及删除图片时的级联清理
+        'CREATE INDEX IF NOT EXISTS idx_vton_history_user_created ON vton_history (user_id, created_at DESC)',
+        'CREATE INDEX IF NOT EXISTS idx_vton_history_result_image ON vton_history (result_image_id)',
+    ]),
+    (2, [
+        # 游标分页按 (时间, id) 排序，索引需要包含id作为第二排序键
+        'DROP INDEX IF EXISTS idx_images_user_category_saved',
+        'DROP INDEX IF EXISTS idx_images_user_saved',
+        'DROP INDEX IF EXISTS idx_favorites_user_type_created',
+        'DROP INDEX IF EXISTS idx_vton_history_user_created',
+        'CREATE INDEX IF NOT EXISTS idx_images_user_category_saved_id ON images (user_id, category, saved_at DESC, id DESC)',
+        'CREATE INDEX IF NOT EXISTS idx_images_user_saved_id ON images (user_id, saved_at DESC, id DESC)',
+        'CREATE INDEX IF NOT EXISTS idx_images_saved_id ON images (saved_at DESC, id DESC)',
+        'CREATE INDEX IF NOT EXISTS idx_favorites_user_type_created_image ON favorites (user_id, favorite_type, created_at DESC, image_id DESC)',
+        'CREATE INDEX IF NOT EXISTS idx_vton_history_user_created_id ON vton_history (user_id, created_at DESC, id DESC)',
+    ]),
+    (3, [
+        # 按用户维护的图片分类计数和收藏计数，由触发器随 images/favorites 的增删自动更新
+        '''CREATE TABLE IF NOT EXISTS user_counters (
+            user_id TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            name TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, kind, name)
+        ) WITHOUT ROWID''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_images_count_insert AFTER INSERT ON images BEGIN
+            INSERT INTO user_counters (user_id, kind, name, count)
+            VALUES (NEW.user_id, 'images', COALESCE(NEW.category, 'clothes'), 1)
+            ON CONFLICT (user_id, kind, name) DO UPDATE SET count = count + 1;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_images_count_delete AFTER DELETE ON images BEGIN
+            UPDATE user_counters SET count = count - 1
+            WHERE user_id = OLD.user_id AND kind = 'images' AND name = COALESCE(OLD.category, 'clothes');
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_images_count_update AFTER UPDATE OF user_id, category ON images BEGIN
+            UPDATE user_counters SET count = count - 1
+            WHERE user_id = OLD.user_id AND kind = 'images' AND name = COALESCE(OLD.category, 'clothes');
+            INSERT INTO user_counters (user_id, kind, name, count)
+            VALUES (NEW.user_id, 'images', COALESCE(NEW.category, 'clothes'), 1)
+            ON CONFLICT (user_id, kind, name) DO UPDATE SET count = count + 1;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_favorites_count_insert AFTER INSERT ON favorites BEGIN
+            INSERT INTO user_counters (user_id, kind, name, count)
+            VALUES (NEW.user_id, 'favorites', NEW.favorite_type, 1)
+            ON CONFLICT (user_id, kind, name) DO UPDATE SET count = count + 1;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_favorites_count_delete AFTER DELETE ON favorites BEGIN
+            UPDATE user_counters SET count = count - 1
+            WHERE user_id = OLD.user_id AND kind = 'favorites' AND name = OLD.favorite_type;
+        END''',
+        # 根据现有数据初始化计数
+        'DELETE FROM user_counters',
+        '''INSERT INTO user_counters (user_id, kind, name, count)
+            SELECT user_id, 'images', COALESCE(category, 'clothes'), COUNT(*) FROM images
+            GROUP BY user_id, COALESCE(category, 'clothes')''',
+        '''INSERT INTO user_counters (user_id, kind, name, count)
+            SELECT user_id, 'favorites', favorite_type, COUNT(*) FROM favorites
+            GROUP BY user_id, favorite_type''',
+    ]),
+    (4, [
+        # 按更新时间清理过期任务
+        'CREATE INDEX IF NOT EXISTS idx_tasks_updated ON tasks (updated_at)',
+    ]),
+    (5, [
+        # 图片元数据全文索引，rowid与images表一致；trigram分词支持中文子串检索
+        '''CREATE VIRTUAL TABLE IF NOT EXISTS images_fts USING fts5(
+            page_title, page_url, original_url, context_info, tokenize = 'trigram'
+        )''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_images_fts_insert AFTER INSERT ON images BEGIN
+            INSERT INTO images_fts (rowid, page_title, page_url, original_url, context_info)
+            VALUES (NEW.rowid, NEW.page_title, NEW.page_url, NEW.original_url, {context});
+        END'''.format(context=FTS_CONTEXT_SQL.format(row='NEW')),
+        '''CREATE TRIGGER IF NOT EXISTS trg_images_fts_delete AFTER DELETE ON images BEGIN
+            DELETE FROM images_fts WHERE rowid = OLD.rowid;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_images_fts_update
+        AFTER UPDATE OF page_title, page_url, original_url, context_info ON images BEGIN
+            DELETE FROM images_fts WHERE rowid = OLD.rowid;
+            INSERT INTO images_fts (rowid, page_title, page_url, original_url, context_info)
+            VALUES (NEW.rowid, NEW.page_title, NEW.page_url, NEW.original_url, {context});
+        END'''.format(context=FTS_CONTEXT_SQL.format(row='NEW')),
+        # 为已有图片建立索引
+        'DELETE FROM images_fts',
+        '''INSERT INTO images_fts (rowid, page_title, page_url, original_url, context_info)
+            SELECT rowid, page_title, page_url, original_url, {context} FROM images'''.format(
+            context=FTS_CONTEXT_SQL.format(row='images')),
+    ]),
+    (6, [
+        # 来源网站域名，用于筛选和按域名统计
+        'ALTER TABLE images ADD COLUMN page_domain TEXT',
+        'CREATE INDEX IF NOT EXISTS idx_images_user_domain_saved_id ON images (user_id, page_domain, saved_at DESC, id DESC)',
+        backfill_page_domains,
+    ]),
+    (7, [
+        # 缩略图等衍生文件的生成时间，为空表示尚未生成
+        'ALTER TABLE images ADD COLUMN derivatives_at TIMESTAMP',
+    ]),
+    (8, [
+        # 图片内容的SHA-256，对应 saved_images/<user_id>/blobs/ 下的文件；为空表示尚未迁移到内容寻址存储
+        'ALTER TABLE images ADD COLUMN content_hash TEXT',
+        'CREATE INDEX IF NOT EXISTS idx_images_user_hash ON images (user_id, content_hash)',
+        # 每个blob被多少条图片记录引用，由触发器随 images 的增删改自动更新，降为0时删除blob文件
+        '''CREATE TABLE IF NOT EXISTS blobs (
+            user_id TEXT NOT NULL,
+            content_hash TEXT NOT NULL,
+            size INTEGER,
+            ref_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, content_hash)
+        ) WITHOUT ROWID''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_images_blob_insert AFTER INSERT ON images
+        WHEN NEW.content_hash IS NOT NULL BEGIN
+            INSERT INTO blobs (user_id, content_hash, size, ref_count)
+            VALUES (NEW.user_id, NEW.content_hash, NEW.file_size, 1)
+            ON CONFLICT (user_id, content_hash) DO UPDATE SET ref_count = ref_count + 1;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_images_blob_delete AFTER DELETE ON images
+        WHEN OLD.content_hash IS NOT NULL BEGIN
+            UPDATE blobs SET ref_count = ref_count - 1
+            WHERE user_id = OLD.user_id AND content_hash = OLD.content_hash;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_images_blob_update AFTER UPDATE OF user_id, content_hash ON images BEGIN
+            UPDATE blobs SET ref_count = ref_count - 1
+            WHERE user_id = OLD.user_id AND content_hash = OLD.content_hash;
+            INSERT INTO blobs (user_id, content_hash, size, ref_count)
+            SELECT NEW.user_id, NEW.content_hash, NEW.file_size, 1 WHERE NEW.content_hash IS NOT NULL
+            ON CONFLICT (user_id, content_hash) DO UPDATE SET ref_count = ref_count + 1;
+        END''',
+    ]),
+    (9, [
+        # 感知哈希（16位十六进制），在生成缩略图时计算，用于查找相似图片
+        'ALTER TABLE images ADD COLUMN dhash TEXT',
+        # 入库时发现的近似重复图片，指向先入库的那张
+        'ALTER TABLE images ADD COLUMN duplicate_of TEXT',
+    ]),
+    (10, [
+        # images的主键是TEXT，隐式rowid在VACUUM时可能被重新编号，全文索引不能再依赖它：
+        # 索引中保存图片ID用于关联，索引行的rowid记录在images.fts_rowid中用于更新和删除
+        'ALTER TABLE images ADD COLUMN fts_rowid INTEGER',
+        'DROP TRIGGER IF EXISTS trg_images_fts_insert',
+        'DROP TRIGGER IF EXISTS trg_images_fts_delete',
+        'DROP TRIGGER IF EXISTS trg_images_fts_update',
+        'DROP TABLE IF EXISTS images_fts',
+        '''CREATE VIRTUAL TABLE images_fts USING fts5(
+            id UNINDEXED, page_title, page_url, original_url, context_info, tokenize = 'trigram'
+        )''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_images_fts_insert AFTER INSERT ON images BEGIN
+            INSERT INTO images_fts (id, page_title, page_url, original_url, context_info)
+            VALUES (NEW.id, NEW.page_title, NEW.page_url, NEW.original_url, {context});
+            UPDATE images SET fts_rowid = last_insert_rowid() WHERE id = NEW.id;
+        END'''.format(context=FTS_CONTEXT_SQL.format(row='NEW')),
+        '''CREATE TRIGGER IF NOT EXISTS trg_images_fts_delete AFTER DELETE ON images BEGIN
+            DELETE FROM images_fts WHERE rowid = OLD.fts_rowid;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_images_fts_update
+        AFTER UPDATE OF page_title, page_url, original_url, context_info ON images BEGIN
+            UPDATE images_fts SET page_title = NEW.page_title, page_url = NEW.page_url,
+                original_url = NEW.original_url, context_info = {context}
+            WHERE rowid = NEW.fts_rowid;
+        END'''.format(context=FTS_CONTEXT_SQL.format(row='NEW')),
+        # 为已有图片重建索引，迁移过程中rowid不变，直接用作索引行的rowid
+        '''INSERT INTO images_fts (rowid, id, page_title, page_url, original_url, context_info)
+            SELECT rowid, id, page_title, page_url, original_url, {context} FROM images'''.format(
+            context=FTS_CONTEXT_SQL.format(row='images')),
+        'UPDATE images SET fts_rowid = rowid',
+    ]),
+]
+SCHEMA_VERSION = SCHEMA_MIGRATIONS[-1][0]
+
+def utc_timestamp():
+    """当前UTC时间，格式与SQLite的CURRENT_TIMESTAMP一致"""
+    return datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+def encode_cursor(*values):
+    """将排序键编码为不透明的分页游标"""
+    raw = json.dumps(values, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor, size=2):
+    """解析分页游标，格式无效时抛出ValueError"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    except Exception:
+        raise ValueError('无效的分页游标')
+    if not isinstance(values, list) or len(values) != size:
+        raise ValueError('无效的分页游标')
+    # 排序键只能是字符串或数字，最后一项是记录ID（TEXT主键）
+    if any(isinstance(value, bool) or not isinstance(value, (str, int, float)) for value in values) \
+            or not isinstance(values[-1], str):
+        raise ValueError('无效的分页游标')
+    return tuple(values)
+
+# /api/user/images 支持的筛选参数及其类型
+IMAGE_FILTER_PARAMS = {
+    'domain': str,
+    'saved_from': 'datetime',
+    'saved_to': 'datetime',
+    'min_size': int,
+    'max_size': int,
+    'min_width': int,
+    'max_width': int,
+    'min_height': int,
+    'max_height': int,
+    'favorited': bool,
+}
+
+def parse_image_filters(args):
+    """从请求参数中解析图片筛选条件，参数无效时抛出ValueError"""
+    filters = {}
+    for name, kind in IMAGE_FILTER_PARAMS.items():
+        value = args.get(name)
+        if value is None or value == '':
+            continue
+        if kind is int:
+            try:
+                filters[name] = int(value)
+            except ValueError:
+                raise ValueError(f'参数 {name} 必须是整数')
+        elif kind is bool:
+            if value.lower() not in ('true', 'false', '1', '0'):
+                raise ValueError(f'参数 {name} 必须是 true 或 false')
+            filters[name] = value.lower() in ('true', '1')
+        elif kind == 'datetime':
+            try:
+                parsed = datetime.datetime.fromisoformat(value)
+            except ValueError:
+                raise ValueError(f'参数 {name} 必须是日期，如 2025-06-13 或 2025-06-13 18:45:30')
+            # 只给日期时，结束日期包含当天
+            if name == 'saved_to' and len(value) == 10:
+                parsed += datetime.timedelta(days=1) - datetime.timedelta(seconds=1)
+            filters[name] = parsed.strftime('%Y-%m-%d %H:%M:%S')
+        else:
+            filters[name] = value.lower()
+    return filters
+
+def build_search_query(text):
+    """将用户输入转换为检索条件：按空白拆分，多个词同时命中
+
+    返回 (match, short_terms)：match为长度足够的词组成的FTS5查询（每个词作为短语匹配，
+    没有时为None），short_terms为少于FTS_MIN_TERM_LENGTH个字符、需要逐条匹配的词。
+    """
+    terms = text.split()
+    if not terms:
+        raise ValueError('搜索关键词不能为空')
+    long_terms = [term for term in terms if len(term) >= FTS_MIN_TERM_LENGTH]
+    short_terms = [term for term in terms if len(term) < FTS_MIN_TERM_LENGTH]
+    match = ' '.join('"{}"'.format(term.replace('"', '""')) for term in long_terms) or None
+    return match, short_terms
+
+def paginate_keyset(items, per_page, key):
+    """截取多查询的一条记录，据此判断是否还有下一页并生成next_cursor"""
+    has_more = len(items) > per_page
+    items = items[:per_page]
+    next_cursor = encode_cursor(*key(items[-1])) if has_more and items else None
+    return items, next_cursor
+
+# images表的列，读取时显式列出，避免依赖 SELECT * 的列顺序
+IMAGE_COLUMNS = (
+    'id', 'user_id', 'filename', 'original_url', 'page_url', 'page_title', 'saved_at',
+    'file_size', 'image_width', 'image_height', 'context_info', 'status', 'cloud_synced', 'category',
+    'page_domain', 'duplicate_of'
+)
+IMAGE_COLUMNS_SQL = ', '.join(f'i.{column}' for column in IMAGE_COLUMNS)
+
+class ImageRecord:
+    """images表的一行记录
+
+    使用__slots__保存列值，context_info在首次访问时才解析JSON。
+    支持 record['key'] / record.get('key') 的字典式访问，额外字段（如preview_url、
+    is_favorited）保存在extra中，序列化时通过to_dict()展开。
+    """
+    __slots__ = (
+        'id', 'user_id', 'filename', 'original_url', 'page_url', 'page_title', 'saved_at',
+        'file_size', 'image_width', 'image_height', 'status', 'cloud_synced', 'category',
+        'page_domain', 'duplicate_of', '_context_raw', '_context', 'extra'
+    )
+    
+    FIELDS = IMAGE_COLUMNS
+    
+    def __init__(self, row, **extra):
+        self.id = row['id']
+        self.user_id = row['user_id']
+        self.filename = row['filename']
+        self.original_url = row['original_url']
+        self.page_url = row['page_url']
+        self.page_title = row['page_title']
+        self.saved_at = row['saved_at']
+        self.file_size = row['file_size']
+        self.image_width = row['image_width']
+        self.image_height = row['image_height']
+        self.status = row['status']
+        self.cloud_synced = bool(row['cloud_synced'])
+        self.category = row['category'] or 'clothes'
+        self.page_domain = row['page_domain']
+        self.duplicate_of = row['duplicate_of']
+        self._context_raw = row['context_info']
+        self._context = None
+        self.extra = extra
+    
+    @property
+    def context_info(self):
+        if self._context is None:
+            try:
+                self._context = json.loads(self._context_raw) if self._context_raw else {}
+            except (TypeError, ValueError):
+                self._context = {}
+        return self._context
+    
+    @context_info.setter
+    def context_info(self, value):
+        self._context = value
+    
+    def __getitem__(self, key):
+        if key in self.FIELDS:
+            return getattr(self, key)
+        return self.extra[key]
+    
+    def __setitem__(self, key, value):
+        if key in self.FIELDS:
+            setattr(self, key, value)
+        else:
+            self.extra[key] = value
+    
+    def __contains__(self, key):
+        return key in self.FIELDS or key in self.extra
+    
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+    
+    def to_dict(self, include_context=True):
+        """转换为普通字典，include_context=False时不解析context_info"""
+        data = {field: getattr(self, field) for field in self.FIELDS if field != 'context_info'}
+        if include_context:
+            data['context_info'] = self.context_info
+        data.update(self.extra)
+        return data
+
+class AppJSONProvider(DefaultJSONProvider):
+    """让jsonify可以直接序列化ImageRecord"""
+    @staticmethod
+    def default(o):
+        if isinstance(o, ImageRecord):
+            return o.to_dict()
+        return DefaultJSONProvider.default(o)
+
+app.json = AppJSONProvider(app)
+
+class SQLiteConnectionPool:
+    """有界的SQLite连接池
+
+    连接在线程间复用，并统一开启WAL、busy_timeout和synchronous=NORMAL，
+    使读写可以并发进行，避免"database is locked"错误。
+    同一线程内嵌套调用 connection() 时复用外层连接，由外层负责提交。
+    read_only为True时连接开启query_only，任何写入都会失败。
+    """
+    def __init__(self, db_path, max_size=8, timeout=30.0, read_only=False):
+        self.db_path = db_path
+        self.max_size = max_size
+        self.timeout = timeout
+        self.read_only = read_only
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+    
+    def _open(self):
+        conn = sqlite3.connect(self.db_path, timeout=self.timeout, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA busy_timeout={int(self.timeout * 1000)}')
+        if self.read_only:
+            conn.execute('PRAGMA query_only=ON')
+        return conn
+    
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        
+        with self._lock:
+            if self._created < self.max_size:
+                self._created += 1
+                create = True
+            else:
+                create = False
+        
+        if create:
+            try:
+                return self._open()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise sqlite3.OperationalError("数据库连接池已耗尽")
+    
+    @contextmanager
+    def connection(self):
+        """获取连接，正常退出时提交，异常时回滚"""
+        held = getattr(self._local, 'conn', None)
+        if held is not None:
+            yield held
+            return
+        
+        conn = self._acquire()
+        self._local.conn = conn
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            self._local.conn = None
+            self._idle.put(conn)
+    
+    def close_all(self):
+        """关闭所有空闲连接"""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
 class ImageDatabase:
-    def __init__(self, db_path):
+    """图片数据库
+
+    shard_dir为None时所有数据保存在db_path一个文件中；否则db_path只保存users表，
+    每个用户的数据保存在 shard_dir/<user_id>/USER_DB_FILENAME 中。
+    各方法按user_id自动选择对应的数据库，调用方无需区分两种模式。
+    用户库只在注册和登录时创建，最多同时打开MAX_OPEN_SHARDS个，超出时关闭最久未使用的。
+    """
+    def __init__(self, db_path, shard_dir=None):
         self.db_path = db_path
+        self.pool = SQLiteConnectionPool(db_path)
+        self.shard_dir = Path(shard_dir) if shard_dir else None
+        self._shards = OrderedDict()
+        self._shards_lock = threading.Lock()
+        self._empty_shard = None
+        # 默认用户ID在进程内只解析一次
+        self._default_user_id = None
+        self._default_user_lock = threading.Lock()
+        # 待写入的最后登录时间 {user_id: 时间}
+        self._pending_logins = {}
+        self._logins_lock = threading.Lock()
+        self._login_flusher = None
         self.init_db()
     
-    def init_db(self):
-        conn = sqlite3.connect(self.db_path)
+    def connection(self, user_id=None):
+        """从连接池获取数据库连接（上下文管理器），分库模式下传入user_id时使用该用户的数据库"""
+        if user_id is None or self.shard_dir is None:
+            return self.pool.connection()
+        return self.shard_pool(user_id).connection()
+    
+    def shard_path(self, user_id):
+        """用户数据库文件路径"""
+        if not user_id or user_id in ('.', '..') or '/' in user_id or '\\' in user_id:
+            raise ValueError(f'无效的用户ID: {user_id!r}')
+        return self.shard_dir / user_id / USER_DB_FILENAME
+    
+    def shard_pool(self, user_id, create=False):
+        """获取用户数据库的连接池，首次打开时检查结构版本
+
+        数据库文件不存在时，create为True才创建（注册和登录），否则返回只读的空库，
+        避免任意user_id的请求在磁盘上创建数据库。
+        """
+        with self._shards_lock:
+            pool = self._shards.get(user_id)
+            if pool is not None:
+                self._shards.move_to_end(user_id)
+                return pool
+        
+        path = self.shard_path(user_id)
+        if not create and not path.exists():
+            return self._empty_shard_pool()
+        
+        with self._shards_lock:
+            pool = self._shards.get(user_id)
+            if pool is None:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                pool = SQLiteConnectionPool(str(path), max_size=4)
+                self.init_db(pool)
+                self._shards[user_id] = pool
+                while len(self._shards) > MAX_OPEN_SHARDS:
+                    # 正在使用的连接归还后随连接池一起被回收
+                    _, evicted = self._shards.popitem(last=False)
+                    evicted.close_all()
+        return pool
+    
+    def _empty_shard_pool(self):
+        """没有数据库文件的用户共用的空库，结构与用户库相同但不能写入"""
+        with self._shards_lock:
+            if self._empty_shard is None:
+                path = self.shard_dir / EMPTY_SHARD_FILENAME
+                self.shard_dir.mkdir(parents=True, exist_ok=True)
+                writer = SQLiteConnectionPool(str(path), max_size=1)
+                self.init_db(writer)
+                writer.close_all()
+                self._empty_shard = SQLiteConnectionPool(str(path), max_size=4, read_only=True)
+        return self._empty_shard
+    
+    def shard_user_ids(self):
+        """已有数据库文件的用户ID列表（仅分库模式）"""
+        if self.shard_dir is None or not self.shard_dir.exists():
+            return []
+        return sorted(path.parent.name for path in self.shard_dir.glob(f'*/{USER_DB_FILENAME}'))
+    
+    def all_pools(self):
+        """全部数据库的连接池：主库以及所有用户库"""
+        return [self.pool] + [self.shard_pool(user_id) for user_id in self.shard_user_ids()]
+    
+    def migrate_to_shards(self):
+        """将主库中各用户的图片、收藏、任务和试穿历史迁移到各自的用户库
+
+        迁移前先备份主库为 <db_path>.bak；数据复制到所有用户库后才从主库删除，
+        重复执行时已迁移的记录会被跳过。返回 {user_id: {表名: 复制的行数}}
+        """
+        if self.shard_dir is None:
+            raise ValueError('未开启分库模式（shard_dir为空）')
+        
+        backup_path = f'{self.db_path}.bak'
+        with self.connection() as conn:
+            backup = sqlite3.connect(backup_path)
+            try:
+                conn.backup(backup)
+            finally:
+                backup.close()
+        print(f"已备份数据库: {backup_path}")
+        
+        with self.connection() as conn:
+            user_ids = [row[0] for row in conn.execute(
+                ' UNION '.join(f'SELECT user_id FROM {table}' for table in USER_SHARD_TABLES)
+            )]
+        
+        source_path = str(Path(self.db_path).resolve())
+        report = {}
+        for user_id in user_ids:
+            report[user_id] = {}
+            with self.shard_pool(user_id, create=True).connection() as conn:
+                conn.execute('ATTACH DATABASE ? AS source', (source_path,))
+                try:
+                    for table in USER_SHARD_TABLES:
+                        # 只复制两边都有的列，images的计数和全文索引由触发器维护
+                        target_columns = [row[1] for row in conn.execute(f'PRAGMA main.table_info({table})')]
+                        source_columns = {row[1] for row in conn.execute(f'PRAGMA source.table_info({table})')}
+                        columns = ', '.join(column for column in target_columns if column in source_columns)
+                        cursor = conn.execute(f'''
+                            INSERT OR IGNORE INTO main.{table} ({columns})
+                            SELECT {columns} FROM source.{table} WHERE user_id = ?
+                        ''', (user_id,))
+                        report[user_id][table] = cursor.rowcount
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+                finally:
+                    conn.execute('DETACH DATABASE source')
+            print(f"已迁移用户 {user_id}: {report[user_id]}")
+        
+        with self.connection() as conn:
+            for table in USER_SHARD_TABLES:
+                conn.execute(f'DELETE FROM {table}')
+        
+        return report
+    
+    def migrate_to_blobs(self):
+        """为尚未计算内容哈希的图片建立内容寻址存储，并合并内容相同的文件
+
+        逐个文件计算SHA-256：blob不存在时把原文件硬链接为blob，已存在时用指向blob的
+        硬链接替换原文件，释放重复内容占用的空间。文件缺失的记录保持不变，可重复执行。
+        返回 {'hashed', 'deduplicated', 'bytes_saved', 'missing'}
+        """
+        report = {'hashed': 0, 'deduplicated': 0, 'bytes_saved': 0, 'missing': 0}
+        for pool in self.all_pools():
+            with pool.connection() as conn:
+                rows = conn.execute(
+                    'SELECT id, user_id, filename, category FROM images WHERE content_hash IS NULL'
+                ).fetchall()
+            
+            updates = []
+            for image_id, user_id, filename, category in rows:
+                filepath = BASE_SAVE_DIR / user_id / (category or 'clothes') / filename
+                try:
+                    content_hash, bytes_saved = adopt_blob(user_id, filepath)
+                except FileNotFoundError:
+                    report['missing'] += 1
+                    continue
+                if bytes_saved:
+                    report['deduplicated'] += 1
+                    report['bytes_saved'] += bytes_saved
+                updates.append((content_hash, image_id))
+                report['hashed'] += 1
+            
+            # 引用计数由触发器随content_hash的更新维护
+            with pool.connection() as conn:
+                conn.executemany('UPDATE images SET content_hash = ? WHERE id = ?', updates)
+        
+        print(f"内容寻址存储迁移完成: {report}")
+        return report
+    
+    def init_db(self, pool=None):
+        """启动时检查数据库结构版本，只有版本落后时才执行建表和迁移"""
+        pool = pool or self.pool
+        with pool.connection() as conn:
+            if conn.execute('PRAGMA user_version').fetchone()[0] >= SCHEMA_VERSION:
+                return
+            
+            # 获取写锁后再次检查版本，避免多个进程同时迁移
+            conn.execute('BEGIN IMMEDIATE')
+            current_version = conn.execute('PRAGMA user_version').fetchone()[0]
+            if current_version >= SCHEMA_VERSION:
+                return
+            
+            self.create_base_schema(conn)
+            self.apply_migrations(conn, current_version)
+    
+    def create_base_schema(self, conn):
+        """创建基础表结构，并为旧数据库补充category字段"""
         cursor = conn.cursor()
         
         # 创建用户表
@@ -139,87 +881,189 @@ class ImageDatabase:
                 FOREIGN KEY (result_image_id) REFERENCES images (id)
             )
         ''')
-        
-        conn.commit()
-        conn.close()
+    
+    def apply_migrations(self, conn, current_version):
+        """按版本执行尚未应用的结构迁移"""
+        for version, statements in SCHEMA_MIGRATIONS:
+            if version <= current_version:
+                continue
+            for statement in statements:
+                if callable(statement):
+                    statement(conn)
+                else:
+                    conn.execute(statement)
+            conn.execute(f'PRAGMA user_version = {version}')
+            print(f"已应用数据库迁移 (版本 {version})")
     
     def create_user(self, username, email, password):
         """创建新用户"""
         user_id = str(uuid.uuid4())
         password_hash = hashlib.sha256(password.encode()).hexdigest()
         
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        try:
-            cursor.execute('''
-                INSERT INTO users (user_id, username, email, password_hash)
-                VALUES (?, ?, ?, ?)
-            ''', (user_id, username, email, password_hash))
-            conn.commit()
+        with self.connection() as conn:
+            try:
+                conn.execute('''
+                    INSERT INTO users (user_id, username, email, password_hash)
+                    VALUES (?, ?, ?, ?)
+                ''', (user_id, username, email, password_hash))
+            except sqlite3.IntegrityError as e:
+                return None
+        
+        # 创建用户专属目录
+        user_dir = BASE_SAVE_DIR / user_id
+        user_dir.mkdir(exist_ok=True)
+        if self.shard_dir is not None:
+            self.shard_pool(user_id, create=True)
+        
+        return user_id
+    
+    def get_default_user_id(self):
+        """获取或创建默认用户（用于未登录用户），结果缓存在进程内"""
+        default_user_id = self._default_user_id
+        if default_user_id:
+            return default_user_id
+        
+        with self._default_user_lock:
+            if self._default_user_id:
+                return self._default_user_id
             
-            # 创建用户专属目录
-            user_dir = BASE_SAVE_DIR / user_id
-            user_dir.mkdir(exist_ok=True)
+            with self.connection() as conn:
+                # username唯一，多个进程同时创建时只有一个插入生效
+                conn.execute('''
+                    INSERT OR IGNORE INTO users (user_id, username, email, password_hash, is_active)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', ("default-user-" + str(uuid.uuid4())[:8], 'default_user',
+                      'default@local.app', 'default_hash', 1))
+                default_user_id = conn.execute(
+                    "SELECT user_id FROM users WHERE username = 'default_user' LIMIT 1"
+                ).fetchone()[0]
             
-            return user_id
-        except sqlite3.IntegrityError as e:
-            return None
-        finally:
-            conn.close()
+            # 创建默认用户目录
+            (BASE_SAVE_DIR / default_user_id / "clothes").mkdir(parents=True, exist_ok=True)
+            if self.shard_dir is not None:
+                self.shard_pool(default_user_id, create=True)
+            
+            self._default_user_id = default_user_id
+            return default_user_id
     
     def verify_user(self, username, password):
         """验证用户登录"""
         password_hash = hashlib.sha256(password.encode()).hexdigest()
         
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT user_id, username, email FROM users 
-            WHERE username = ? AND password_hash = ? AND is_active = 1
-        ''', (username, password_hash))
-        result = cursor.fetchone()
+        with self.connection() as conn:
+            result = conn.execute('''
+                SELECT user_id, username, email FROM users 
+                WHERE username = ? AND password_hash = ? AND is_active = 1
+            ''', (username, password_hash)).fetchone()
         
         if result:
-            # 更新最后登录时间
-            cursor.execute('''
-                UPDATE users SET last_login = CURRENT_TIMESTAMP WHERE user_id = ?
-            ''', (result[0],))
-            conn.commit()
+            # 最后登录时间由后台线程批量写入，登录只读数据库
+            self.record_login(result[0])
+            if self.shard_dir is not None:
+                self.shard_pool(result[0], create=True)
         
-        conn.close()
         return result
     
+    def record_login(self, user_id):
+        """记录用户的最后登录时间，稍后批量写入数据库"""
+        with self._logins_lock:
+            self._pending_logins[user_id] = utc_timestamp()
+            if self._login_flusher is None or not self._login_flusher.is_alive():
+                self._login_flusher = threading.Thread(target=self._login_flush_loop, name='login-flusher', daemon=True)
+                self._login_flusher.start()
+    
+    def _login_flush_loop(self):
+        while True:
+            time.sleep(LOGIN_FLUSH_INTERVAL)
+            self.flush_last_logins()
+    
+    def flush_last_logins(self):
+        """将缓存的最后登录时间批量写入数据库"""
+        with self._logins_lock:
+            pending = self._pending_logins
+            self._pending_logins = {}
+        if not pending:
+            return 0
+        
+        try:
+            with self.connection() as conn:
+                conn.executemany(
+                    'UPDATE users SET last_login = ? WHERE user_id = ?',
+                    [(login_time, user_id) for user_id, login_time in pending.items()]
+                )
+        except Exception as e:
+            print(f"写入最后登录时间失败: {e}")
+            # 写入失败时放回缓存，下次重试（不覆盖更新的登录时间）
+            with self._logins_lock:
+                for user_id, login_time in pending.items():
+                    self._pending_logins.setdefault(user_id, login_time)
+            return 0
+        return len(pending)
+    
     def get_user_info(self, user_id):
         """获取用户信息"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT user_id, username, email, created_at, last_login, cloud_sync_enabled
-            FROM users WHERE user_id = ?
-        ''', (user_id,))
-        result = cursor.fetchone()
-        conn.close()
+        with self.connection() as conn:
+            result = conn.execute('''
+                SELECT user_id, username, email, created_at, last_login, cloud_sync_enabled
+                FROM users WHERE user_id = ?
+            ''', (user_id,)).fetchone()
         
         if result:
+            # 尚未写入数据库的登录时间优先
+            with self._logins_lock:
+                last_login = self._pending_logins.get(user_id, result[4])
             return {
                 'user_id': result[0],
                 'username': result[1],
                 'email': result[2],
                 'created_at': result[3],
-                'last_login': result[4],
+                'last_login': last_login,
                 'cloud_sync_enabled': bool(result[5])
             }
         return None
     
-    def save_image_record(self, image_id, user_id, filename, original_url, page_info, file_size, width, height, context_info, category='clothes'):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO images (id, user_id, filename, original_url, page_url, page_title, file_size, image_width, image_height, context_info, category)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (image_id, user_id, filename, original_url, page_info.get('url'), page_info.get('title'), file_size, width, height, json.dumps(context_info), category))
-        conn.commit()
-        conn.close()
+    def save_image_record(self, image_id, user_id, filename, original_url, page_info, file_size, width, height, context_info, category='clothes', content_hash=None):
+        self.save_image_records([{
+            'image_id': image_id,
+            'user_id': user_id,
+            'filename': filename,
+            'original_url': original_url,
+            'page_info': page_info,
+            'file_size': file_size,
+            'width': width,
+            'height': height,
+            'context_info': context_info,
+            'category': category,
+            'content_hash': content_hash
+        }])
+    
+    def save_image_records(self, records):
+        """在一个事务中批量插入图片记录，records的键与save_image_record的参数相同"""
+        rows = [
+            (
+                record['image_id'], record['user_id'], record['filename'], record['original_url'],
+                record['page_info'].get('url'), record['page_info'].get('title'),
+                record['file_size'], record['width'], record['height'],
+                json.dumps(record['context_info']), record.get('category', 'clothes'),
+                extract_page_domain(record['page_info'].get('url')), record.get('content_hash')
+            )
+            for record in records
+        ]
+        if not rows:
+            return 0
+        
+        # 按用户分组，分库模式下每个用户的记录写入各自的数据库
+        rows_by_user = {}
+        for row in rows:
+            rows_by_user.setdefault(row[1], []).append(row)
+        
+        for user_id, user_rows in rows_by_user.items():
+            with self.connection(user_id) as conn:
+                conn.executemany('''
+                    INSERT INTO images (id, user_id, filename, original_url, page_url, page_title, file_size, image_width, image_height, context_info, category, page_domain, content_hash)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', user_rows)
+        return len(rows)
     
     def add_to_favorites(self, user_id, image_id, favorite_type='image'):
         """添加到收藏"""
@@ -227,131 +1071,213 @@ class ImageDatabase:
             return False
             
         favorite_id = str(uuid.uuid4())
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        try:
-            cursor.execute('''
-                INSERT INTO favorites (id, user_id, image_id, favorite_type)
-                VALUES (?, ?, ?, ?)
-            ''', (favorite_id, user_id, image_id, favorite_type))
-            conn.commit()
-            return True
-        except sqlite3.IntegrityError:
-            # 已经收藏过了
-            return False
-        finally:
-            conn.close()
+        with self.connection(user_id) as conn:
+            try:
+                conn.execute('''
+                    INSERT INTO favorites (id, user_id, image_id, favorite_type)
+                    VALUES (?, ?, ?, ?)
+                ''', (favorite_id, user_id, image_id, favorite_type))
+                return True
+            except sqlite3.IntegrityError:
+                # 已经收藏过了
+                return False
     
     def remove_from_favorites(self, user_id, image_id, favorite_type='image'):
         """从收藏中移除"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        try:
-            cursor.execute('''
+        with self.connection(user_id) as conn:
+            cursor = conn.execute('''
                 DELETE FROM favorites 
                 WHERE user_id = ? AND image_id = ? AND favorite_type = ?
             ''', (user_id, image_id, favorite_type))
-            conn.commit()
             return cursor.rowcount > 0
-        finally:
-            conn.close()
     
     def is_favorited(self, user_id, image_id, favorite_type='image'):
         """检查是否已收藏"""
         if not image_id:
             return False
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        try:
-            cursor.execute('''
+        with self.connection(user_id) as conn:
+            cursor = conn.execute('''
                 SELECT COUNT(*) FROM favorites 
                 WHERE user_id = ? AND image_id = ? AND favorite_type = ?
             ''', (user_id, image_id, favorite_type))
             return cursor.fetchone()[0] > 0
-        finally:
-            conn.close()
     
-    def get_user_favorites(self, user_id, favorite_type='image', limit=50, offset=0):
-        """获取用户收藏列表"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        try:
+    def get_user_favorites(self, user_id, favorite_type='image', limit=50, offset=0, cursor=None):
+        """获取用户收藏列表，cursor为 (favorited_at, image_id) 时使用游标分页"""
+        conditions = ['f.user_id = ?', 'f.favorite_type = ?']
+        params = [user_id, favorite_type]
+        if cursor:
+            conditions.append('(f.created_at, f.image_id) < (?, ?)')
+            params.extend(cursor)
+            offset = 0
+        
+        with self.connection(user_id) as conn:
             # 收藏的都是image类型，通过category区分
-            cursor.execute('''
-                SELECT i.*, f.created_at as favorited_at
+            results = conn.execute(f'''
+                SELECT {IMAGE_COLUMNS_SQL}, f.created_at as favorited_at
                 FROM favorites f
                 JOIN images i ON f.image_id = i.id
-                WHERE f.user_id = ? AND f.favorite_type = ?
-                ORDER BY f.created_at DESC
+                WHERE {' AND '.join(conditions)}
+                ORDER BY f.created_at DESC, f.image_id DESC
                 LIMIT ? OFFSET ?
-            ''', (user_id, favorite_type, limit, offset))
-            
-            results = cursor.fetchall()
+            ''', (*params, limit, offset)).fetchall()
+        
+        # 这些都是收藏的
+        return [ImageRecord(row, favorited_at=row['favorited_at'], is_favorited=True) for row in results]
+    
+    def iter_user_images(self, user_id, batch_size=EXPORT_BATCH_SIZE):
+        """按 (saved_at, id) 分批读取用户的全部图片，每批是独立的短查询，内存占用与图片总数无关"""
+        cursor = None
+        while True:
+            batch = self.get_user_images(user_id, limit=batch_size, cursor=cursor)
+            yield from batch
+            if len(batch) < batch_size:
+                return
+            cursor = (batch[-1]['saved_at'], batch[-1]['id'])
+    
+    def iter_user_favorites(self, user_id, favorite_type='image', batch_size=EXPORT_BATCH_SIZE):
+        """按 (favorited_at, image_id) 分批读取用户的全部收藏"""
+        cursor = None
+        while True:
+            batch = self.get_user_favorites(user_id, favorite_type, limit=batch_size, cursor=cursor)
+            yield from batch
+            if len(batch) < batch_size:
+                return
+            cursor = (batch[-1]['favorited_at'], batch[-1]['id'])
+    
+    def iter_vton_history(self, user_id, batch_size=EXPORT_BATCH_SIZE):
+        """按 (created_at, id) 分批读取用户的全部试穿历史"""
+        cursor = None
+        while True:
+            conditions = ['user_id = ?']
+            params = [user_id]
+            if cursor:
+                conditions.append('(created_at, id) < (?, ?)')
+                params.extend(cursor)
+            with self.connection(user_id) as conn:
+                rows = conn.execute(f'''
+                    SELECT id, user_id, human_image, garment_image, result_image, 
+                           result_image_id, parameters, processing_time, created_at
+                    FROM vton_history 
+                    WHERE {' AND '.join(conditions)}
+                    ORDER BY created_at DESC, id DESC LIMIT ?
+                ''', (*params, batch_size)).fetchall()
             
-            favorites = []
-            for row in results:
-                favorites.append({
+            for row in rows:
+                try:
+                    parameters = json.loads(row[6]) if row[6] else {}
+                except:
+                    parameters = {}
+                
+                yield {
                     'id': row[0],
                     'user_id': row[1],
-                    'filename': row[2],
-                    'original_url': row[3],
-                    'page_url': row[4],
-                    'page_title': row[5],
-                    'saved_at': row[6],
-                    'file_size': row[7],
-                    'image_width': row[8],
-                    'image_height': row[9],
-                    'context_info': json.loads(row[10]) if row[10] else {},
-                    'status': row[11],
-                    'cloud_synced': bool(row[12]) if len(row) > 12 else False,
-                    'category': row[13] if len(row) > 13 else 'clothes',
-                    'favorited_at': row[-1],
-                    'is_favorited': True  # 这些都是收藏的
-                })
-            return favorites
-                
-        finally:
-            conn.close()
+                    'human_image': row[2],
+                    'garment_image': row[3],
+                    'result_image': row[4],
+                    'result_image_id': row[5],
+                    'parameters': parameters,
+                    'processing_time': row[7],
+                    'created_at': row[8]
+                }
+            if len(rows) < batch_size:
+                return
+            cursor = (rows[-1][8], rows[-1][0])
     
-    def create_task(self, task_id, user_id, image_id):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        try:
-            cursor.execute('''
-                INSERT INTO tasks (task_id, user_id, image_id, status, created_at, updated_at) 
-                VALUES (?, ?, ?, 'processing', CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
-            ''', (task_id, user_id, image_id))
-            conn.commit()
-        except Exception as e:
-            print(f"创建任务失败: {e}")
-            conn.rollback()
-            raise
-        finally:
-            conn.close()
+    def record_derivatives(self, user_id, image_id, width, height, dhash=None):
+        """记录缩略图和感知哈希已生成，并补全入库时未能读取的图片尺寸，图片已被删除时返回False"""
+        with self.connection(user_id) as conn:
+            cursor = conn.execute('''
+                UPDATE images SET derivatives_at = CURRENT_TIMESTAMP,
+                    image_width = CASE WHEN image_width > 0 THEN image_width ELSE ? END,
+                    image_height = CASE WHEN image_height > 0 THEN image_height ELSE ? END,
+                    dhash = COALESCE(?, dhash)
+                WHERE id = ? AND user_id = ?
+            ''', (width, height, dhash, image_id, user_id))
+            return cursor.rowcount > 0
     
-    def update_task_status(self, task_id, status):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        try:
-            cursor.execute('''
-                UPDATE tasks SET status = ?, updated_at = CURRENT_TIMESTAMP WHERE task_id = ?
-            ''', (status, task_id))
-            if cursor.rowcount == 0:
-                print(f"警告: 任务 {task_id} 不存在")
-            conn.commit()
-        except Exception as e:
-            print(f"更新任务状态失败: {e}")
-            conn.rollback()
-            raise
-        finally:
-            conn.close()
+    def mark_duplicate(self, user_id, image_id, duplicate_of):
+        """标记图片为另一张图片的近似重复"""
+        with self.connection(user_id) as conn:
+            conn.execute('UPDATE images SET duplicate_of = ? WHERE id = ? AND user_id = ?',
+                         (duplicate_of, image_id, user_id))
     
-    def get_task_status(self, task_id):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    def get_image_hashes(self, user_id):
+        """用户所有已计算感知哈希的图片，返回 [(image_id, dhash)]"""
+        with self.connection(user_id) as conn:
+            return conn.execute(
+                'SELECT id, dhash FROM images WHERE user_id = ? AND dhash IS NOT NULL', (user_id,)
+            ).fetchall()
+    
+    def get_images_without_hash(self, user_id):
+        """尚未计算感知哈希的图片（如升级前保存的图片），返回 [(image_id, category, filename)]"""
+        with self.connection(user_id) as conn:
+            return conn.execute(
+                'SELECT id, category, filename FROM images WHERE user_id = ? AND dhash IS NULL', (user_id,)
+            ).fetchall()
+    
+    def get_image_dhash(self, user_id, image_id):
+        with self.connection(user_id) as conn:
+            row = conn.execute('SELECT dhash FROM images WHERE id = ? AND user_id = ?', (image_id, user_id)).fetchone()
+        return row[0] if row else None
+    
+    def get_images_by_ids(self, user_id, image_ids):
+        """按ID批量获取用户图片，返回 {image_id: ImageRecord}"""
+        images = {}
+        with self.connection(user_id) as conn:
+            for start in range(0, len(image_ids), SQLITE_IN_BATCH_SIZE):
+                chunk = image_ids[start:start + SQLITE_IN_BATCH_SIZE]
+                placeholders = ','.join('?' * len(chunk))
+                for row in conn.execute(f'''
+                    SELECT {IMAGE_COLUMNS_SQL} FROM images i
+                    WHERE i.user_id = ? AND i.id IN ({placeholders})
+                ''', (user_id, *chunk)):
+                    images[row['id']] = ImageRecord(row)
+        return images
+    
+    def get_vton_history_count(self, user_id):
+        with self.connection(user_id) as conn:
+            return conn.execute('SELECT COUNT(*) FROM vton_history WHERE user_id = ?', (user_id,)).fetchone()[0]
+    
+    def export_user_data(self, user_id):
+        """导出用户数据（用于云端同步），图片、收藏和试穿历史按需分批读取"""
+        return UserDataExport(self, user_id)
+    
+    def save_tasks(self, tasks):
+        """批量写入任务状态（已存在则更新）"""
+        if not tasks:
+            return 0
+        
+        tasks_by_user = {}
+        for task in tasks:
+            tasks_by_user.setdefault(task['user_id'], []).append(task)
+        
+        for user_id, user_tasks in tasks_by_user.items():
+            with self.connection(user_id) as conn:
+                conn.executemany('''
+                    INSERT INTO tasks (task_id, user_id, image_id, status, created_at, updated_at)
+                    VALUES (:task_id, :user_id, :image_id, :status, :created_at, :updated_at)
+                    ON CONFLICT(task_id) DO UPDATE SET
+                        status = excluded.status, updated_at = excluded.updated_at
+                ''', user_tasks)
+        return len(tasks)
+    
+    def purge_tasks(self, retention_days):
+        """删除超过保留期限的任务记录"""
+        purged = 0
+        for pool in self.all_pools():
+            with pool.connection() as conn:
+                cursor = conn.execute(
+                    "DELETE FROM tasks WHERE updated_at < datetime('now', ?)",
+                    (f'-{int(retention_days)} days',)
+                )
+                purged += cursor.rowcount
+        return purged
+    
+    def get_task_status(self, task_id, user_id=None):
         try:
-            cursor.execute('SELECT task_id, user_id, status, created_at, updated_at, image_id FROM tasks WHERE task_id = ?', (task_id,))
-            result = cursor.fetchone()
+            with self.connection(user_id) as conn:
+                result = conn.execute('SELECT task_id, user_id, status, created_at, updated_at, image_id FROM tasks WHERE task_id = ?', (task_id,)).fetchone()
             if result:
                 return {
                     'task_id': result[0],
@@ -365,230 +1291,782 @@ class ImageDatabase:
         except Exception as e:
             print(f"获取任务状态失败: {e}")
             return None
-        finally:
-            conn.close()
 
-    def get_all_images(self, limit=50, offset=0):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT * FROM images ORDER BY saved_at DESC LIMIT ? OFFSET ?
-        ''', (limit, offset))
-        results = cursor.fetchall()
-        conn.close()
-        
-        images = []
-        for row in results:
-            images.append({
-                'id': row[0],
-                'filename': row[1],
-                'original_url': row[2],
-                'page_url': row[3],
-                'page_title': row[4],
-                'saved_at': row[5],
-                'file_size': row[6],
-                'image_width': row[7],
-                'image_height': row[8],
-                'context_info': json.loads(row[9]) if row[9] else {},
-                'status': row[10]
-            })
-        return images
+    def get_all_images(self, limit=50, offset=0, cursor=None):
+        conditions = []
+        params = []
+        if cursor:
+            conditions.append('(saved_at, id) < (?, ?)')
+            params.extend(cursor)
+            offset = 0
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        sql = f'''
+            SELECT {IMAGE_COLUMNS_SQL} FROM images i {where} ORDER BY saved_at DESC, id DESC LIMIT ? OFFSET ?
+        '''
+        
+        if self.shard_dir is None:
+            with self.connection() as conn:
+                results = conn.execute(sql, (*params, limit, offset)).fetchall()
+            return [ImageRecord(row) for row in results]
+        
+        # 分库模式下从每个用户库取前 offset+limit 条，再按相同顺序归并
+        per_shard = []
+        for user_id in self.shard_user_ids():
+            with self.connection(user_id) as conn:
+                per_shard.append(conn.execute(sql, (*params, offset + limit, 0)).fetchall())
+        merged = heapq.merge(*per_shard, key=lambda row: (row['saved_at'], row['id']), reverse=True)
+        return [ImageRecord(row) for row in list(merged)[offset:offset + limit]]
     
-    def get_user_images(self, user_id, category=None, limit=50, offset=0):
-        """获取用户的图片列表，支持按分类过滤"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
+    @staticmethod
+    def image_filter_conditions(filters):
+        """将parse_image_filters得到的筛选条件转换为SQL条件（images别名i，favorites别名f）"""
+        conditions = []
+        params = []
+        if not filters:
+            return conditions, params
+        
+        ranges = [
+            ('saved_from', 'i.saved_at >= ?'), ('saved_to', 'i.saved_at <= ?'),
+            ('min_size', 'i.file_size >= ?'), ('max_size', 'i.file_size <= ?'),
+            ('min_width', 'i.image_width >= ?'), ('max_width', 'i.image_width <= ?'),
+            ('min_height', 'i.image_height >= ?'), ('max_height', 'i.image_height <= ?'),
+        ]
+        if 'domain' in filters:
+            conditions.append('i.page_domain = ?')
+            params.append(filters['domain'])
+        for name, condition in ranges:
+            if name in filters:
+                conditions.append(condition)
+                params.append(filters[name])
+        if 'favorited' in filters:
+            conditions.append('f.id IS NOT NULL' if filters['favorited'] else 'f.id IS NULL')
+        return conditions, params
+    
+    def get_user_images(self, user_id, category=None, limit=50, offset=0, cursor=None, filters=None):
+        """获取用户的图片列表，支持按分类和筛选条件过滤，cursor为 (saved_at, id) 时使用游标分页"""
+        conditions = ['i.user_id = ?']
+        params = [user_id]
         if category:
-            cursor.execute('''
-                SELECT * FROM images WHERE user_id = ? AND category = ? ORDER BY saved_at DESC LIMIT ? OFFSET ?
-            ''', (user_id, category, limit, offset))
+            conditions.append('i.category = ?')
+            params.append(category)
+        filter_conditions, filter_params = self.image_filter_conditions(filters)
+        conditions.extend(filter_conditions)
+        params.extend(filter_params)
+        if cursor:
+            conditions.append('(i.saved_at, i.id) < (?, ?)')
+            params.extend(cursor)
+            offset = 0
+        
+        # 收藏状态通过LEFT JOIN在同一查询中获取，避免逐条查询
+        with self.connection(user_id) as conn:
+            results = conn.execute(f'''
+                SELECT {IMAGE_COLUMNS_SQL}, f.id IS NOT NULL AS is_favorited
+                FROM images i
+                LEFT JOIN favorites f
+                    ON f.user_id = i.user_id AND f.image_id = i.id AND f.favorite_type = 'image'
+                WHERE {' AND '.join(conditions)}
+                ORDER BY i.saved_at DESC, i.id DESC LIMIT ? OFFSET ?
+            ''', (*params, limit, offset)).fetchall()
+        
+        return [ImageRecord(row, is_favorited=bool(row['is_favorited'])) for row in results]
+    
+    def get_filtered_image_count(self, user_id, category=None, filters=None):
+        """按筛选条件统计用户图片数量（没有筛选条件时应使用计数表）"""
+        conditions = ['i.user_id = ?']
+        params = [user_id]
+        if category:
+            conditions.append('i.category = ?')
+            params.append(category)
+        filter_conditions, filter_params = self.image_filter_conditions(filters)
+        conditions.extend(filter_conditions)
+        params.extend(filter_params)
+        
+        with self.connection(user_id) as conn:
+            return conn.execute(f'''
+                SELECT COUNT(*) FROM images i
+                LEFT JOIN favorites f
+                    ON f.user_id = i.user_id AND f.image_id = i.id AND f.favorite_type = 'image'
+                WHERE {' AND '.join(conditions)}
+            ''', params).fetchone()[0]
+    
+    def get_user_domain_facets(self, user_id, category=None, filters=None):
+        """按来源域名统计用户图片数量，域名条件本身不参与统计"""
+        filters = {name: value for name, value in (filters or {}).items() if name != 'domain'}
+        conditions = ['i.user_id = ?']
+        params = [user_id]
+        if category:
+            conditions.append('i.category = ?')
+            params.append(category)
+        filter_conditions, filter_params = self.image_filter_conditions(filters)
+        conditions.extend(filter_conditions)
+        params.extend(filter_params)
+        
+        with self.connection(user_id) as conn:
+            results = conn.execute(f'''
+                SELECT i.page_domain, COUNT(*) AS count FROM images i
+                LEFT JOIN favorites f
+                    ON f.user_id = i.user_id AND f.image_id = i.id AND f.favorite_type = 'image'
+                WHERE {' AND '.join(conditions)}
+                GROUP BY i.page_domain
+                ORDER BY count DESC, i.page_domain
+            ''', params).fetchall()
+        
+        return [{'domain': row['page_domain'], 'count': row['count']} for row in results]
+    
+    @staticmethod
+    def search_clauses(query):
+        """将build_search_query的结果转换为 (FROM子句, 条件, 参数, 是否按相关度排序)
+
+        有FTS5查询时由全文索引驱动，按图片ID关联images；只有短关键词时从用户的图片出发，
+        按fts_rowid取出索引行逐条匹配，范围限定在该用户的图片内。
+        """
+        match, short_terms = query
+        conditions = []
+        params = []
+        if match:
+            from_sql = 'images_fts JOIN images i ON i.id = images_fts.id'
+            conditions.append('images_fts MATCH ?')
+            params.append(match)
         else:
-            cursor.execute('''
-                SELECT * FROM images WHERE user_id = ? ORDER BY saved_at DESC LIMIT ? OFFSET ?
-            ''', (user_id, limit, offset))
-        
-        results = cursor.fetchall()
-        conn.close()
-        
-        images = []
-        for row in results:
-            images.append({
-                'id': row[0],
-                'user_id': row[1],
-                'filename': row[2],
-                'original_url': row[3],
-                'page_url': row[4],
-                'page_title': row[5],
-                'saved_at': row[6],
-                'file_size': row[7],
-                'image_width': row[8],
-                'image_height': row[9],
-                'context_info': json.loads(row[10]) if row[10] else {},
-                'status': row[11],
-                'cloud_synced': bool(row[12]) if len(row) > 12 else False,
-                'category': row[13] if len(row) > 13 else 'clothes',
-                'is_favorited': self.is_favorited(user_id, row[0], favorite_type='image')
-            })
-        return images
+            from_sql = 'images i JOIN images_fts ON images_fts.rowid = i.fts_rowid'
+        for term in short_terms:
+            # 列名前的+使条件不交给FTS5处理（trigram分词对少于3个字符的LIKE不返回结果）
+            pattern = '%{}%'.format(term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_'))
+            conditions.append('({})'.format(' OR '.join(
+                f"+images_fts.{column} LIKE ? ESCAPE '\\'" for column in FTS_TEXT_COLUMNS
+            )))
+            params.extend([pattern] * len(FTS_TEXT_COLUMNS))
+        return from_sql, conditions, params, bool(match)
+    
+    def search_user_images(self, user_id, query, category=None, limit=50, offset=0):
+        """全文检索用户图片，按相关度排序；query为build_search_query的返回值"""
+        from_sql, conditions, params, ranked = self.search_clauses(query)
+        conditions.append('i.user_id = ?')
+        params.append(user_id)
+        if category:
+            conditions.append('i.category = ?')
+            params.append(category)
+        order_by = f'{FTS_RANK_SQL}, i.saved_at DESC' if ranked else 'i.saved_at DESC, i.id DESC'
+        
+        with self.connection(user_id) as conn:
+            results = conn.execute(f'''
+                SELECT {IMAGE_COLUMNS_SQL}, f.id IS NOT NULL AS is_favorited
+                FROM {from_sql}
+                LEFT JOIN favorites f
+                    ON f.user_id = i.user_id AND f.image_id = i.id AND f.favorite_type = 'image'
+                WHERE {' AND '.join(conditions)}
+                ORDER BY {order_by} LIMIT ? OFFSET ?
+            ''', (*params, limit, offset)).fetchall()
+        
+        return [ImageRecord(row, is_favorited=bool(row['is_favorited'])) for row in results]
+    
+    def get_search_count(self, user_id, query, category=None):
+        """全文检索命中的用户图片数量"""
+        from_sql, conditions, params, _ = self.search_clauses(query)
+        conditions.append('i.user_id = ?')
+        params.append(user_id)
+        if category:
+            conditions.append('i.category = ?')
+            params.append(category)
+        
+        with self.connection(user_id) as conn:
+            return conn.execute(f'''
+                SELECT COUNT(*) FROM {from_sql}
+                WHERE {' AND '.join(conditions)}
+            ''', params).fetchone()[0]
     
     def get_image_count(self):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('SELECT COUNT(*) FROM images')
-        count = cursor.fetchone()[0]
-        conn.close()
-        return count
+        total = 0
+        for pool in self.all_pools():
+            with pool.connection() as conn:
+                total += conn.execute("SELECT COALESCE(SUM(count), 0) FROM user_counters WHERE kind = 'images'").fetchone()[0]
+        return total
     
     def get_user_image_count(self, user_id, category=None):
-        """获取用户图片数量，支持按分类统计"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        if category:
-            cursor.execute('SELECT COUNT(*) FROM images WHERE user_id = ? AND category = ?', (user_id, category))
-        else:
-            cursor.execute('SELECT COUNT(*) FROM images WHERE user_id = ?', (user_id,))
-            
-        count = cursor.fetchone()[0]
-        conn.close()
-        return count
+        """获取用户图片数量，支持按分类统计（读取计数表）"""
+        with self.connection(user_id) as conn:
+            if category:
+                cursor = conn.execute('''
+                    SELECT COALESCE(SUM(count), 0) FROM user_counters
+                    WHERE user_id = ? AND kind = 'images' AND name = ?
+                ''', (user_id, category))
+            else:
+                cursor = conn.execute('''
+                    SELECT COALESCE(SUM(count), 0) FROM user_counters
+                    WHERE user_id = ? AND kind = 'images'
+                ''', (user_id,))
+            return cursor.fetchone()[0]
+    
+    def get_user_favorite_count(self, user_id, favorite_type=None):
+        """获取用户收藏数量，支持按收藏类型统计（读取计数表）"""
+        with self.connection(user_id) as conn:
+            if favorite_type:
+                cursor = conn.execute('''
+                    SELECT COALESCE(SUM(count), 0) FROM user_counters
+                    WHERE user_id = ? AND kind = 'favorites' AND name = ?
+                ''', (user_id, favorite_type))
+            else:
+                cursor = conn.execute('''
+                    SELECT COALESCE(SUM(count), 0) FROM user_counters
+                    WHERE user_id = ? AND kind = 'favorites'
+                ''', (user_id,))
+            return cursor.fetchone()[0]
+    
+    def get_user_counters(self, user_id):
+        """一次读取用户的全部计数，返回 {kind: {name: count}}"""
+        with self.connection(user_id) as conn:
+            rows = conn.execute(
+                'SELECT kind, name, count FROM user_counters WHERE user_id = ?', (user_id,)
+            ).fetchall()
+        
+        counters = {}
+        for kind, name, count in rows:
+            counters.setdefault(kind, {})[name] = count
+        return counters
+    
+    def get_user_filenames(self, user_id):
+        """获取用户所有图片的文件名集合"""
+        with self.connection(user_id) as conn:
+            rows = conn.execute('SELECT filename FROM images WHERE user_id = ?', (user_id,)).fetchall()
+        return {row[0] for row in rows}
     
     def get_image_by_filename(self, user_id, filename):
         """根据用户ID和文件名获取图片信息"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        try:
-            cursor.execute('''
-                SELECT id, user_id, filename, original_url, page_url, page_title, 
-                       saved_at, file_size, image_width, image_height, context_info, 
-                       status, cloud_synced, category
-                FROM images 
-                WHERE user_id = ? AND filename = ?
+        with self.connection(user_id) as conn:
+            row = conn.execute(f'''
+                SELECT {IMAGE_COLUMNS_SQL}
+                FROM images i
+                WHERE i.user_id = ? AND i.filename = ?
                 LIMIT 1
-            ''', (user_id, filename))
-            
-            row = cursor.fetchone()
-            if row:
-                return {
-                    'id': row[0],
-                    'user_id': row[1],
-                    'filename': row[2],
-                    'original_url': row[3],
-                    'page_url': row[4],
-                    'page_title': row[5],
-                    'saved_at': row[6],
-                    'file_size': row[7],
-                    'image_width': row[8],
-                    'image_height': row[9],
-                    'context_info': json.loads(row[10]) if row[10] else {},
-                    'status': row[11],
-                    'cloud_synced': bool(row[12]) if len(row) > 12 else False,
-                    'category': row[13] if len(row) > 13 else 'clothes'
-                }
-            return None
-        finally:
-            conn.close()
+            ''', (user_id, filename)).fetchone()
+        
+        return ImageRecord(row) if row else None
+    
+    def get_image_category(self, user_id, filename):
+        """根据用户ID和文件名获取图片所在分类，没有记录时返回None"""
+        with self.connection(user_id) as conn:
+            row = conn.execute(
+                'SELECT category FROM images WHERE user_id = ? AND filename = ? LIMIT 1', (user_id, filename)
+            ).fetchone()
+        return row[0] if row else None
     
     def get_image_by_id(self, image_id, user_id=None):
         """根据图片ID获取图片信息"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        try:
+        with self.connection(user_id) as conn:
             if user_id:
-                cursor.execute('SELECT * FROM images WHERE id = ? AND user_id = ?', (image_id, user_id))
+                row = conn.execute(f'SELECT {IMAGE_COLUMNS_SQL} FROM images i WHERE i.id = ? AND i.user_id = ?', (image_id, user_id)).fetchone()
             else:
-                cursor.execute('SELECT * FROM images WHERE id = ?', (image_id,))
-            
-            result = cursor.fetchone()
-            if result:
-                return {
-                    'id': result[0],
-                    'user_id': result[1],
-                    'filename': result[2],
-                    'original_url': result[3],
-                    'page_url': result[4],
-                    'page_title': result[5],
-                    'saved_at': result[6],
-                    'file_size': result[7],
-                    'image_width': result[8],
-                    'image_height': result[9],
-                    'context_info': json.loads(result[10]) if result[10] else {},
-                    'status': result[11],
-                    'cloud_synced': bool(result[12]) if len(result) > 12 else False,
-                    'category': result[13] if len(result) > 13 else 'clothes'
-                }
-            return None
-        finally:
-            conn.close()
+                row = conn.execute(f'SELECT {IMAGE_COLUMNS_SQL} FROM images i WHERE i.id = ?', (image_id,)).fetchone()
+        
+        return ImageRecord(row) if row else None
     
     def delete_image(self, image_id, user_id):
         """删除图片记录和文件"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
         try:
-            # 先获取图片信息
-            image = self.get_image_by_id(image_id, user_id)
-            if not image:
-                return False, "图片不存在或无权限删除"
-            
-            # 删除文件
-            try:
-                category = image.get('category', 'clothes')
-                user_save_dir = get_user_save_dir(user_id, category)
-                filepath = user_save_dir / image['filename']
-                if filepath.exists():
-                    filepath.unlink()
-                    print(f"已删除文件: {filepath}")
-            except Exception as e:
-                print(f"删除文件失败: {e}")
-                # 即使文件删除失败，也继续删除数据库记录
-            
-            # 删除数据库记录
-            cursor.execute('DELETE FROM images WHERE id = ? AND user_id = ?', (image_id, user_id))
-            
-            # 删除相关的收藏记录
-            cursor.execute('DELETE FROM favorites WHERE image_id = ?', (image_id,))
-            
-            # 删除相关的VTON历史记录
-            cursor.execute('DELETE FROM vton_history WHERE result_image_id = ?', (image_id,))
-            
-            conn.commit()
-            return True, "删除成功"
-            
+            deleted = self.delete_image_rows([image_id], user_id)
         except Exception as e:
-            conn.rollback()
             print(f"删除图片失败: {e}")
             return False, f"删除失败: {str(e)}"
-        finally:
-            conn.close()
+        
+        if not deleted:
+            return False, "图片不存在或无权限删除"
+        
+        # 文件交给后台线程删除
+        file_remover.submit_images(user_id, deleted.values())
+        return True, "删除成功"
+    
+    def delete_image_rows(self, image_ids, user_id):
+        """在一个事务中删除图片及其收藏和试穿历史记录，返回 {image_id: {'filename', 'category', 'blob'}}
+
+        blob为不再被任何图片引用的内容哈希（其文件应随图片一起删除），否则为None。
+        """
+        deleted = {}
+        hashes = {}
+        with self.connection(user_id) as conn:
+            for start in range(0, len(image_ids), SQLITE_IN_BATCH_SIZE):
+                chunk = image_ids[start:start + SQLITE_IN_BATCH_SIZE]
+                placeholders = ','.join('?' * len(chunk))
+                rows = conn.execute(f'''
+                    SELECT id, filename, category, content_hash FROM images
+                    WHERE user_id = ? AND id IN ({placeholders})
+                ''', (user_id, *chunk)).fetchall()
+                if not rows:
+                    continue
+                
+                found = [row[0] for row in rows]
+                placeholders = ','.join('?' * len(found))
+                conn.execute(f'DELETE FROM images WHERE user_id = ? AND id IN ({placeholders})', (user_id, *found))
+                # 删除相关的收藏记录
+                conn.execute(f'DELETE FROM favorites WHERE image_id IN ({placeholders})', found)
+                # 删除相关的VTON历史记录
+                conn.execute(f'DELETE FROM vton_history WHERE result_image_id IN ({placeholders})', found)
+                
+                for image_id, filename, category, content_hash in rows:
+                    deleted[image_id] = {'filename': filename, 'category': category or 'clothes', 'blob': None}
+                    if content_hash:
+                        hashes[content_hash] = image_id
+            
+            # 引用计数降为0的blob随最后一张引用它的图片一起删除
+            if hashes:
+                released = [row[0] for row in conn.execute(
+                    'SELECT content_hash FROM blobs WHERE user_id = ? AND ref_count <= 0', (user_id,)
+                )]
+                conn.execute('DELETE FROM blobs WHERE user_id = ? AND ref_count <= 0', (user_id,))
+                for content_hash in released:
+                    if content_hash in hashes:
+                        deleted[hashes[content_hash]]['blob'] = content_hash
+        return deleted
     
     def delete_multiple_images(self, image_ids, user_id):
-        """批量删除图片"""
+        """批量删除图片，返回 (是否成功, 消息, 每张图片的删除结果)"""
         if not image_ids:
-            return False, "未选择图片"
+            return False, "未选择图片", []
+        
+        image_ids = list(dict.fromkeys(image_ids))
+        try:
+            deleted = self.delete_image_rows(image_ids, user_id)
+        except Exception as e:
+            print(f"批量删除图片失败: {e}")
+            error = f"删除失败: {str(e)}"
+            return False, error, [{'id': image_id, 'success': False, 'error': error} for image_id in image_ids]
         
-        success_count = 0
-        failed_count = 0
-        errors = []
+        # 数据库事务提交后，文件交给后台线程删除
+        file_remover.submit_images(user_id, deleted.values())
         
+        results = []
         for image_id in image_ids:
-            success, message = self.delete_image(image_id, user_id)
-            if success:
-                success_count += 1
+            if image_id in deleted:
+                results.append({'id': image_id, 'success': True})
             else:
-                failed_count += 1
-                errors.append(f"ID {image_id}: {message}")
+                results.append({'id': image_id, 'success': False, 'error': "图片不存在或无权限删除"})
+        
+        success_count = len(deleted)
+        failed_count = len(image_ids) - success_count
         
         if failed_count == 0:
-            return True, f"成功删除 {success_count} 张图片"
+            return True, f"成功删除 {success_count} 张图片", results
         elif success_count == 0:
-            return False, f"删除失败: {'; '.join(errors)}"
+            errors = [f"ID {result['id']}: {result['error']}" for result in results]
+            return False, f"删除失败: {'; '.join(errors)}", results
         else:
-            return True, f"成功删除 {success_count} 张图片，失败 {failed_count} 张"
+            return True, f"成功删除 {success_count} 张图片，失败 {failed_count} 张", results
+
+class UserDataExport:
+    """一个用户的导出数据
+
+    images()、favorites()、vton_history() 每次调用都返回新的生成器，从数据库分批读取，
+    可以多次遍历；数量直接读取计数表。
+    """
+    def __init__(self, database, user_id):
+        self.database = database
+        self.user_id = user_id
+        self.user_info = database.get_user_info(user_id)
+    
+    def images(self):
+        return self.database.iter_user_images(self.user_id)
+    
+    def favorites(self):
+        return self.database.iter_user_favorites(self.user_id)
+    
+    def vton_history(self):
+        return self.database.iter_vton_history(self.user_id)
+    
+    def counts(self):
+        return {
+            'images': self.database.get_user_image_count(self.user_id),
+            'favorites': self.database.get_user_favorite_count(self.user_id, 'image'),
+            'vton_history': self.database.get_vton_history_count(self.user_id)
+        }
+
+class BackgroundFileRemover:
+    """后台删除图片文件，避免在请求线程中逐个unlink"""
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+    
+    def submit_images(self, user_id, images):
+        """提交待删除的图片及其缩略图，images为包含filename、category以及可选blob的字典"""
+        for image in images:
+            image_paths.discard(user_id, image['filename'])
+            similarity_index.invalidate(user_id)
+            self.submit(BASE_SAVE_DIR / user_id / image['category'] / image['filename'])
+            for thumbnail_path in get_thumbnail_paths(user_id, image['category'], image['filename']):
+                self.submit(thumbnail_path)
+            # 不再被引用的blob文件
+            if image.get('blob'):
+                self.submit(get_blob_path(user_id, image['blob']))
+    
+    def submit(self, path):
+        self._queue.put(Path(path))
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='file-remover', daemon=True)
+                self._thread.start()
+    
+    def join(self):
+        """等待已提交的文件全部处理完"""
+        self._queue.join()
+    
+    def _run(self):
+        while True:
+            path = self._queue.get()
+            try:
+                path.unlink()
+                print(f"已删除文件: {path}")
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                print(f"删除文件失败: {path}, 错误: {e}")
+            finally:
+                self._queue.task_done()
+
+class TaskRegistry:
+    """内存中的任务状态表，过期自动淘汰，可选异步批量写回数据库"""
+    def __init__(self, database, ttl=TASK_TTL_SECONDS, persist=TASK_PERSIST,
+                 flush_interval=TASK_FLUSH_INTERVAL, retention_days=TASK_RETENTION_DAYS,
+                 max_workers=TASK_MAX_WORKERS):
+        self.database = database
+        self.ttl = ttl
+        self.persist = persist
+        self.flush_interval = flush_interval
+        self.retention_days = retention_days
+        # 按过期时间排列：task_id -> (任务, 过期时间)
+        self._tasks = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='task-worker')
+        self._flusher = None
+        self._last_purge = None
+    
+    def submit(self, user_id, image_id, work=None, *args):
+        """登记任务并返回task_id；work为None时直接标记完成，否则交给后台线程池执行"""
+        task_id = self._create(user_id, image_id, 'processing' if work else 'completed')
+        if work:
+            self._executor.submit(self._run, task_id, work, *args)
+        return task_id
+    
+    def track(self, user_id, image_id, future):
+        """登记已写入文件和数据库的图片，返回task_id
+
+        任务直接标记为完成；future（缩略图生成）的进度单独记录在derivatives字段中，
+        生成失败只记录日志，不影响任务状态。
+        """
+        task_id = self._create(user_id, image_id, 'completed', derivatives='processing')
+        
+        def on_done(done):
+            error = 'cancelled' if done.cancelled() else done.exception()
+            if error:
+                print(f"缩略图生成失败: 任务 {task_id}, 图片 {image_id}, 错误: {error}")
+            self._update(task_id, derivatives='failed' if error else 'completed')
+        
+        future.add_done_callback(on_done)
+        return task_id
+    
+    def _create(self, user_id, image_id, status, **fields):
+        task_id = str(uuid.uuid4())
+        now = utc_timestamp()
+        self._store({
+            'task_id': task_id,
+            'user_id': user_id,
+            'status': status,
+            'created_at': now,
+            'updated_at': now,
+            'image_id': image_id,
+            **fields
+        })
+        return task_id
+    
+    def _run(self, task_id, work, *args):
+        try:
+            work(*args)
+            self.update(task_id, 'completed')
+        except Exception as e:
+            print(f"任务处理失败: {task_id}, 错误: {e}")
+            self.update(task_id, 'failed')
+    
+    def update(self, task_id, status):
+        self._update(task_id, status=status)
+    
+    def _update(self, task_id, **changes):
+        with self._lock:
+            entry = self._tasks.get(task_id)
+        if entry is None:
+            print(f"警告: 任务 {task_id} 不存在")
+            return
+        self._store(dict(entry[0], **changes, updated_at=utc_timestamp()))
+    
+    def get(self, task_id, user_id=None):
+        """优先从内存读取任务状态，已淘汰的任务再查数据库（分库模式下查user_id对应的数据库）"""
+        with self._lock:
+            self._expire()
+            entry = self._tasks.get(task_id)
+        if entry:
+            return dict(entry[0])
+        if self.persist:
+            return self.database.get_task_status(task_id, user_id)
+        return None
+    
+    def _store(self, task):
+        with self._lock:
+            self._tasks.pop(task['task_id'], None)
+            self._tasks[task['task_id']] = (task, time.monotonic() + self.ttl)
+            self._expire()
+            if self.persist:
+                self._pending[task['task_id']] = task
+        if self.persist:
+            self._ensure_flusher()
+    
+    def _expire(self):
+        """淘汰已过期的任务（调用方需持有锁）"""
+        now = time.monotonic()
+        while self._tasks:
+            _, expires_at = next(iter(self._tasks.values()))
+            if expires_at > now:
+                break
+            self._tasks.popitem(last=False)
+    
+    def _ensure_flusher(self):
+        with self._lock:
+            if self._flusher is None or not self._flusher.is_alive():
+                self._flusher = threading.Thread(target=self._flush_loop, name='task-flusher', daemon=True)
+                self._flusher.start()
+    
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+    
+    def flush(self):
+        """将待写回的任务状态批量写入数据库，并定期清理过期记录"""
+        with self._lock:
+            pending = list(self._pending.values())
+            self._pending.clear()
+        try:
+            self.database.save_tasks(pending)
+            if self._last_purge is None or time.monotonic() - self._last_purge > 3600:
+                self._last_purge = time.monotonic()
+                purged = self.database.purge_tasks(self.retention_days)
+                if purged:
+                    print(f"已清理过期任务: {purged} 条")
+        except Exception as e:
+            print(f"写回任务状态失败: {e}")
+            # 写入失败时放回队列，下次重试（不覆盖更新的状态）
+            with self._lock:
+                for task in pending:
+                    self._pending.setdefault(task['task_id'], task)
+
+class DerivativeQueue:
+    """新图片入库后在有界进程池中生成缩略图和尺寸信息，完成后写入数据库
+
+    缩略图的解码和缩放不在请求线程中执行，也不占用主进程的GIL。
+    进程池在第一次提交时才创建，使用spawn方式启动，避免fork带锁的线程状态；
+    工作进程只导入没有副作用的derivatives模块，不会重新初始化应用和数据库。
+    """
+    def __init__(self, database, max_workers=DERIVATIVE_WORKERS):
+        self.database = database
+        self.max_workers = max_workers
+        self._executor = None
+        self._lock = threading.Lock()
+    
+    def _get_executor(self, reset=False):
+        with self._lock:
+            if reset and self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers, mp_context=multiprocessing.get_context('spawn')
+                )
+            return self._executor
+    
+    def submit(self, user_id, image_id, category, filename):
+        """提交一张图片，返回Future，结果为 {'width', 'height', 'dhash'}"""
+        source_path = (BASE_SAVE_DIR / user_id / category / filename).resolve()
+        targets = [(size, str(path.resolve())) for size, path in
+                   zip(THUMBNAIL_SIZES, get_thumbnail_paths(user_id, category, filename))]
+        args = (str(source_path), targets, THUMBNAIL_FORMAT, THUMBNAIL_QUALITY, IMAGE_HASH_SIZE)
+        try:
+            future = self._get_executor().submit(build_derivatives, *args)
+        except BrokenProcessPool:
+            # 工作进程异常退出后进程池不可再用，重建后重试一次
+            future = self._get_executor(reset=True).submit(build_derivatives, *args)
+        future.add_done_callback(lambda done: self._record(user_id, image_id, category, filename, done))
+        return future
+    
+    def _record(self, user_id, image_id, category, filename, future):
+        try:
+            result = future.result()
+            if not self.database.record_derivatives(user_id, image_id, result['width'], result['height'], result['dhash']):
+                # 生成期间图片已被删除，清理刚写入的缩略图
+                for path in get_thumbnail_paths(user_id, category, filename):
+                    path.unlink(missing_ok=True)
+                return
+            # 加入相似图片索引，与已有图片几乎相同时标记为重复
+            duplicate_of = similarity_index.add(user_id, image_id, result['dhash'])
+            if duplicate_of:
+                self.database.mark_duplicate(user_id, image_id, duplicate_of)
+                print(f"图片 {image_id} 与 {duplicate_of} 近似重复")
+        except FileNotFoundError:
+            pass  # 原图在生成前已被删除
+        except Exception as e:
+            print(f"生成缩略图失败: {image_id}, 错误: {e}")
+    
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+class ImagePathCache:
+    """(用户ID, 文件名) -> 分类 的LRU缓存，未命中时查询images表
+
+    提供图片时据此直接拼出文件路径，不再逐个目录探测文件是否存在。
+    只缓存分类，路径在读取时由BASE_SAVE_DIR拼出。
+    """
+    def __init__(self, database, max_size=IMAGE_PATH_CACHE_SIZE):
+        self.database = database
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, user_id, filename):
+        """返回图片分类，数据库中也没有记录时返回None"""
+        key = (user_id, filename)
+        with self._lock:
+            category = self._entries.get(key)
+            if category is not None:
+                self._entries.move_to_end(key)
+                return category
+        
+        category = self.database.get_image_category(user_id, filename)
+        if category in IMAGE_CATEGORY_DIRS:
+            self.put(user_id, filename, category)
+            return category
+        return None
+    
+    def put(self, user_id, filename, category):
+        with self._lock:
+            self._entries[(user_id, filename)] = category
+            self._entries.move_to_end((user_id, filename))
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+    
+    def discard(self, user_id, filename):
+        with self._lock:
+            self._entries.pop((user_id, filename), None)
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+class BKTree:
+    """按汉明距离组织的BK树，查询时利用三角不等式跳过距离不可能足够近的子树"""
+    def __init__(self):
+        # 节点：[哈希, 该哈希对应的条目列表, {到子节点的距离: 子节点}]
+        self._root = None
+        self.size = 0
+    
+    def add(self, value, item):
+        self.size += 1
+        if self._root is None:
+            self._root = [value, [item], {}]
+            return
+        node = self._root
+        while True:
+            distance = hamming_distance(value, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, [item], {}]
+                return
+            node = child
+    
+    def search(self, value, max_distance):
+        """返回汉明距离不超过max_distance的 [(距离, 条目)]，按距离升序"""
+        results = []
+        stack = [self._root] if self._root else []
+        while stack:
+            node = stack.pop()
+            distance = hamming_distance(value, node[0])
+            if distance <= max_distance:
+                results.extend((distance, item) for item in node[1])
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        results.sort(key=lambda result: result[0])
+        return results
+
+class SimilarityIndex:
+    """每个用户一棵内存中的BK树，按感知哈希查找相似图片
+
+    首次查询时从images表构建；新图片在生成缩略图后加入，删除图片时整棵树失效并在下次查询时重建。
+    """
+    def __init__(self, database):
+        self.database = database
+        self._trees = {}
+        self._backfilled = set()
+        self._lock = threading.Lock()
+    
+    def _tree(self, user_id):
+        """返回 (BK树, 已加入的图片ID集合)，调用方需持有锁"""
+        entry = self._trees.get(user_id)
+        if entry is None:
+            tree, indexed = BKTree(), set()
+            for image_id, dhash in self.database.get_image_hashes(user_id):
+                tree.add(dhash, image_id)
+                indexed.add(image_id)
+            entry = self._trees[user_id] = (tree, indexed)
+        return entry
+    
+    def search(self, user_id, dhash, max_distance, exclude=None):
+        """返回 [(距离, image_id)]"""
+        with self._lock:
+            tree, _ = self._tree(user_id)
+            return [(distance, image_id) for distance, image_id in tree.search(dhash, max_distance)
+                    if image_id != exclude]
+    
+    def add(self, user_id, image_id, dhash, max_distance=DUPLICATE_MAX_DISTANCE):
+        """加入一张图片，返回与之最接近的已有近似重复图片ID（没有时为None）"""
+        with self._lock:
+            tree, indexed = self._tree(user_id)
+            matches = [image for _, image in tree.search(dhash, max_distance) if image != image_id]
+            if image_id not in indexed:
+                tree.add(dhash, image_id)
+                indexed.add(image_id)
+        return matches[0] if matches else None
+    
+    def invalidate(self, user_id):
+        with self._lock:
+            self._trees.pop(user_id, None)
+    
+    def backfill(self, user_id):
+        """把尚未计算感知哈希的图片交给后台生成（每个用户只执行一次），返回提交的数量"""
+        with self._lock:
+            if user_id in self._backfilled:
+                return 0
+            self._backfilled.add(user_id)
+        missing = self.database.get_images_without_hash(user_id)
+        for image_id, category, filename in missing:
+            derivative_queue.submit(user_id, image_id, category or 'clothes', filename)
+        return len(missing)
+
+file_remover = BackgroundFileRemover()
 
 # 初始化数据库
-db = ImageDatabase(DB_PATH)
+db = ImageDatabase(DB_PATH, shard_dir=BASE_SAVE_DIR if DB_SHARDED else None)
+
+image_paths = ImagePathCache(db)
+similarity_index = SimilarityIndex(db)
+
+task_registry = TaskRegistry(db)
+atexit.register(task_registry.flush)
+
+derivative_queue = DerivativeQueue(db)
+atexit.register(derivative_queue.shutdown)
+atexit.register(db.flush_last_logins)
 
 # 云端服务器通信类
 class CloudServerClient:
@@ -630,7 +2108,11 @@ class CloudServerClient:
             return None
     
     def sync_user_data(self, user_id, user_data):
-        """同步用户数据到云端，包括所有图片文件、VTON历史和收藏数据"""
+        """同步用户数据到云端，包括所有图片文件、VTON历史和收藏数据
+
+        user_data为 ImageDatabase.export_user_data() 的结果。请求体由生成器逐段产生并分块上传，
+        图片记录和文件逐条读取、编码，内存占用与图片数量无关。
+        """
         if not self.enabled:
             return {'success': True, 'message': '云端同步已禁用'}
         
@@ -643,138 +2125,12 @@ class CloudServerClient:
                 print(f"用户目录不存在: {user_dir}")
                 return {'success': False, 'error': '用户目录不存在'}
             
-            # 从user_data中获取图片列表
-            images_metadata = user_data.get('images', [])
-            print(f"从数据库获取到 {len(images_metadata)} 个图片记录")
-            
-            # 获取VTON历史数据
-            vton_history = user_data.get('vton_history', [])
-            print(f"从数据库获取到 {len(vton_history)} 个VTON历史记录")
-            
-            # 获取收藏数据
-            favorites_data = user_data.get('favorites', [])
-            print(f"从数据库获取到 {len(favorites_data)} 个收藏记录")
-            
-            # 收集所有图片文件的base64数据
-            image_files = {}
-            total_files = 0
-            total_size = 0
-            processed_files = 0
-            failed_files = 0
-            
-            for image_meta in images_metadata:
-                filename = image_meta.get('filename')
-                if not filename:
-                    print(f"跳过无文件名的图片记录: {image_meta.get('id', 'unknown')}")
-                    continue
-                
-                # 从数据库中获取分类信息，如果没有则从文件名推断
-                category = image_meta.get('category', 'clothes')
-                if not category or category == 'favorites':  # favorites不是文件夹分类
-                    if filename.startswith('char_'):
-                        category = 'char'
-                    elif filename.startswith('clothes_'):
-                        category = 'clothes'
-                    elif filename.startswith('vton_result_'):
-                        category = 'vton_results'
-                    else:
-                        category = 'clothes'  # 默认分类
-                
-                # 构造文件路径
-                category_dir = user_dir / category
-                filepath = category_dir / filename
-                
-                # 如果在推断的分类目录中找不到，尝试其他分类目录
-                if not filepath.exists():
-                    for other_category in ['char', 'clothes', 'vton_results']:
-                        if other_category != category:
-                            other_category_dir = user_dir / other_category
-                            alt_filepath = other_category_dir / filename
-                            if alt_filepath.exists():
-                                filepath = alt_filepath
-                                category = other_category
-                                print(f"在 {other_category} 目录中找到文件: {filename}")
-                                break
-                
-                # 检查文件是否存在
-                if not filepath.exists():
-                    print(f"警告: 图片文件不存在: {filepath}")
-                    failed_files += 1
-                    continue
-                
-                try:
-                    # 读取图片文件并转换为base64
-                    with open(filepath, 'rb') as f:
-                        file_content = f.read()
-                    
-                    # 转换为base64
-                    file_base64 = base64.b64encode(file_content).decode('utf-8')
-                    
-                    # 确定MIME类型
-                    file_ext = filepath.suffix.lower()
-                    mime_types = {
-                        '.png': 'image/png',
-                        '.jpg': 'image/jpeg',
-                        '.jpeg': 'image/jpeg',
-                        '.gif': 'image/gif',
-                        '.webp': 'image/webp'
-                    }
-                    mime_type = mime_types.get(file_ext, 'image/jpeg')
-                    
-                    # 构造完整的data URL
-                    image_data_url = f"data:{mime_type};base64,{file_base64}"
-                    
-                    # 只存储base64数据，使用filename作为key
-                    image_files[filename] = image_data_url
-                    
-                    total_files += 1
-                    total_size += len(file_content)
-                    processed_files += 1
-                    
-                    print(f"已处理图片: {filename} ({len(file_content)} bytes)")
-                    
-                except Exception as e:
-                    print(f"处理图片文件失败 {filepath}: {e}")
-                    failed_files += 1
-                    continue
-            
-            print(f"图片处理完成: 成功 {processed_files} 个，失败 {failed_files} 个，总大小: {total_size / 1024 / 1024:.2f} MB")
-            
-            # 收集分类统计信息
-            categories_stats = {}
-            for img in images_metadata:
-                if img.get('filename'):
-                    cat = img.get('category', 'clothes')
-                    if cat == 'favorites':  # favorites不计入文件分类统计
-                        continue
-                    categories_stats[cat] = categories_stats.get(cat, 0) + 1
-            
-            # 构造完整的同步数据
-            sync_payload = {
-                'user_info': user_data.get('user_info', {}),
-                'images_metadata': images_metadata,
-                'image_files': image_files,
-                'vton_history': vton_history,
-                'favorites_data': favorites_data,
-                'sync_timestamp': datetime.datetime.now().isoformat(),
-                'sync_statistics': {
-                    'total_metadata_records': len(images_metadata),
-                    'total_files_found': processed_files,
-                    'total_files_missing': failed_files,
-                    'total_size': total_size,
-                    'categories': list(categories_stats.keys()),
-                    'categories_stats': categories_stats,
-                    'vton_history_count': len(vton_history),
-                    'favorites_count': len(favorites_data)
-                }
-            }
-            
             print(f"开始上传到云端服务器: {self.server_url}/sync/user/{user_id}")
             
             # 由于数据可能很大，增加超时时间
             response = self.session.post(
                 f"{self.server_url}/sync/user/{user_id}", 
-                json=sync_payload, 
+                data=self.iter_sync_payload(user_dir, user_data), 
                 timeout=300,  # 5分钟超时
                 headers={'Content-Type': 'application/json'}
             )
@@ -802,6 +2158,113 @@ class CloudServerClient:
             import traceback
             traceback.print_exc()
             return {'success': False, 'error': f'同步过程中发生错误: {str(e)}'}
+    
+    def iter_sync_payload(self, user_dir, user_data):
+        """逐段生成同步请求体（UTF-8编码的JSON），字段与云端接口要求的sync_payload一致
+
+        images_metadata和image_files分两次遍历图片记录，sync_statistics在最后生成。
+        """
+        stats = {'metadata': 0, 'processed': 0, 'failed': 0, 'size': 0, 'vton_history': 0, 'favorites': 0}
+        categories_stats = {}
+        
+        def dumps(value):
+            return json.dumps(value).encode('utf-8')
+        
+        def json_array(items, counter):
+            yield b'['
+            for index, item in enumerate(items):
+                stats[counter] += 1
+                yield (b', ' if index else b'') + dumps(item)
+            yield b']'
+        
+        def images_metadata():
+            for image in user_data.images():
+                if image['filename']:
+                    cat = image['category'] or 'clothes'
+                    if cat != 'favorites':  # favorites不计入文件分类统计
+                        categories_stats[cat] = categories_stats.get(cat, 0) + 1
+                yield image.to_dict()
+        
+        yield b'{"user_info": ' + dumps(user_data.user_info or {})
+        yield b', "images_metadata": '
+        yield from json_array(images_metadata(), 'metadata')
+        print(f"已发送 {stats['metadata']} 个图片记录")
+        
+        # 图片文件逐个读取并转换为data URL，使用filename作为key
+        yield b', "image_files": {'
+        for image_meta in user_data.images():
+            image_file = self.read_image_file(user_dir, image_meta)
+            if image_file is None:
+                stats['failed'] += 1
+                continue
+            image_data_url, file_size = image_file
+            yield (b', ' if stats['processed'] else b'') + dumps(image_meta['filename']) + b': ' + dumps(image_data_url)
+            stats['processed'] += 1
+            stats['size'] += file_size
+        yield b'}'
+        print(f"图片处理完成: 成功 {stats['processed']} 个，失败 {stats['failed']} 个，总大小: {stats['size'] / 1024 / 1024:.2f} MB")
+        
+        yield b', "vton_history": '
+        yield from json_array(user_data.vton_history(), 'vton_history')
+        yield b', "favorites_data": '
+        yield from json_array((favorite.to_dict() for favorite in user_data.favorites()), 'favorites')
+        print(f"已发送 {stats['vton_history']} 个VTON历史记录, {stats['favorites']} 个收藏记录")
+        
+        yield b', "sync_timestamp": ' + dumps(datetime.datetime.now().isoformat())
+        yield b', "sync_statistics": ' + dumps({
+            'total_metadata_records': stats['metadata'],
+            'total_files_found': stats['processed'],
+            'total_files_missing': stats['failed'],
+            'total_size': stats['size'],
+            'categories': list(categories_stats.keys()),
+            'categories_stats': categories_stats,
+            'vton_history_count': stats['vton_history'],
+            'favorites_count': stats['favorites']
+        }) + b'}'
+    
+    def read_image_file(self, user_dir, image_meta):
+        """读取图片文件并转换为data URL，返回 (data_url, 文件大小)，文件不存在或读取失败时返回None"""
+        filename = image_meta.get('filename')
+        if not filename:
+            print(f"跳过无文件名的图片记录: {image_meta.get('id', 'unknown')}")
+            return None
+        
+        # 分类来自数据库记录，文件就在对应的分类目录下
+        category = image_meta.get('category')
+        if category not in IMAGE_CATEGORY_DIRS:
+            print(f"跳过分类无效的图片记录: {image_meta.get('id', 'unknown')} ({category})")
+            return None
+        filepath = user_dir / category / filename
+        
+        try:
+            # 读取图片文件并转换为base64
+            with open(filepath, 'rb') as f:
+                file_content = f.read()
+            
+            # 转换为base64
+            file_base64 = base64.b64encode(file_content).decode('utf-8')
+            
+            # 确定MIME类型
+            file_ext = filepath.suffix.lower()
+            mime_types = {
+                '.png': 'image/png',
+                '.jpg': 'image/jpeg',
+                '.jpeg': 'image/jpeg',
+                '.gif': 'image/gif',
+                '.webp': 'image/webp'
+            }
+            mime_type = mime_types.get(file_ext, 'image/jpeg')
+            
+            print(f"已处理图片: {filename} ({len(file_content)} bytes)")
+            # 构造完整的data URL
+            return f"data:{mime_type};base64,{file_base64}", len(file_content)
+            
+        except FileNotFoundError:
+            print(f"警告: 图片文件不存在: {filepath}")
+            return None
+        except Exception as e:
+            print(f"处理图片文件失败 {filepath}: {e}")
+            return None
 
 cloud_client = CloudServerClient(CLOUD_SERVER_URL, ENABLE_CLOUD_SYNC)
 
@@ -849,20 +2312,6 @@ def image_to_base64(image_path):
         print(f"图片转base64失败 {image_path}: {e}")
         return None
 
-def base64_to_image(base64_str, output_path):
-    """将base64字符串保存为图片文件"""
-    try:
-        if base64_str.startswith('data:image'):
-            base64_str = base64_str.split(',')[1]
-        
-        img_data = base64.b64decode(base64_str)
-        with open(output_path, 'wb') as f:
-            f.write(img_data)
-        return True
-    except Exception as e:
-        print(f"base64转图片失败 {output_path}: {e}")
-        return False
-
 def call_vton_api(human_image_path, garment_image_path, garment_description="a shirt", 
                   auto_mask=True, auto_crop=False, denoise_steps=25, seed=42):
     """使用gradio_client调用IDM-VTON虚拟试穿API"""
@@ -957,49 +2406,337 @@ def call_vton_api(human_image_path, garment_image_path, garment_description="a s
         else:
             return {"success": False, "error": f"虚拟试穿失败: {error_msg}"}
 
+# 已确认存在的分类目录，避免每次调用都执行mkdir
+_known_save_dirs = set()
+
 def get_user_save_dir(user_id, category='clothes'):
     """获取用户专属保存目录，支持分类"""
+    category_dir = BASE_SAVE_DIR / user_id / category
+    if category_dir in _known_save_dirs:
+        return category_dir
+    
     user_dir = BASE_SAVE_DIR / user_id
     user_dir.mkdir(exist_ok=True)
     
-    # 创建分类子目录
-    category_dir = user_dir / category
-    category_dir.mkdir(exist_ok=True)
+    # 创建分类子目录
+    category_dir.mkdir(exist_ok=True)
+    _known_save_dirs.add(category_dir)
+    
+    return category_dir
+
+def get_blob_path(user_id, content_hash):
+    """内容寻址存储中的文件路径：saved_images/<user_id>/blobs/<哈希前两位>/<sha256>"""
+    return BASE_SAVE_DIR / user_id / BLOB_DIR_NAME / content_hash[:2] / content_hash
+
+def link_blob(blob_path, filepath):
+    """在分类目录中创建指向blob的硬链接，文件系统不支持硬链接时退回复制"""
+    try:
+        os.link(blob_path, filepath)
+    except (FileExistsError, FileNotFoundError):
+        raise
+    except OSError:
+        shutil.copyfile(blob_path, filepath)
+
+class StagedImage:
+    """写入暂存目录临时文件的图片内容，写入时同步计算SHA-256并检查大小
+
+    保存时由 store_blob 直接重命名为blob文件；未被保存时close()会删除临时文件。
+    """
+    def __init__(self, max_size=MAX_UPLOAD_SIZE):
+        staging_dir = BASE_SAVE_DIR / UPLOAD_STAGING_DIR_NAME
+        staging_dir.mkdir(parents=True, exist_ok=True)
+        self._file = tempfile.NamedTemporaryFile(dir=staging_dir, suffix='.tmp', delete=False)
+        self.path = Path(self._file.name)
+        self.max_size = max_size
+        self.size = 0
+        self._digest = hashlib.sha256()
+    
+    @classmethod
+    def from_stream(cls, stream, max_size=MAX_UPLOAD_SIZE):
+        """分块读取流并暂存，超过大小上限时抛出RequestEntityTooLarge"""
+        staged = cls(max_size)
+        try:
+            for block in iter(lambda: stream.read(FILE_BLOCK_SIZE), b''):
+                staged.write(block)
+        except Exception:
+            staged.close()
+            raise
+        return staged
+    
+    def write(self, data):
+        self.size += len(data)
+        if self.max_size is not None and self.size > self.max_size:
+            self.close()
+            raise RequestEntityTooLarge(f'文件大小不能超过{self.max_size // 1024 // 1024}MB')
+        self._digest.update(data)
+        return self._file.write(data)
+    
+    def hexdigest(self):
+        return self._digest.hexdigest()
+    
+    def header(self, size=16):
+        """文件开头的字节，用于识别图片格式"""
+        self._file.flush()
+        with open(self.path, 'rb') as f:
+            return f.read(size)
+    
+    def seek(self, *args):
+        return self._file.seek(*args)
+    
+    def tell(self):
+        return self._file.tell()
+    
+    def read(self, *args):
+        return self._file.read(*args)
     
-    return category_dir
+    def flush(self):
+        self._file.flush()
+    
+    def close(self):
+        """关闭并删除尚未保存的临时文件"""
+        self._file.close()
+        self.path.unlink(missing_ok=True)
 
-def get_or_create_default_user():
-    """获取或创建默认用户，用于未登录用户"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+class ImageUploadRequest(Request):
+    """multipart上传的文件直接写入暂存目录并同步计算哈希，不经过内存缓冲和额外复制"""
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return StagedImage(MAX_UPLOAD_SIZE)
+
+app.request_class = ImageUploadRequest
+
+# 图片文件头 -> 扩展名
+IMAGE_SIGNATURES = (
+    (b'\x89PNG', 'png'),
+    (b'\xff\xd8\xff', 'jpg'),
+    (b'GIF8', 'gif'),
+)
+
+def detect_image_ext(header):
+    """根据文件头识别图片格式，无法识别时返回None"""
+    for signature, ext in IMAGE_SIGNATURES:
+        if header.startswith(signature):
+            return ext
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+def store_blob(user_id, content, filepath):
+    """把图片内容存入内容寻址存储，并在filepath处创建链接，返回 (sha256, 是否写入了新文件)
+
+    content为bytes或StagedImage。相同内容已存在时跳过写盘，只创建硬链接；
+    StagedImage的临时文件直接重命名为blob，不再复制。
+    """
+    staged = isinstance(content, StagedImage)
+    content_hash = content.hexdigest() if staged else hashlib.sha256(content).hexdigest()
+    blob_path = get_blob_path(user_id, content_hash)
+    try:
+        link_blob(blob_path, filepath)
+        if staged:
+            content.close()
+        return content_hash, False
+    except FileNotFoundError:
+        pass
+    
+    # 先写临时文件再替换，并发写入同一内容时结果一致
+    blob_path.parent.mkdir(parents=True, exist_ok=True)
+    if staged:
+        content.flush()
+        os.replace(content.path, blob_path)
+        content.close()
+    else:
+        temp_path = blob_path.with_name(f'{content_hash}.{uuid.uuid4().hex}.tmp')
+        with open(temp_path, 'wb') as f:
+            f.write(content)
+        os.replace(temp_path, blob_path)
+    link_blob(blob_path, filepath)
+    return content_hash, True
+
+def adopt_blob(user_id, filepath):
+    """把分类目录中已有的图片文件纳入内容寻址存储，返回 (sha256, 因去重释放的字节数)
+
+    blob不存在时把原文件硬链接为blob；已存在时用指向blob的硬链接替换原文件。
+    """
+    content_hash = hash_file(filepath)
+    blob_path = get_blob_path(user_id, content_hash)
+    if not blob_path.exists():
+        blob_path.parent.mkdir(parents=True, exist_ok=True)
+        link_blob(filepath, blob_path)
+        return content_hash, 0
+    if os.path.samefile(blob_path, filepath):
+        return content_hash, 0
     
-    # 查找默认用户
-    cursor.execute("SELECT user_id FROM users WHERE username = 'default_user' LIMIT 1")
-    result = cursor.fetchone()
+    # 内容重复：先链接到临时文件再替换，过程中原文件始终可读
+    temp_path = filepath.with_name(f'{filepath.name}.{uuid.uuid4().hex}.tmp')
+    link_blob(blob_path, temp_path)
+    size = filepath.stat().st_size
+    os.replace(temp_path, filepath)
+    return content_hash, size
+
+def hash_file(path):
+    """分块计算文件的SHA-256"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(FILE_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def get_thumbnail_path(user_id, category, filename, size):
+    """缩略图缓存路径：与分类目录同级的 thumbnails/<category>/<size>/ 下"""
+    return BASE_SAVE_DIR / user_id / 'thumbnails' / category / str(size) / (Path(filename).stem + THUMBNAIL_EXTENSION)
+
+def get_thumbnail_paths(user_id, category, filename):
+    """图片所有尺寸的缩略图路径"""
+    return [get_thumbnail_path(user_id, category, filename, size) for size in THUMBNAIL_SIZES]
+
+def get_or_create_thumbnail(source_path, thumbnail_path, size):
+    """返回缩略图路径，缓存不存在或比原图旧时重新生成；无法生成时返回None"""
+    try:
+        if thumbnail_path.stat().st_mtime >= source_path.stat().st_mtime:
+            return thumbnail_path
+    except FileNotFoundError:
+        pass
     
-    if result:
-        conn.close()
-        return result[0]
+    try:
+        render_thumbnails(source_path, [(size, thumbnail_path)], THUMBNAIL_FORMAT, THUMBNAIL_QUALITY, IMAGE_HASH_SIZE)
+        return thumbnail_path
+    except Exception as e:
+        print(f"生成缩略图失败: {source_path}, 错误: {e}")
+        return None
+
+def image_dhash(source_path):
+    """计算图片文件的感知哈希"""
+    from PIL import Image, ImageOps
     
-    # 创建默认用户
-    default_user_id = "default-user-" + str(uuid.uuid4())[:8]
-    cursor.execute('''
-        INSERT INTO users (user_id, username, email, password_hash, is_active)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (default_user_id, 'default_user', 'default@local.app', 'default_hash', 1))
+    with Image.open(source_path) as img:
+        img.seek(0)
+        img.draft('RGB', (THUMBNAIL_SIZES[0], THUMBNAIL_SIZES[0]))  # JPEG解码时直接缩小
+        return compute_dhash(ImageOps.exif_transpose(img), IMAGE_HASH_SIZE)
+
+def hamming_distance(a, b):
+    """两个十六进制哈希之间的汉明距离"""
+    return bin(int(a, 16) ^ int(b, 16)).count('1')
+
+def find_user_image(user_id, filename):
+    """查找用户图片文件，返回 (分类, 文件路径)，找不到时返回 (None, None)
+
+    分类来自images表（经LRU缓存），不访问文件系统；文件是否存在由调用方打开时判断。
+    只有尚未整理入库的文件才回退到逐个分类目录查找。
+    """
+    category = image_paths.get(user_id, filename)
+    if category:
+        return category, BASE_SAVE_DIR / user_id / category / filename
     
-    conn.commit()
-    conn.close()
+    for category in IMAGE_CATEGORY_DIRS:
+        filepath = BASE_SAVE_DIR / user_id / category / filename
+        if filepath.is_file():
+            return category, filepath
+    return None, None
+
+# SendfileRequestHandler 把客户端socket放在environ的这个键下
+SENDFILE_SOCKET_KEY = 'local_client.socket'
+
+class FileRangeWrapper:
+    """WSGI响应体：发送文件中从offset开始的length个字节
+
+    运行在 SendfileRequestHandler 下时用 socket.sendfile（os.sendfile）直接从文件写入socket，
+    数据不经过Python；其他WSGI服务器上按块读取。
+    """
+    def __init__(self, file, offset, length, sock=None, block_size=FILE_BLOCK_SIZE):
+        self.file = file
+        self.offset = offset
+        self.length = length
+        self.sock = sock
+        self.block_size = block_size
     
-    # 创建默认用户目录
-    default_dir = BASE_SAVE_DIR / default_user_id
-    default_dir.mkdir(exist_ok=True)
-    (default_dir / "clothes").mkdir(exist_ok=True)
+    def __iter__(self):
+        if self.sock is not None:
+            yield b''  # 先让服务器发出响应头，再直接向socket写文件内容
+            self.sock.sendfile(self.file, self.offset, self.length)
+            return
+        
+        self.file.seek(self.offset)
+        remaining = self.length
+        while remaining > 0:
+            data = self.file.read(min(self.block_size, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
     
-    return default_user_id
+    def close(self):
+        self.file.close()
+
+class SendfileRequestHandler(WSGIRequestHandler):
+    """开发服务器的请求处理器，向environ提供客户端socket，使图片文件可以零拷贝发送"""
+    def make_environ(self):
+        environ = super().make_environ()
+        environ[SENDFILE_SOCKET_KEY] = self.connection
+        return environ
 
-def save_image_from_data(image_data, original_url, page_info, user_id, category='clothes'):
-    """保存图片数据到用户目录的指定分类文件夹"""
+def send_image_file(filepath):
+    """发送图片文件，支持条件请求（304）和Range请求（206），并允许浏览器长期缓存
+
+    文件不存在时抛出FileNotFoundError。
+    图片属于用户私有数据，只允许浏览器缓存，不允许共享代理缓存。
+    """
+    file = open(filepath, 'rb')
+    try:
+        stat = os.fstat(file.fileno())
+        size = stat.st_size
+        
+        response = app.response_class(
+            mimetype=mimetypes.guess_type(str(filepath))[0] or 'application/octet-stream',
+            direct_passthrough=True
+        )
+        response.set_etag(f'{stat.st_mtime_ns:x}-{size:x}')
+        response.last_modified = int(stat.st_mtime)
+        response.cache_control.max_age = IMAGE_CACHE_MAX_AGE
+        response.cache_control.private = True
+        response.cache_control.immutable = True
+        response.accept_ranges = 'bytes'
+        
+        # If-None-Match / If-Modified-Since 命中时变为304
+        response.make_conditional(request.environ)
+        if response.status_code == 304:
+            file.close()
+            return response
+        
+        start, length = 0, size
+        # If-Range与当前文件不符时忽略Range，返回完整文件
+        if request.range and size and (
+            'HTTP_IF_RANGE' not in request.environ
+            or not is_resource_modified(request.environ, response.get_etag()[0], None,
+                                        response.last_modified, ignore_if_range=False)
+        ):
+            byte_range = request.range.range_for_length(size)
+            if byte_range is None:
+                file.close()
+                response = app.response_class(status=416)
+                response.content_range = f'bytes */{size}'
+                return response
+            start, end = byte_range
+            length = end - start
+            response.status_code = 206
+            response.content_range = request.range.to_content_range_header(size)
+        
+        response.content_length = length
+        response.response = FileRangeWrapper(file, start, length, request.environ.get(SENDFILE_SOCKET_KEY))
+        return response
+    except Exception:
+        file.close()
+        raise
+
+def get_or_create_default_user():
+    """获取或创建默认用户，用于未登录用户（首次解析后直接返回缓存的ID）"""
+    return db.get_default_user_id()
+
+def save_image_from_data(image_data, original_url, page_info, user_id, category='clothes', ext=None):
+    """保存图片数据到用户目录的指定分类文件夹
+
+    image_data可以是data URL、图片URL、原始bytes、可读的文件流或StagedImage；
+    后三种不经过base64，ext为空时根据文件头识别格式。
+    """
+    image_bytes = None
     try:
         print(f"开始保存图片: 用户ID={user_id}, 分类={category}")
         
@@ -1008,8 +2745,17 @@ def save_image_from_data(image_data, original_url, page_info, user_id, category=
         
         print(f"保存目录: {user_save_dir}")
         
+        if isinstance(image_data, (bytes, bytearray, memoryview)):
+            image_bytes = bytes(image_data)
+            ext = ext or detect_image_ext(image_bytes[:16]) or 'png'
+            print(f"图片格式: {ext}, 数据大小: {len(image_bytes)} bytes")
+        elif not isinstance(image_data, str):
+            # 文件流先分块写入暂存文件（同时计算哈希），保存时直接重命名
+            image_bytes = image_data if isinstance(image_data, StagedImage) else StagedImage.from_stream(image_data)
+            ext = ext or detect_image_ext(image_bytes.header()) or 'png'
+            print(f"图片格式: {ext}, 数据大小: {image_bytes.size} bytes")
         # 处理base64图片数据
-        if image_data.startswith('data:image'):
+        elif image_data.startswith('data:image'):
             header, data = image_data.split(',', 1)
             image_bytes = base64.b64decode(data)
             # 从header中获取图片格式
@@ -1054,11 +2800,10 @@ def save_image_from_data(image_data, original_url, page_info, user_id, category=
         
         print(f"生成文件名: {filename}")
         
-        # 保存文件
-        with open(filepath, 'wb') as f:
-            f.write(image_bytes)
+        # 保存文件：内容已存在时只创建硬链接，不重复写盘
+        content_hash, written = store_blob(user_id, image_bytes, filepath)
         
-        print(f"文件保存成功: {filepath}")
+        print(f"文件保存成功: {filepath}" if written else f"内容已存在，复用已保存的文件: {filepath}")
         
         # 获取图片尺寸
         try:
@@ -1071,7 +2816,7 @@ def save_image_from_data(image_data, original_url, page_info, user_id, category=
             width, height = 0, 0
         
         # 保存到数据库，添加分类信息
-        file_size = len(image_bytes)
+        file_size = image_bytes.size if isinstance(image_bytes, StagedImage) else len(image_bytes)
         context_info = page_info.get('imageContext', {}) if page_info else {}
         context_info['category'] = category  # 添加分类信息
         
@@ -1079,7 +2824,7 @@ def save_image_from_data(image_data, original_url, page_info, user_id, category=
         
         db.save_image_record(
             image_id, user_id, filename, original_url, page_info or {}, 
-            file_size, width, height, context_info, category
+            file_size, width, height, context_info, category, content_hash
         )
         
         result = {
@@ -1088,7 +2833,9 @@ def save_image_from_data(image_data, original_url, page_info, user_id, category=
             'filepath': str(filepath),
             'file_size': file_size,
             'dimensions': (width, height),
-            'category': category
+            'category': category,
+            # 缩略图在后台进程池中生成，调用方可用 task_registry.track 跟踪进度
+            'derivatives': derivative_queue.submit(user_id, image_id, category, filename)
         }
         
         print(f"保存完成: {result}")
@@ -1098,8 +2845,15 @@ def save_image_from_data(image_data, original_url, page_info, user_id, category=
         print(f"保存图片失败: {e}")
         import traceback
         traceback.print_exc()
+        if isinstance(image_bytes, StagedImage):
+            image_bytes.close()
         return None
 
+@app.errorhandler(RequestEntityTooLarge)
+def request_entity_too_large(e):
+    """请求体超过MAX_CONTENT_LENGTH或上传文件超过MAX_UPLOAD_SIZE"""
+    return jsonify({'success': False, 'error': f'请求数据过大，不能超过{MAX_REQUEST_SIZE // 1024 // 1024}MB'}), 413
+
 # API路由
 @app.route('/api/status', methods=['GET'])
 def get_status():
@@ -1138,16 +2892,8 @@ def receive_image():
         result = save_image_from_data(image_data, original_url, page_info, user_id, category)
         
         if result:
-            # 创建任务
-            task_id = str(uuid.uuid4())
-            db.create_task(task_id, user_id, result['image_id'])
-            
-            # 模拟异步处理
-            def process_task():
-                db.update_task_status(task_id, 'completed')
-            
-            thread = threading.Thread(target=process_task)
-            thread.start()
+            # 登记任务（图片已同步保存，任务直接完成，缩略图进度单独记录）
+            task_id = task_registry.track(user_id, result['image_id'], result['derivatives'])
             
             response_data = {
                 'success': True,
@@ -1170,10 +2916,104 @@ def receive_image():
         print(f"处理请求失败: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+def read_json_header(name, default=None):
+    """读取URL编码的JSON请求头（请求头只能是latin-1，中文标题等需要先encodeURIComponent）"""
+    value = request.headers.get(name)
+    if not value:
+        return default
+    return json.loads(unquote(value))
+
+@app.route('/api/receive-image/binary', methods=['POST'])
+def receive_image_binary():
+    """接收插件或剪切板发送的原始图片字节（支持未登录用户）
+
+    请求体就是图片文件本身，元数据放在请求头中：X-Image-Category、X-Image-Source、
+    X-Original-Url（URL编码）、X-Page-Info（URL编码的JSON）。请求体边读边写入暂存文件，
+    不经过base64和JSON解析，与receive-image使用同一保存流程。
+    Content-Type必须是image/*或application/octet-stream：这两种类型的跨域请求需要预检，
+    其他网页不能像text/plain那样直接提交图片。
+    """
+    mimetype = request.mimetype
+    if not (mimetype.startswith('image/') or mimetype == 'application/octet-stream'):
+        return jsonify({'success': False, 'error': 'Content-Type必须是image/*或application/octet-stream'}), 415
+    
+    staged = None
+    try:
+        user_id = session.get('user_id')
+        if not user_id:
+            user_id = get_or_create_default_user()
+            print(f"未登录用户，使用默认用户ID: {user_id}")
+        
+        try:
+            page_info = read_json_header('X-Page-Info', {})
+        except ValueError:
+            return jsonify({'success': False, 'error': 'X-Page-Info不是有效的JSON'}), 400
+        original_url = unquote(request.headers.get('X-Original-Url', ''))
+        source = request.headers.get('X-Image-Source', 'browser-extension')
+        category = request.headers.get('X-Image-Category', 'clothes')
+        
+        # 验证分类参数
+        if category not in ['clothes', 'char']:
+            category = 'clothes'
+        
+        # 超过MAX_UPLOAD_SIZE时抛出RequestEntityTooLarge，由错误处理器返回413
+        staged = StagedImage.from_stream(request.stream, MAX_UPLOAD_SIZE)
+        if staged.size == 0:
+            return jsonify({'success': False, 'error': '缺少图片数据'}), 400
+        
+        # 以文件头为准识别格式，不信任Content-Type
+        ext = detect_image_ext(staged.header())
+        if not ext:
+            return jsonify({'success': False, 'error': '不支持的图片格式，请上传 PNG、JPG、GIF 或 WebP 格式的图片'}), 400
+        
+        if source == 'clipboard':
+            original_url = original_url or 'clipboard'
+            page_info = {
+                'url': 'clipboard',
+                'title': f'剪切板图片 - {category}',
+                'source': 'clipboard'
+            }
+        
+        # 暂存文件直接重命名到内容寻址存储
+        result = save_image_from_data(staged, original_url or None, page_info, user_id, category, ext=ext)
+        
+        if result:
+            # 登记任务（图片已同步保存，任务直接完成，缩略图进度单独记录）
+            task_id = task_registry.track(user_id, result['image_id'], result['derivatives'])
+            
+            response_data = {
+                'success': True,
+                'taskId': task_id,
+                'imageId': result['image_id'],
+                'filename': result['filename'],
+                'fileSize': result['file_size'],
+                'category': result['category'],
+                'isLoggedIn': 'user_id' in session
+            }
+            
+            if 'user_id' not in session:
+                response_data['message'] = f'图片已保存到默认目录的{category}文件夹，建议登录以便管理您的图片'
+            
+            return jsonify(response_data)
+        else:
+            return jsonify({'success': False, 'error': '保存图片失败'}), 500
+    
+    except RequestEntityTooLarge:
+        raise
+    except Exception as e:
+        print(f"处理二进制图片请求失败: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+    finally:
+        # 已保存的暂存文件已被重命名，这里只会删除未保存的
+        if staged is not None:
+            staged.close()
+
 @app.route('/api/task/<task_id>', methods=['GET'])
 def get_task_status(task_id):
     """获取任务状态"""
-    task = db.get_task_status(task_id)
+    # 任务属于提交图片的用户：已登录用户或默认用户
+    user_id = session.get('user_id') or get_or_create_default_user()
+    task = task_registry.get(task_id, user_id)
     if task:
         return jsonify({'status': task})
     else:
@@ -1186,8 +3026,18 @@ def get_images():
     per_page = int(request.args.get('per_page', 20))
     offset = (page - 1) * per_page
     
-    images = db.get_all_images(per_page, offset)
-    total = db.get_image_count()
+    # 传入cursor时使用游标分页，忽略page
+    try:
+        page_cursor = decode_cursor(request.args['cursor']) if request.args.get('cursor') else None
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    
+    try:
+        images = db.get_all_images(per_page + 1, offset, cursor=page_cursor)
+        total = db.get_image_count()
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+    images, next_cursor = paginate_keyset(images, per_page, lambda image: (image['saved_at'], image['id']))
     
     # 为每个图片添加预览URL
     for image in images:
@@ -1199,7 +3049,8 @@ def get_images():
         'total': total,
         'page': page,
         'per_page': per_page,
-        'pages': (total + per_page - 1) // per_page
+        'pages': (total + per_page - 1) // per_page,
+        'next_cursor': next_cursor
     })
 
 @app.route('/api/user/images', methods=['GET'])
@@ -1212,8 +3063,23 @@ def get_user_images():
     category = request.args.get('category')  # 支持分类过滤
     offset = (page - 1) * per_page
     
-    images = db.get_user_images(user_id, category, per_page, offset)
-    total = db.get_user_image_count(user_id, category)
+    # 传入cursor时使用游标分页，忽略page
+    try:
+        page_cursor = decode_cursor(request.args['cursor']) if request.args.get('cursor') else None
+        filters = parse_image_filters(request.args)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    
+    try:
+        images = db.get_user_images(user_id, category, per_page + 1, offset, cursor=page_cursor, filters=filters)
+        # 只按分类过滤时直接读取计数表
+        if filters:
+            total = db.get_filtered_image_count(user_id, category, filters)
+        else:
+            total = db.get_user_image_count(user_id, category)
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+    images, next_cursor = paginate_keyset(images, per_page, lambda image: (image['saved_at'], image['id']))
     
     # 为每个图片添加预览URL
     for image in images:
@@ -1226,7 +3092,110 @@ def get_user_images():
         'page': page,
         'per_page': per_page,
         'pages': (total + per_page - 1) // per_page,
-        'category': category
+        'category': category,
+        'filters': filters,
+        'next_cursor': next_cursor
+    })
+
+@app.route('/api/user/images/facets', methods=['GET'])
+@login_required
+def get_user_image_facets():
+    """按来源域名统计用户图片数量，支持与图片列表相同的筛选参数"""
+    user_id = session['user_id']
+    category = request.args.get('category')
+    
+    try:
+        filters = parse_image_filters(request.args)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    
+    return jsonify({
+        'success': True,
+        'category': category,
+        'facets': {
+            'domain': db.get_user_domain_facets(user_id, category, filters)
+        }
+    })
+
+@app.route('/api/user/images/search', methods=['GET'])
+@login_required
+def search_user_images():
+    """按页面标题、URL和图片上下文全文检索用户图片"""
+    user_id = session['user_id']
+    query = request.args.get('q', '')
+    page = int(request.args.get('page', 1))
+    per_page = int(request.args.get('per_page', 20))
+    category = request.args.get('category')
+    offset = (page - 1) * per_page
+    
+    try:
+        search_query = build_search_query(query)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    
+    images = db.search_user_images(user_id, search_query, category, per_page, offset)
+    total = db.get_search_count(user_id, search_query, category)
+    
+    for image in images:
+        image['preview_url'] = url_for('serve_user_image', user_id=user_id, filename=image['filename'])
+        image['thumbnail_url'] = url_for('serve_user_thumbnail', user_id=user_id, filename=image['filename'])
+    
+    return jsonify({
+        'success': True,
+        'images': images,
+        'total': total,
+        'page': page,
+        'per_page': per_page,
+        'pages': (total + per_page - 1) // per_page,
+        'category': category,
+        'query': query
+    })
+
+@app.route('/api/user/images/<image_id>/similar', methods=['GET'])
+@login_required
+def get_similar_images(image_id):
+    """按感知哈希查找与指定图片相似的图片（不同尺寸、轻微裁剪的同一件服装等）"""
+    user_id = session['user_id']
+    try:
+        max_distance = int(request.args.get('max_distance', SIMILAR_MAX_DISTANCE))
+        limit = int(request.args.get('limit', 20))
+    except ValueError:
+        return jsonify({'success': False, 'error': '无效的参数'}), 400
+    if not 0 <= max_distance <= IMAGE_HASH_SIZE * IMAGE_HASH_SIZE or limit < 1:
+        return jsonify({'success': False, 'error': '无效的参数'}), 400
+    
+    image = db.get_image_by_id(image_id, user_id)
+    if not image:
+        return jsonify({'success': False, 'error': '图片不存在'}), 404
+    
+    dhash = db.get_image_dhash(user_id, image_id)
+    if dhash is None:
+        # 缩略图尚未生成（刚入库或升级前保存的图片），直接计算
+        try:
+            dhash = image_dhash(BASE_SAVE_DIR / user_id / image['category'] / image['filename'])
+        except Exception as e:
+            return jsonify({'success': False, 'error': f'无法读取图片: {e}'}), 500
+    # 升级前保存的图片在后台补算哈希，完成后陆续出现在结果中
+    similarity_index.backfill(user_id)
+    
+    matches = similarity_index.search(user_id, dhash, max_distance, exclude=image_id)[:limit]
+    records = db.get_images_by_ids(user_id, [match_id for _, match_id in matches])
+    images = []
+    for distance, match_id in matches:
+        record = records.get(match_id)
+        if record is None:
+            continue
+        record['distance'] = distance
+        record['preview_url'] = url_for('serve_user_image', user_id=user_id, filename=record['filename'])
+        record['thumbnail_url'] = url_for('serve_user_thumbnail', user_id=user_id, filename=record['filename'])
+        images.append(record)
+    
+    return jsonify({
+        'success': True,
+        'image_id': image_id,
+        'dhash': dhash,
+        'max_distance': max_distance,
+        'images': images
     })
 
 @app.route('/api/user/<user_id>/images/<filename>')
@@ -1236,31 +3205,7 @@ def serve_user_image(user_id, filename):
     if 'user_id' in session and session['user_id'] != user_id:
         return jsonify({'error': '权限不足'}), 403
     
-    # 从文件名推断分类
-    category = 'clothes'  # 默认分类
-    if filename.startswith('char_'):
-        category = 'char'
-    elif filename.startswith('clothes_'):
-        category = 'clothes'
-    elif filename.startswith('vton_result_'):
-        category = 'vton_results'
-    
-    user_save_dir = get_user_save_dir(user_id, category)
-    filepath = user_save_dir / filename
-    
-    # 如果在默认分类中找不到，尝试在其他分类中查找
-    if not filepath.exists():
-        for other_category in ['char', 'clothes', 'vton_results']:
-            if other_category != category:
-                user_save_dir = get_user_save_dir(user_id, other_category)
-                filepath = user_save_dir / filename
-                if filepath.exists():
-                    break
-    
-    if filepath.exists():
-        return send_file(filepath)
-    else:
-        return "图片不存在", 404
+    return send_found_image(user_id, filename)
 
 @app.route('/api/images/<filename>')
 def serve_image(filename):
@@ -1268,28 +3213,52 @@ def serve_image(filename):
     # 这个函数主要是为了兼容性，实际应该使用用户专属的图片服务
     # 尝试在默认用户目录中查找
     default_user_id = get_or_create_default_user()
+    return send_found_image(default_user_id, filename)
+
+def send_found_image(user_id, filename):
+    """按文件名定位并发送用户图片，找不到时返回404"""
+    category, filepath = find_user_image(user_id, filename)
+    if filepath:
+        try:
+            return send_image_file(filepath)
+        except FileNotFoundError:
+            image_paths.discard(user_id, filename)  # 记录还在但文件已被删除
+    return "图片不存在", 404
+
+def send_user_thumbnail(user_id, filename):
+    """按请求的size参数返回缩略图，首次请求时生成并缓存"""
+    try:
+        size = int(request.args.get('size', DEFAULT_THUMBNAIL_SIZE))
+    except ValueError:
+        return jsonify({'error': '无效的缩略图尺寸'}), 400
+    # 取不小于请求尺寸的最小可用尺寸
+    size = next((s for s in THUMBNAIL_SIZES if s >= size), THUMBNAIL_SIZES[-1])
     
-    # 从文件名推断分类
-    category = 'clothes' if filename.startswith('clothes_') else 'char' if filename.startswith('char_') else 'clothes'
-    
-    user_save_dir = get_user_save_dir(default_user_id, category)
-    filepath = user_save_dir / filename
+    category, filepath = find_user_image(user_id, filename)
+    if not filepath:
+        return "图片不存在", 404
     
-    if filepath.exists():
-        return send_file(filepath)
-    else:
+    thumbnail_path = get_or_create_thumbnail(filepath, get_thumbnail_path(user_id, category, filename, size), size)
+    # 无法生成缩略图时（如文件损坏）退回原图
+    try:
+        return send_file(thumbnail_path or filepath)
+    except FileNotFoundError:
+        image_paths.discard(user_id, filename)
         return "图片不存在", 404
 
 @app.route('/api/thumbnails/<filename>')
 def serve_thumbnail(filename):
-    """提供缩略图"""
-    # 简单实现：直接返回原图，实际可以生成缩略图
-    return serve_image(filename)
+    """提供默认用户图片的缩略图（已弃用，保留兼容性）"""
+    return send_user_thumbnail(get_or_create_default_user(), filename)
 
 @app.route('/api/user/<user_id>/thumbnails/<filename>')
 def serve_user_thumbnail(user_id, filename):
-    """提供用户缩略图（移除登录要求以支持默认用户）"""
-    return serve_user_image(user_id, filename)
+    """提供用户缩略图（移除登录要求以支持默认用户），可用size参数选择尺寸"""
+    # 如果是登录用户，验证权限
+    if 'user_id' in session and session['user_id'] != user_id:
+        return jsonify({'error': '权限不足'}), 403
+    
+    return send_user_thumbnail(user_id, filename)
 
 @app.route('/api/user/<user_id>/images/<category>/<filename>')
 def serve_user_image_by_category(user_id, category, filename):
@@ -1302,11 +3271,9 @@ def serve_user_image_by_category(user_id, category, filename):
     if category not in ['clothes', 'char', 'vton_results']:
         return jsonify({'error': '无效的分类'}), 400
     
-    user_save_dir = get_user_save_dir(user_id, category)
-    filepath = user_save_dir / filename
-    if filepath.exists():
-        return send_file(filepath)
-    else:
+    try:
+        return send_image_file(BASE_SAVE_DIR / user_id / category / filename)
+    except FileNotFoundError:
         return "图片不存在", 404
 
 @app.route('/api/user/file-paths', methods=['GET'])
@@ -1466,7 +3433,10 @@ def get_user_file_paths_by_id(user_id):
         return jsonify({'success': False, 'error': f'获取文件路径失败: {str(e)}'}), 500
 
 def download_image_from_url(image_info, user_id, base_dir):
-    """下载单个图片到指定用户目录的分类文件夹"""
+    """下载单个图片到指定用户目录的分类文件夹
+
+    成功时返回待写入数据库的图片记录（由调用方批量保存），失败时返回False
+    """
     try:
         category = image_info.get('category', 'clothes')
         filename = image_info.get('filename')
@@ -1476,6 +3446,11 @@ def download_image_from_url(image_info, user_id, base_dir):
             print(f"下载失败: 缺少必要信息 - filename:{filename}, url:{url}, category:{category}")
             return False
         
+        # 分类同时决定保存目录和数据库中的category列，下载前校验
+        if category not in ['clothes', 'char', 'vton_results']:
+            print(f"下载失败: 无效的分类 {category} - {filename}")
+            return False
+        
         # 构建文件路径 - 使用 saved_images/ 而不是 downloads/
         file_path = Path(base_dir) / user_id / category / filename
         file_path.parent.mkdir(parents=True, exist_ok=True)
@@ -1486,37 +3461,33 @@ def download_image_from_url(image_info, user_id, base_dir):
         response = requests.get(url, timeout=30)
         
         if response.status_code == 200:
-            with open(file_path, 'wb') as f:
-                f.write(response.content)
-            print(f"下载成功: {filename} ({len(response.content)} bytes)")
+            # 同名文件会被新下载的内容替换；内容已存在时只创建硬链接
+            file_path.unlink(missing_ok=True)
+            content_hash, written = store_blob(user_id, response.content, file_path)
+            print(f"下载成功: {filename} ({len(response.content)} bytes{'' if written else '，内容已存在'})")
             
-            # 保存到数据库
+            # 获取图片尺寸
             try:
-                image_id = str(uuid.uuid4())
-                
-                # 获取图片尺寸
-                try:
-                    from PIL import Image
-                    with Image.open(file_path) as img:
-                        width, height = img.size
-                except Exception:
-                    width, height = 0, 0
-                
-                # 保存数据库记录
-                db.save_image_record(
-                    image_id, user_id, filename, url, 
-                    {'url': url, 'title': f'Downloaded from {url}'}, 
-                    len(response.content), width, height, 
-                    {'downloaded_from': url, 'category': category}, 
-                    category
-                )
-                print(f"已保存到数据库: {image_id}")
-                
-            except Exception as db_error:
-                print(f"保存到数据库失败: {db_error}")
-                # 即使数据库保存失败，文件下载成功也算成功
+                from PIL import Image
+                with Image.open(file_path) as img:
+                    width, height = img.size
+            except Exception:
+                width, height = 0, 0
             
-            return True
+            # 构造数据库记录，由调用方批量写入
+            return {
+                'image_id': str(uuid.uuid4()),
+                'user_id': user_id,
+                'filename': filename,
+                'original_url': url,
+                'page_info': {'url': url, 'title': f'Downloaded from {url}'},
+                'file_size': len(response.content),
+                'width': width,
+                'height': height,
+                'context_info': {'downloaded_from': url, 'category': category},
+                'category': category,
+                'content_hash': content_hash
+            }
         else:
             print(f"下载失败 [{response.status_code}]: {url}")
             return False
@@ -1526,7 +3497,10 @@ def download_image_from_url(image_info, user_id, base_dir):
         return False
 
 def sync_images_from_server(user_id, images_data, max_workers=5):
-    """从服务器同步图片到本地 saved_images 目录"""
+    """从服务器同步图片到本地 saved_images 目录
+
+    返回 (是否成功, 说明, 失败列表)，失败列表中每项为 {'filename', 'error'}
+    """
     try:
         from concurrent.futures import ThreadPoolExecutor
         
@@ -1538,7 +3512,7 @@ def sync_images_from_server(user_id, images_data, max_workers=5):
         
         if not all_images:
             print("没有图片需要下载")
-            return True, "没有图片需要下载"
+            return True, "没有图片需要下载", []
         
         # 使用 saved_images 作为基础目录
         base_dir = BASE_SAVE_DIR
@@ -1552,21 +3526,44 @@ def sync_images_from_server(user_id, images_data, max_workers=5):
                 all_images
             ))
         
-        success_count = sum(results)
+        records = [record for record in results if record]
+        failures = [
+            {'filename': image_info.get('filename'), 'error': '下载失败'}
+            for image_info, record in zip(all_images, results) if not record
+        ]
         total_count = len(all_images)
         
-        print(f"下载完成！成功 {success_count}/{total_count} 张图片")
+        print(f"下载完成！成功 {len(records)}/{total_count} 张图片")
+        
+        # 所有下载成功的图片在一个事务中写入数据库；批量写入失败时逐条写入，只跳过出错的记录
+        try:
+            db.save_image_records(records)
+            saved_records = records
+        except Exception as db_error:
+            print(f"批量保存到数据库失败，改为逐条保存: {db_error}")
+            saved_records = []
+            for record in records:
+                try:
+                    db.save_image_records([record])
+                    saved_records.append(record)
+                except Exception as e:
+                    print(f"保存图片记录失败: {record['filename']} - {e}")
+                    failures.append({'filename': record['filename'], 'error': str(e)})
+        print(f"已保存 {len(saved_records)} 条图片记录到数据库")
+        for record in saved_records:
+            derivative_queue.submit(user_id, record['image_id'], record['category'], record['filename'])
         
+        success_count = len(saved_records)
         if success_count == total_count:
-            return True, f"全部 {total_count} 张图片下载成功"
+            return True, f"全部 {total_count} 张图片下载成功", failures
         elif success_count > 0:
-            return True, f"下载完成，成功 {success_count}/{total_count} 张图片"
+            return True, f"下载完成，成功 {success_count}/{total_count} 张图片", failures
         else:
-            return False, "所有图片下载失败"
+            return False, "所有图片下载失败", failures
             
     except Exception as e:
         print(f"同步图片失败: {e}")
-        return False, f"同步图片失败: {str(e)}"
+        return False, f"同步图片失败: {str(e)}", []
 
 def organize_user_images(user_id):
     """整理用户图片，确保文件和数据库记录一致"""
@@ -1577,7 +3574,10 @@ def organize_user_images(user_id):
             return False
         
         categories = ['clothes', 'char', 'vton_results']
-        organized_count = 0
+        records = []
+        
+        # 一次查出已有记录的文件名，避免逐个文件查询
+        existing_filenames = db.get_user_filenames(user_id)
         
         for category in categories:
             category_dir = user_dir / category
@@ -1590,14 +3590,12 @@ def organize_user_images(user_id):
                     filename = file_path.name
                     
                     # 检查数据库中是否已有记录
-                    existing_image = db.get_image_by_filename(user_id, filename)
-                    if not existing_image:
+                    if filename not in existing_filenames:
                         # 为没有数据库记录的文件创建记录
                         try:
-                            image_id = str(uuid.uuid4())
-                            
-                            # 获取文件信息
+                            # 获取文件信息，并纳入内容寻址存储
                             file_size = file_path.stat().st_size
+                            content_hash, _ = adopt_blob(user_id, file_path)
                             
                             # 获取图片尺寸
                             try:
@@ -1607,21 +3605,28 @@ def organize_user_images(user_id):
                             except Exception:
                                 width, height = 0, 0
                         
-                            # 创建数据库记录
-                            db.save_image_record(
-                                image_id, user_id, filename, '', 
-                                {'url': '', 'title': f'Local file: {filename}'}, 
-                                file_size, width, height, 
-                                {'category': category, 'source': 'local_file'}, 
-                                category
-                            )
-                            
-                            organized_count += 1
+                            records.append({
+                                'image_id': str(uuid.uuid4()),
+                                'user_id': user_id,
+                                'filename': filename,
+                                'original_url': '',
+                                'page_info': {'url': '', 'title': f'Local file: {filename}'},
+                                'file_size': file_size,
+                                'width': width,
+                                'height': height,
+                                'context_info': {'category': category, 'source': 'local_file'},
+                                'category': category,
+                                'content_hash': content_hash
+                            })
+                            existing_filenames.add(filename)
                             print(f"为本地文件创建数据库记录: {filename}")
                             
                         except Exception as e:
                             print(f"为文件 {filename} 创建数据库记录失败: {e}")
         
+        # 所有新记录在一个事务中写入
+        organized_count = db.save_image_records(records)
+        
         print(f"整理完成，为 {organized_count} 个文件创建了数据库记录")
         return True
         
@@ -1789,8 +3794,8 @@ def login():
                             
                             # 执行图片同步
                             if images_to_sync:
-                                sync_success, sync_message = sync_images_from_server(user_id, images_to_sync, max_workers=3)
-                                print(f"图片同步结果: {sync_success}, {sync_message}")
+                                sync_success, sync_message, sync_failures = sync_images_from_server(user_id, images_to_sync, max_workers=3)
+                                print(f"图片同步结果: {sync_success}, {sync_message}，失败 {len(sync_failures)} 张")
                                 
                                 # 同步完成后整理本地图片
                                 organize_user_images(user_id)
@@ -1864,88 +3869,30 @@ def sync_to_cloud():
         user_id = session['user_id']
         print(f"开始同步用户 {user_id} 的数据...")
         
-        # 获取用户信息和图片元数据
-        user_info = db.get_user_info(user_id)
-        user_images = db.get_user_images(user_id, limit=10000)  # 获取所有图片元数据
-        
-        # 获取VTON历史数据
-        vton_history = []
-        try:
-            conn = sqlite3.connect(DB_PATH)
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT name FROM sqlite_master 
-                WHERE type='table' AND name='vton_history'
-            ''')
-            if cursor.fetchone():
-                cursor.execute('''
-                    SELECT id, user_id, human_image, garment_image, result_image, 
-                           result_image_id, parameters, processing_time, created_at
-                    FROM vton_history 
-                    WHERE user_id = ?
-                    ORDER BY created_at DESC
-                ''', (user_id,))
-                
-                for row in cursor.fetchall():
-                    try:
-                        parameters = json.loads(row[6]) if row[6] else {}
-                    except:
-                        parameters = {}
-                    
-                    vton_history.append({
-                        'id': row[0],
-                        'user_id': row[1],
-                        'human_image': row[2],
-                        'garment_image': row[3],
-                        'result_image': row[4],
-                        'result_image_id': row[5],
-                        'parameters': parameters,
-                        'processing_time': row[7],
-                        'created_at': row[8]
-                    })
-            conn.close()
-        except Exception as e:
-            print(f"获取VTON历史失败: {e}")
-        
-        # 获取收藏数据
-        favorites_data = []
-        try:
-            favorites_data = db.get_user_favorites(user_id, limit=10000)
-        except Exception as e:
-            print(f"获取收藏数据失败: {e}")
-        
-        sync_data = {
-            'user_info': user_info,
-            'images': user_images,
-            'vton_history': vton_history,
-            'favorites': favorites_data,
-            'sync_timestamp': datetime.datetime.now().isoformat()
-        }
+        # 用户数据在同步时分批读取，这里只读取各项数量
+        user_data = db.export_user_data(user_id)
+        counts = user_data.counts()
         
-        print(f"准备同步: 用户信息={bool(user_info)}, 图片数量={len(user_images)}, VTON历史={len(vton_history)}, 收藏数量={len(favorites_data)}")
+        print(f"准备同步: 用户信息={bool(user_data.user_info)}, 图片数量={counts['images']}, VTON历史={counts['vton_history']}, 收藏数量={counts['favorites']}")
         
         def sync_task():
             try:
                 print("开始异步同步任务...")
-                result = cloud_client.sync_user_data(user_id, sync_data)
+                result = cloud_client.sync_user_data(user_id, user_data)
                 if result and result.get('success'):
                     print(f"用户 {user_id} 数据同步成功: {result}")
                     
                     # 可选：更新本地数据库标记为已同步
                     # 这里可以添加更新图片cloud_synced状态的逻辑
-                    conn = sqlite3.connect(DB_PATH)
-                    cursor = conn.cursor()
                     try:
-                        cursor.execute('''
-                            UPDATE images SET cloud_synced = 1 
-                            WHERE user_id = ? AND cloud_synced = 0
-                        ''', (user_id,))
-                        conn.commit()
+                        with db.connection(user_id) as conn:
+                            conn.execute('''
+                                UPDATE images SET cloud_synced = 1 
+                                WHERE user_id = ? AND cloud_synced = 0
+                            ''', (user_id,))
                         print(f"已标记用户 {user_id} 的图片为云端已同步")
                     except Exception as e:
                         print(f"更新同步状态失败: {e}")
-                    finally:
-                        conn.close()
                         
                 else:
                     print(f"用户 {user_id} 数据同步失败: {result}")
@@ -1963,10 +3910,10 @@ def sync_to_cloud():
             'message': '同步任务已启动',
             'sync_info': {
                 'user_id': user_id,
-                'image_count': len(user_images),
-                'vton_history_count': len(vton_history),
-                'favorites_count': len(favorites_data),
-                'estimated_time': f"{(len(user_images) + len(vton_history)) * 0.1:.1f}秒"  # 估算时间
+                'image_count': counts['images'],
+                'vton_history_count': counts['vton_history'],
+                'favorites_count': counts['favorites'],
+                'estimated_time': f"{(counts['images'] + counts['vton_history']) * 0.1:.1f}秒"  # 估算时间
             }
         })
         
@@ -2022,23 +3969,10 @@ def upload_clipboard():
         if result:
             print(f"图片保存成功: {result['filename']}")
             
-            # 创建任务
-            task_id = str(uuid.uuid4())
-            db.create_task(task_id, user_id, result['image_id'])
+            # 登记任务（图片已同步保存，任务直接完成，缩略图进度单独记录）
+            task_id = task_registry.track(user_id, result['image_id'], result['derivatives'])
             print(f"任务创建成功: {task_id}")
             
-            # 模拟异步处理
-            def process_task():
-                try:
-                    time.sleep(1)  # 模拟处理时间
-                    db.update_task_status(task_id, 'completed')
-                    print(f"任务完成: {task_id}")
-                except Exception as e:
-                    print(f"任务处理失败: {e}")
-            
-            thread = threading.Thread(target=process_task)
-            thread.start()
-            
             response_data = {
                 'success': True,
                 'taskId': task_id,
@@ -2101,33 +4035,13 @@ def upload_file():
             category = 'clothes'
             print(f"无效分类，使用默认分类: {category}")
         
-        # 检查文件大小 (10MB限制)
-        file.seek(0, 2)  # 移动到文件末尾
-        file_size = file.tell()
-        file.seek(0)  # 重置文件指针
-        
-        if file_size > 10 * 1024 * 1024:  # 10MB
-            print(f"错误: 文件过大 ({file_size} bytes)")
-            return jsonify({'success': False, 'error': '文件大小不能超过10MB'}), 400
-        
-        # 读取文件内容并转换为base64
-        file_content = file.read()
+        # 上传内容在解析表单时已写入暂存文件（超过MAX_UPLOAD_SIZE时返回413），哈希同步算好
+        staged = file.stream
         file_ext = file.filename.lower().split('.')[-1]
+        if file_ext == 'jpeg':
+            file_ext = 'jpg'
         
-        # 确定MIME类型
-        mime_types = {
-            'png': 'image/png',
-            'jpg': 'image/jpeg',
-            'jpeg': 'image/jpeg',
-            'gif': 'image/gif',
-            'webp': 'image/webp'
-        }
-        mime_type = mime_types.get(file_ext, 'image/jpeg')
-        
-        # 转换为base64格式
-        image_data = f"data:{mime_type};base64," + base64.b64encode(file_content).decode('utf-8')
-        
-        print(f"文件转换完成, MIME类型: {mime_type}, 数据长度: {len(image_data)}")
+        print(f"文件接收完成, 格式: {file_ext}, 大小: {staged.size} bytes")
         
         # 构造页面信息
         page_info = {
@@ -2139,29 +4053,16 @@ def upload_file():
         
         print(f"开始保存文件到分类: {category}")
         
-        # 保存图片
-        result = save_image_from_data(image_data, f'file_upload:{file.filename}', page_info, user_id, category)
+        # 保存图片：暂存文件直接重命名到内容寻址存储
+        result = save_image_from_data(staged, f'file_upload:{file.filename}', page_info, user_id, category, ext=file_ext)
         
         if result:
             print(f"文件保存成功: {result['filename']}")
             
-            # 创建任务
-            task_id = str(uuid.uuid4())
-            db.create_task(task_id, user_id, result['image_id'])
+            # 登记任务（图片已同步保存，任务直接完成，缩略图进度单独记录）
+            task_id = task_registry.track(user_id, result['image_id'], result['derivatives'])
             print(f"任务创建成功: {task_id}")
             
-            # 模拟异步处理
-            def process_task():
-                try:
-                    time.sleep(1)  # 模拟处理时间
-                    db.update_task_status(task_id, 'completed')
-                    print(f"任务完成: {task_id}")
-                except Exception as e:
-                    print(f"任务处理失败: {e}")
-            
-            thread = threading.Thread(target=process_task)
-            thread.start()
-            
             response_data = {
                 'success': True,
                 'taskId': task_id,
@@ -2180,6 +4081,9 @@ def upload_file():
             print("错误: 保存上传文件失败")
             return jsonify({'success': False, 'error': '保存上传文件失败'}), 500
             
+    except RequestEntityTooLarge:
+        print("错误: 文件过大")
+        return jsonify({'success': False, 'error': f'文件大小不能超过{MAX_UPLOAD_SIZE // 1024 // 1024}MB'}), 413
     except Exception as e:
         print(f"处理文件上传失败: {e}")
         import traceback
@@ -2295,28 +4199,12 @@ def virtual_tryon():
         if not human_filename or not garment_filename:
             return jsonify({'success': False, 'error': '人物图片和服装图片都是必需的'}), 400
         
-        # 构建图片文件路径
-        user_dir = BASE_SAVE_DIR / user_id
-        
-        # 查找人物图片（可能在char目录下）
-        human_path = None
-        for category in ['char', 'clothes']:
-            potential_path = user_dir / category / human_filename
-            if potential_path.exists():
-                human_path = potential_path
-                break
-        
+        # 根据images表中的分类定位图片文件
+        _, human_path = find_user_image(user_id, human_filename)
         if not human_path:
             return jsonify({'success': False, 'error': f'人物图片不存在: {human_filename}'}, 404)
         
-        # 查找服装图片（通常在clothes目录下）
-        garment_path = None
-        for category in ['clothes', 'char']:
-            potential_path = user_dir / category / garment_filename
-            if potential_path.exists():
-                garment_path = potential_path
-                break
-        
+        _, garment_path = find_user_image(user_id, garment_filename)
         if not garment_path:
             return jsonify({'success': False, 'error': f'服装图片不存在: {garment_filename}'}, 404)
         
@@ -2352,7 +4240,8 @@ def virtual_tryon():
         
         # 保存试穿结果 - 只保存result图片
         timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
-        result_filename = f"vton_result_{timestamp}_{seed}.png"
+        # 同一秒内相同seed的多次试穿不能使用相同的文件名
+        result_filename = f"vton_result_{timestamp}_{seed}_{uuid.uuid4().hex[:8]}.png"
         
         # 使用vton_results分类目录
         vton_results_dir = get_user_save_dir(user_id, 'vton_results')
@@ -2362,8 +4251,17 @@ def virtual_tryon():
         garment_image_info = db.get_image_by_filename(user_id, garment_filename)
         
         result_image_id = None
-        # 保存试穿结果图片
-        if base64_to_image(vton_result['result_image'], result_path):
+        # 保存试穿结果图片：内容存入内容寻址存储，结果文件是指向blob的硬链接
+        content_hash = None
+        try:
+            result_data = vton_result['result_image']
+            if result_data.startswith('data:image'):
+                result_data = result_data.split(',', 1)[1]
+            content_hash, _ = store_blob(user_id, base64.b64decode(result_data), result_path)
+        except Exception as e:
+            print(f"base64转图片失败 {result_path}: {e}")
+        
+        if content_hash:
             print(f"试穿结果已保存: {result_path}")
             
             # 将试穿结果保存到images表中，分类为vton_results
@@ -2401,16 +4299,17 @@ def virtual_tryon():
                     'human_image': human_filename,
                     'garment_image': garment_filename,
                     'category': 'vton_results',
-                    'garment_original_info': garment_image_info  # 保存服装图片的完整信息
+                    'garment_original_info': garment_image_info.to_dict() if garment_image_info else None  # 保存服装图片的完整信息
                 }
                 
                 # 保存到images表
                 result_image_id = str(uuid.uuid4())
                 db.save_image_record(
                     result_image_id, user_id, result_filename, 'vton_result', 
-                    page_info, file_size, width, height, context_info, 'vton_results'
+                    page_info, file_size, width, height, context_info, 'vton_results', content_hash
                 )
                 print(f"试穿结果已保存到图片库: {result_image_id}")
+                derivative_queue.submit(user_id, result_image_id, 'vton_results', result_filename)
                 
             except Exception as e:
                 print(f"保存试穿结果到图片库失败: {e}")
@@ -2420,41 +4319,19 @@ def virtual_tryon():
         
         # 记录试穿历史到数据库
         try:
-            conn = sqlite3.connect(DB_PATH)
-            cursor = conn.cursor()
-            
-            # 创建试穿历史表（如果不存在）
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS vton_history (
-                    id TEXT PRIMARY KEY,
-                    user_id TEXT NOT NULL,
-                    human_image TEXT NOT NULL,
-                    garment_image TEXT NOT NULL,
-                    result_image TEXT NOT NULL,
-                    result_image_id TEXT,
-                    parameters TEXT,
-                    processing_time REAL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users (user_id),
-                    FOREIGN KEY (result_image_id) REFERENCES images (id)
-                )
-            ''')
-            
-            # 插入试穿记录
-            vton_id = str(uuid.uuid4())
-            cursor.execute('''
-                INSERT INTO vton_history 
-                (id, user_id, human_image, garment_image, result_image, result_image_id, parameters, processing_time)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                vton_id, user_id, human_filename, garment_filename,
-                result_filename, result_image_id,
-                json.dumps(vton_result['parameters']),
-                vton_result['processing_time']
-            ))
-            
-            conn.commit()
-            conn.close()
+            with db.connection(user_id) as conn:
+                # 插入试穿记录（vton_history表在启动时的结构迁移中创建）
+                vton_id = str(uuid.uuid4())
+                conn.execute('''
+                    INSERT INTO vton_history 
+                    (id, user_id, human_image, garment_image, result_image, result_image_id, parameters, processing_time)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ''', (
+                    vton_id, user_id, human_filename, garment_filename,
+                    result_filename, result_image_id,
+                    json.dumps(vton_result['parameters']),
+                    vton_result['processing_time']
+                ))
             
         except Exception as e:
             print(f"保存试穿历史失败: {e}")
@@ -2506,41 +4383,39 @@ def get_vton_history():
         per_page = min(request.args.get('per_page', 10, type=int), 50)
         offset = (page - 1) * per_page
         
-        # 查询试穿历史
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        # 检查表是否存在
-        cursor.execute('''
-            SELECT name FROM sqlite_master 
-            WHERE type='table' AND name='vton_history'
-        ''')
-        if not cursor.fetchone():
-            conn.close()
-            return jsonify({
-                'success': True,
-                'history': [],
-                'total': 0,
-                'page': page,
-                'per_page': per_page
-            })
-        
-        # 获取总数
-        cursor.execute('SELECT COUNT(*) FROM vton_history WHERE user_id = ?', (user_id,))
-        total = cursor.fetchone()[0]
+        # 传入cursor时使用游标分页，忽略page
+        try:
+            page_cursor = decode_cursor(request.args['cursor']) if request.args.get('cursor') else None
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
         
-        # 获取历史记录
-        cursor.execute('''
-            SELECT id, human_image, garment_image, result_image, mask_image, 
-                   parameters, processing_time, created_at
-            FROM vton_history 
-            WHERE user_id = ? 
-            ORDER BY created_at DESC 
-            LIMIT ? OFFSET ?
-        ''', (user_id, per_page, offset))
+        # 查询试穿历史
+        with db.connection(user_id) as conn:
+            # 获取总数
+            total = conn.execute('SELECT COUNT(*) FROM vton_history WHERE user_id = ?', (user_id,)).fetchone()[0]
+            
+            conditions = ['h.user_id = ?']
+            params = [user_id]
+            if page_cursor:
+                conditions.append('(h.created_at, h.id) < (?, ?)')
+                params.extend(page_cursor)
+                offset = 0
+            
+            # 获取历史记录，结果图片的收藏状态在同一查询中获取
+            # vton_history表不保存遮罩图片，mask_image固定为NULL
+            records = conn.execute(f'''
+                SELECT h.id, h.human_image, h.garment_image, h.result_image, NULL AS mask_image, 
+                       h.parameters, h.processing_time, h.created_at,
+                       f.id IS NOT NULL AS is_favorited
+                FROM vton_history h
+                LEFT JOIN favorites f
+                    ON f.user_id = h.user_id AND f.image_id = h.result_image_id AND f.favorite_type = 'image'
+                WHERE {' AND '.join(conditions)}
+                ORDER BY h.created_at DESC, h.id DESC 
+                LIMIT ? OFFSET ?
+            ''', (*params, per_page + 1, offset)).fetchall()
         
-        records = cursor.fetchall()
-        conn.close()
+        records, next_cursor = paginate_keyset(records, per_page, lambda record: (record[7], record[0]))
         
         history = []
         for record in records:
@@ -2549,9 +4424,6 @@ def get_vton_history():
             except:
                 parameters = {}
             
-            vton_result_id = record[0]
-            is_favorited = db.is_favorited(user_id, vton_result_id=vton_result_id, favorite_type='vton_result')
-            
             history.append({
                 'id': record[0],
                 'human_image': record[1],
@@ -2563,7 +4435,7 @@ def get_vton_history():
                 'parameters': parameters,
                 'processing_time': record[6],
                 'created_at': record[7],
-                'is_favorited': is_favorited
+                'is_favorited': bool(record[8])
             })
         
         return jsonify({
@@ -2572,8 +4444,9 @@ def get_vton_history():
             'total': total,
             'page': page,
             'per_page': per_page,
-            'has_next': offset + per_page < total,
-            'has_prev': page > 1
+            'has_next': next_cursor is not None,
+            'has_prev': page > 1 and page_cursor is None,
+            'next_cursor': next_cursor
         })
         
     except Exception as e:
@@ -2587,9 +4460,9 @@ def serve_vton_result(user_id, filename):
         vton_results_dir = BASE_SAVE_DIR / user_id / "vton_results"
         file_path = vton_results_dir / filename
         
-        if file_path.exists():
-            return send_file(file_path)
-        else:
+        try:
+            return send_image_file(file_path)
+        except FileNotFoundError:
             return jsonify({'error': '文件不存在'}), 404
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -2657,17 +4530,17 @@ def get_favorites():
         favorite_type = request.args.get('type', 'image')
         offset = (page - 1) * per_page
         
-        favorites = db.get_user_favorites(user_id, favorite_type, per_page, offset)
+        # 传入cursor时使用游标分页，忽略page
+        try:
+            page_cursor = decode_cursor(request.args['cursor']) if request.args.get('cursor') else None
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+        
+        favorites = db.get_user_favorites(user_id, favorite_type, per_page + 1, offset, cursor=page_cursor)
+        favorites, next_cursor = paginate_keyset(favorites, per_page, lambda favorite: (favorite['favorited_at'], favorite['id']))
         
         # 获取收藏总数
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT COUNT(*) FROM favorites 
-            WHERE user_id = ? AND favorite_type = ?
-        ''', (user_id, favorite_type))
-        total_count = cursor.fetchone()[0]
-        conn.close()
+        total_count = db.get_user_favorite_count(user_id, favorite_type)
         
         total_pages = (total_count + per_page - 1) // per_page  # 向上取整
         
@@ -2680,10 +4553,7 @@ def get_favorites():
                                                     user_id=user_id, 
                                                     category=category, 
                                                     filename=favorite['filename'])
-                    favorite['thumbnail_url'] = url_for('serve_user_image_by_category', 
-                                                      user_id=user_id, 
-                                                      category=category, 
-                                                      filename=favorite['filename'])
+                    favorite['thumbnail_url'] = url_for('serve_user_thumbnail', user_id=user_id, filename=favorite['filename'])
                 else:
                     favorite['preview_url'] = url_for('serve_user_image', user_id=user_id, filename=favorite['filename'])
                     favorite['thumbnail_url'] = url_for('serve_user_thumbnail', user_id=user_id, filename=favorite['filename'])
@@ -2694,7 +4564,8 @@ def get_favorites():
             'per_page': per_page,
             'pages': total_pages,
             'total': total_count,
-            'type': favorite_type
+            'type': favorite_type,
+            'next_cursor': next_cursor
         })
         
     except Exception as e:
@@ -2710,17 +4581,14 @@ def get_category_stats():
         categories = ['clothes', 'char', 'vton_results', 'favorites']
         stats = {}
         
+        # 计数表中一次读出所有分类和收藏的数量
+        counters = db.get_user_counters(user_id)
         for category in categories:
             if category == 'favorites':
                 # 收藏的统计
-                conn = sqlite3.connect(DB_PATH)
-                cursor = conn.cursor()
-                cursor.execute('SELECT COUNT(*) FROM favorites WHERE user_id = ?', (user_id,))
-                count = cursor.fetchone()[0]
-                conn.close()
-                stats[category] = count
+                stats[category] = sum(counters.get('favorites', {}).values())
             else:
-                stats[category] = db.get_user_image_count(user_id, category)
+                stats[category] = counters.get('images', {}).get(category, 0)
         
         return jsonify({
             'success': True,
@@ -2761,12 +4629,12 @@ def batch_delete_images():
         if not image_ids:
             return jsonify({'success': False, 'error': '未选择图片'}), 400
         
-        success, message = db.delete_multiple_images(image_ids, user_id)
+        success, message, results = db.delete_multiple_images(image_ids, user_id)
         
         if success:
-            return jsonify({'success': True, 'message': message})
+            return jsonify({'success': True, 'message': message, 'results': results})
         else:
-            return jsonify({'success': False, 'error': message}), 400
+            return jsonify({'success': False, 'error': message, 'results': results}), 400
             
     except Exception as e:
         print(f"批量删除图片API失败: {e}")
@@ -2810,7 +4678,7 @@ def sync_images():
             return jsonify({'success': False, 'error': '没有图片数据需要同步'}), 400
         
         # 执行同步
-        success, message = sync_images_from_server(user_id, images_data, max_workers)
+        success, message, failures = sync_images_from_server(user_id, images_data, max_workers)
         
         if success:
             # 同步完成后整理文件
@@ -2818,11 +4686,12 @@ def sync_images():
             return jsonify({
                 'success': True, 
                 'message': message,
+                'failures': failures,
                 'user_id': user_id,
                 'saved_to': str(BASE_SAVE_DIR / user_id)
             })
         else:
-            return jsonify({'success': False, 'error': message}), 500
+            return jsonify({'success': False, 'error': message, 'failures': failures}), 500
             
     except Exception as e:
         print(f"同步图片失败: {e}")
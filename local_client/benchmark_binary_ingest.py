@@ -0,0 +1,116 @@
+"""图片接收性能测试：对比 JSON+base64 的 /api/receive-image 与二进制的 /api/receive-image/binary
+
+用法：
+    python benchmark_binary_ingest.py [每种情况的请求次数]
+
+在临时目录中启动本地服务器，对每种大小生成若干张内容不同的PNG（避免内容去重跳过写盘），
+分别以data URL（JSON）和原始字节（请求体）发送，输出平均/P95延迟和吞吐量。
+JSON请求体预先编码好，只统计传输和服务器端的开销。
+"""
+import base64
+import contextlib
+import io
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import requests
+
+# 添加当前目录到Python路径
+current_dir = Path(__file__).parent
+sys.path.insert(0, str(current_dir))
+
+IMAGE_SIZES_MB = (0.5, 2, 8)
+
+
+def start_server(application):
+    """在后台线程中启动开发服务器，返回 (server, base_url)"""
+    from werkzeug.serving import make_server
+    server = make_server('127.0.0.1', 0, application, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}'
+
+
+def make_png(size_mb):
+    """随机像素的PNG，几乎无法压缩，文件大小约为size_mb"""
+    from PIL import Image
+    side = int((size_mb * 1024 * 1024 / 3) ** 0.5)
+    buffer = io.BytesIO()
+    Image.frombytes('RGB', (side, side), os.urandom(side * side * 3)).save(buffer, 'PNG', compress_level=0)
+    return buffer.getvalue()
+
+
+def measure(send, payloads):
+    """依次发送payloads，返回 (平均延迟ms, P95延迟ms, 吞吐量MB/s)；吞吐量按图片大小计算"""
+    latencies = []
+    for payload, image_size in payloads:
+        started = time.perf_counter()
+        response = send(payload)
+        latencies.append(time.perf_counter() - started)
+        assert response.status_code == 200 and response.json()['success'], response.text
+    total_mb = sum(image_size for _, image_size in payloads) / 1024 / 1024
+    p95 = sorted(latencies)[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+    return statistics.mean(latencies) * 1000, p95 * 1000, total_mb / sum(latencies)
+
+
+if __name__ == '__main__':
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+
+    # 在临时目录中运行，不影响真实的数据库和图片目录
+    work_dir = Path(tempfile.mkdtemp())
+    os.chdir(work_dir)
+    import app as app_module
+
+    app_module.BASE_SAVE_DIR = work_dir.resolve() / 'saved_images'
+    app_module.BASE_SAVE_DIR.mkdir(exist_ok=True)
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server, base_url = start_server(app_module.app)
+    session = requests.Session()
+    page_info = {'url': 'https://shop.example.com/p/1', 'title': 'benchmark'}
+
+    def send_json(body):
+        return session.post(f'{base_url}/api/receive-image', data=body,
+                            headers={'Content-Type': 'application/json'})
+
+    def send_binary(body):
+        return session.post(f'{base_url}/api/receive-image/binary', data=body, headers={
+            'Content-Type': 'image/png',
+            'X-Original-Url': 'https://cdn.example.com/a.png',
+            'X-Page-Info': requests.utils.quote(json.dumps(page_info), safe=''),
+        })
+
+    print("=" * 72)
+    print(f"每种情况请求 {rounds} 次（另加1次预热），延迟单位 ms，吞吐量单位 MB/s")
+    print("=" * 72)
+    for size_mb in IMAGE_SIZES_MB:
+        # 两种方式使用不同的图片，避免后发送的一方命中内容去重
+        json_payloads = []
+        for _ in range(rounds + 1):
+            image = make_png(size_mb)
+            json_payloads.append((json.dumps({
+                'imageData': 'data:image/png;base64,' + base64.b64encode(image).decode(),
+                'originalUrl': 'https://cdn.example.com/a.png',
+                'pageInfo': page_info,
+            }), len(image)))
+        binary_payloads = [(image, len(image)) for image in (make_png(size_mb) for _ in range(rounds + 1))]
+
+        # 服务器的日志输出较多，测量期间丢弃
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            results = []
+            for name, send, payloads in (('JSON+base64', send_json, json_payloads),
+                                         ('二进制', send_binary, binary_payloads)):
+                send(payloads[0][0])  # 预热
+                results.append((name, measure(send, payloads[1:])))
+
+        for name, (mean_ms, p95_ms, throughput) in results:
+            print(f"{size_mb:>4}MB  平均 {mean_ms:>8.1f}   P95 {p95_ms:>8.1f}   吞吐量 {throughput:>7.1f}   {name}")
+    print("=" * 72)
+
+    server.shutdown()
+    app_module.derivative_queue.shutdown()
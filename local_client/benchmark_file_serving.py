@@ -0,0 +1,90 @@
+"""图片文件发送性能测试：对比 Flask 默认 send_file 与 send_image_file（零拷贝/分块）
+
+用法：
+    python benchmark_file_serving.py [每种情况的请求次数]
+
+在临时目录中生成 1MB 和 20MB 的文件，分别启动三个本地服务器：
+- send_file：Flask默认实现，开发服务器按8KB块读写
+- 分块读取：send_image_file，默认请求处理器，按 FILE_BLOCK_SIZE 块读写
+- sendfile：send_image_file + SendfileRequestHandler，os.sendfile 零拷贝
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import requests
+
+# 添加当前目录到Python路径
+current_dir = Path(__file__).parent
+sys.path.insert(0, str(current_dir))
+
+FILE_SIZES_MB = (1, 20)
+
+
+def start_server(application, request_handler=None):
+    """在后台线程中启动开发服务器，返回 (server, base_url)"""
+    from werkzeug.serving import make_server, WSGIRequestHandler
+    server = make_server('127.0.0.1', 0, application, threaded=True,
+                         request_handler=request_handler or WSGIRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}'
+
+
+def measure(url, size, rounds, headers=None):
+    """顺序请求rounds次，返回吞吐量（MB/s）"""
+    session = requests.Session()
+    session.get(url, headers=headers).content  # 预热
+    started = time.perf_counter()
+    for _ in range(rounds):
+        with session.get(url, headers=headers, stream=True) as response:
+            received = sum(len(chunk) for chunk in response.raw.stream(1024 * 1024, decode_content=False))
+        assert received == size, f'响应长度错误: {received}'
+    elapsed = time.perf_counter() - started
+    return size * rounds / elapsed / 1024 / 1024
+
+
+if __name__ == '__main__':
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+
+    # 在临时目录中运行，不影响真实的数据库和图片目录
+    work_dir = Path(tempfile.mkdtemp())
+    os.chdir(work_dir)
+    import app as app_module
+    from flask import Flask, send_file
+
+    app_module.BASE_SAVE_DIR = work_dir.resolve() / 'saved_images'
+    app_module.BASE_SAVE_DIR.mkdir(exist_ok=True)
+    save_dir = app_module.get_user_save_dir('bench-user', 'vton_results')
+    for size_mb in FILE_SIZES_MB:
+        (save_dir / f'vton_result_{size_mb}mb.png').write_bytes(os.urandom(size_mb * 1024 * 1024))
+
+    baseline_app = Flask('baseline')
+
+    @baseline_app.route('/api/user/<user_id>/vton_results/<filename>')
+    def baseline_serve(user_id, filename):
+        return send_file(save_dir / filename)
+
+    servers = [
+        ('send_file', *start_server(baseline_app)),
+        ('分块读取', *start_server(app_module.app)),
+        ('sendfile', *start_server(app_module.app, app_module.SendfileRequestHandler)),
+    ]
+
+    print("=" * 60)
+    print(f"每种情况请求 {rounds} 次，单位 MB/s")
+    print("=" * 60)
+    for size_mb in FILE_SIZES_MB:
+        size = size_mb * 1024 * 1024
+        path = f'/api/user/bench-user/vton_results/vton_result_{size_mb}mb.png'
+        for name, server, base_url in servers:
+            full = measure(base_url + path, size, rounds)
+            # 后半个文件的Range请求
+            partial = measure(base_url + path, size - size // 2, rounds, headers={'Range': f'bytes={size // 2}-'})
+            print(f"{size_mb:>3}MB  完整文件 {full:>9.1f}   Range请求 {partial:>9.1f}   {name}")
+    print("=" * 60)
+
+    for name, server, base_url in servers:
+        server.shutdown()
@@ -0,0 +1,35 @@
+import importlib
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    # app 在导入时会在当前目录创建数据库和保存目录
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'saved_images').mkdir(exist_ok=True)
+    app_module = importlib.import_module('app')
+    return app_module.ImageDatabase(str(tmp_path / 'test.db'))
+
+
+@pytest.fixture
+def app_module(tmp_path, monkeypatch):
+    """在临时目录中使用app，数据库及依赖它的全局对象都换成新的实例"""
+    monkeypatch.chdir(tmp_path)
+    app_module = importlib.import_module('app')
+    monkeypatch.setattr(app_module, 'BASE_SAVE_DIR', tmp_path.resolve() / 'saved_images')
+    app_module.BASE_SAVE_DIR.mkdir(exist_ok=True)
+    database = app_module.ImageDatabase(str(tmp_path / 'app.db'))
+    queue = app_module.DerivativeQueue(database, max_workers=1)
+    monkeypatch.setattr(app_module, 'db', database)
+    monkeypatch.setattr(app_module, 'derivative_queue', queue)
+    monkeypatch.setattr(app_module, 'similarity_index', app_module.SimilarityIndex(database))
+    monkeypatch.setattr(app_module, 'image_paths', app_module.ImagePathCache(database))
+    monkeypatch.setattr(app_module, 'task_registry', app_module.TaskRegistry(database, persist=False))
+    monkeypatch.setattr(app_module, 'file_remover', app_module.BackgroundFileRemover())
+    yield app_module
+    queue.shutdown()
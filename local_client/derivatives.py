@@ -0,0 +1,52 @@
+"""缩略图和感知哈希的生成
+
+DerivativeQueue 的进程池以spawn方式启动工作进程，工作进程只导入本模块。
+本模块导入时没有副作用（不创建Flask应用、数据库和目录），参数全部由调用方传入。
+"""
+import os
+import uuid
+from pathlib import Path
+
+
+def compute_dhash(img, hash_size):
+    """差值感知哈希：缩小为 (hash_size+1)×hash_size 的灰度图，逐行比较相邻像素，返回十六进制字符串"""
+    from PIL import Image
+
+    pixels = list(img.convert('L').resize((hash_size + 1, hash_size), Image.LANCZOS).getdata())
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return f'{value:0{hash_size * hash_size // 4}x}'
+
+
+def render_thumbnails(source_path, targets, image_format, quality, hash_size):
+    """只解码一次原图，从大到小依次生成多个尺寸的缩略图，targets为 [(尺寸, 缩略图路径)]
+
+    返回 {'width', 'height', 'dhash'}：原图尺寸以及由最小缩略图计算的感知哈希。
+    """
+    from PIL import Image, ImageOps
+
+    with Image.open(source_path) as img:
+        img.seek(0)  # 动图只取第一帧
+        width, height = img.size
+        thumbnail = ImageOps.exif_transpose(img)
+        if thumbnail.mode not in ('RGB', 'RGBA'):
+            thumbnail = thumbnail.convert('RGBA' if 'transparency' in thumbnail.info or thumbnail.mode in ('LA', 'PA') else 'RGB')
+
+        for size, thumbnail_path in sorted(targets, key=lambda target: target[0], reverse=True):
+            thumbnail_path = Path(thumbnail_path)
+            thumbnail.thumbnail((size, size))
+            # 先写临时文件再替换，避免并发请求读到写了一半的缩略图
+            thumbnail_path.parent.mkdir(parents=True, exist_ok=True)
+            temp_path = thumbnail_path.with_name(f'{thumbnail_path.name}.{uuid.uuid4().hex}.tmp')
+            thumbnail.save(temp_path, image_format, quality=quality)
+            os.replace(temp_path, thumbnail_path)
+        dhash = compute_dhash(thumbnail, hash_size)
+    return {'width': width, 'height': height, 'dhash': dhash}
+
+
+def build_derivatives(source_path, targets, image_format, quality, hash_size):
+    """进程池任务：生成全部尺寸的缩略图，返回原图尺寸和感知哈希"""
+    return render_thumbnails(source_path, targets, image_format, quality, hash_size)
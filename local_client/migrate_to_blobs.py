@@ -0,0 +1,29 @@
+"""为已有图片库建立内容寻址存储，合并内容相同的图片文件
+
+用法：
+    python migrate_to_blobs.py
+
+每张尚未记录内容哈希的图片都会计算SHA-256并链接到 saved_images/<user_id>/blobs/ 下，
+内容重复的文件替换为指向同一blob的硬链接。可重复执行，已迁移的图片会被跳过。
+"""
+import sys
+from pathlib import Path
+
+# 添加当前目录到Python路径
+current_dir = Path(__file__).parent
+sys.path.insert(0, str(current_dir))
+
+from app import db, BASE_SAVE_DIR
+
+if __name__ == '__main__':
+    print("=" * 50)
+    print(f"图片目录: {BASE_SAVE_DIR}")
+    print("=" * 50)
+    
+    report = db.migrate_to_blobs()
+    
+    print("=" * 50)
+    print(f"已计算哈希: {report['hashed']} 张图片")
+    print(f"合并重复文件: {report['deduplicated']} 个，释放 {report['bytes_saved'] / 1024 / 1024:.1f} MB")
+    print(f"文件缺失: {report['missing']} 张图片")
+    print("=" * 50)
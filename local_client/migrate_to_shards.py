@@ -0,0 +1,29 @@
+"""将单文件数据库 image_database.db 迁移为按用户分库的布局
+
+用法：
+    python migrate_to_shards.py
+
+迁移完成后将 app.py 中的 DB_SHARDED 设为 True 再启动服务器。
+"""
+import sys
+from pathlib import Path
+
+# 添加当前目录到Python路径
+current_dir = Path(__file__).parent
+sys.path.insert(0, str(current_dir))
+
+from app import ImageDatabase, DB_PATH, BASE_SAVE_DIR
+
+if __name__ == '__main__':
+    print("=" * 50)
+    print(f"源数据库: {DB_PATH}")
+    print(f"用户库目录: {BASE_SAVE_DIR}")
+    print("=" * 50)
+    
+    database = ImageDatabase(DB_PATH, shard_dir=BASE_SAVE_DIR)
+    report = database.migrate_to_shards()
+    
+    print("=" * 50)
+    print(f"迁移完成，共 {len(report)} 个用户")
+    print("请将 app.py 中的 DB_SHARDED 设为 True 后重启服务器")
+    print("=" * 50)
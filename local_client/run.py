@@ -6,10 +6,10 @@ from pathlib import Path
 current_dir = Path(__file__).parent
 sys.path.insert(0, str(current_dir))
 
-# 导入应用
-from app import app
-
 if __name__ == '__main__':
+    # 在main块中导入应用：缩略图进程池以spawn方式启动时会重新执行本文件，工作进程不应初始化应用
+    from app import app, SendfileRequestHandler
+    
     print("=" * 50)
     print("图片处理客户端启动中...")
     print("=" * 50)
@@ -22,6 +22,7 @@ if __name__ == '__main__':
     print("=" * 50)
     
     try:
-        app.run(host='localhost', port=8080, debug=True)
+        # 图片文件通过 os.sendfile 零拷贝发送
+        app.run(host='localhost', port=8080, debug=True, request_handler=SendfileRequestHandler)
     except KeyboardInterrupt:
         print("\n服务器已停止")
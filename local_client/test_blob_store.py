@@ -0,0 +1,109 @@
+import base64
+import io
+import os
+import sys
+from pathlib import Path
+
+from PIL import Image
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+
+def _png(color):
+    buffer = io.BytesIO()
+    Image.new('RGB', (64, 48), color).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+def _ref_count(app_module, user_id, content_hash):
+    with app_module.db.connection(user_id) as conn:
+        row = conn.execute('SELECT ref_count FROM blobs WHERE user_id = ? AND content_hash = ?',
+                           (user_id, content_hash)).fetchone()
+    return row[0] if row else None
+
+
+def test_identical_captures_share_one_blob(app_module):
+    data_url = 'data:image/png;base64,' + base64.b64encode(_png((200, 0, 0))).decode()
+    first = app_module.save_image_from_data(data_url, 'http://example.com/a.png', {}, 'u1', 'clothes')
+    second = app_module.save_image_from_data(data_url, 'http://example.com/b.png', {}, 'u1', 'char')
+
+    content_hash = app_module.hash_file(first['filepath'])
+    blob_path = app_module.get_blob_path('u1', content_hash)
+    assert os.path.samefile(first['filepath'], blob_path)
+    assert os.path.samefile(second['filepath'], blob_path)
+    assert _ref_count(app_module, 'u1', content_hash) == 2
+
+    # 还有引用时保留blob，最后一张图片删除后blob随之删除
+    assert app_module.db.delete_image(first['image_id'], 'u1')[0]
+    app_module.file_remover.join()
+    assert blob_path.exists() and Path(second['filepath']).exists()
+    assert _ref_count(app_module, 'u1', content_hash) == 1
+
+    assert app_module.db.delete_image(second['image_id'], 'u1')[0]
+    app_module.file_remover.join()
+    assert not blob_path.exists()
+    assert _ref_count(app_module, 'u1', content_hash) is None
+
+
+def test_migration_deduplicates_existing_library(app_module):
+    duplicate, unique = _png((0, 0, 200)), _png((0, 200, 0))
+    files = {'clothes_a.png': duplicate, 'clothes_b.png': duplicate, 'clothes_c.png': unique}
+    save_dir = app_module.get_user_save_dir('u1', 'clothes')
+    for filename, data in files.items():
+        (save_dir / filename).write_bytes(data)
+    app_module.db.save_image_records([{
+        'image_id': filename, 'user_id': 'u1', 'filename': filename, 'original_url': '', 'page_info': {},
+        'file_size': len(data), 'width': 64, 'height': 48, 'context_info': {}, 'category': 'clothes'
+    } for filename, data in [*files.items(), ('clothes_missing.png', b'')]])
+
+    report = app_module.db.migrate_to_blobs()
+    assert report == {'hashed': 3, 'deduplicated': 1, 'bytes_saved': len(duplicate), 'missing': 1}
+    assert os.path.samefile(save_dir / 'clothes_a.png', save_dir / 'clothes_b.png')
+    assert (save_dir / 'clothes_b.png').read_bytes() == duplicate
+    assert _ref_count(app_module, 'u1', app_module.hash_file(save_dir / 'clothes_a.png')) == 2
+
+    assert app_module.db.migrate_to_blobs()['hashed'] == 0
+
+
+def test_organize_adds_local_files_to_the_blob_store(app_module):
+    content = _png((10, 20, 30))
+    save_dir = app_module.get_user_save_dir('u1', 'char')
+    (save_dir / 'char_local.png').write_bytes(content)
+
+    assert app_module.organize_user_images('u1')
+    content_hash = app_module.hashlib.sha256(content).hexdigest()
+    assert os.path.samefile(save_dir / 'char_local.png', app_module.get_blob_path('u1', content_hash))
+    assert _ref_count(app_module, 'u1', content_hash) == 1
+    assert app_module.db.migrate_to_blobs()['hashed'] == 0
+
+
+def test_tryon_result_is_stored_as_a_blob(app_module, monkeypatch):
+    client = app_module.app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = 'u1'
+    for category, filename in (('char', 'char_person.png'), ('clothes', 'clothes_shirt.png')):
+        (app_module.get_user_save_dir('u1', category) / filename).write_bytes(_png((90, 90, 90)))
+    result = _png((1, 2, 3))
+    monkeypatch.setattr(app_module, 'call_vton_api', lambda *args, **kwargs: {
+        'success': True, 'parameters': {}, 'processing_time': 1.0,
+        'result_image': 'data:image/png;base64,' + base64.b64encode(result).decode(),
+    })
+
+    response = client.post('/api/vton/tryon', json={
+        'human_image': 'char_person.png', 'garment_image': 'clothes_shirt.png', 'seed': 7
+    })
+    assert response.status_code == 200, response.json
+    content_hash = app_module.hashlib.sha256(result).hexdigest()
+    image = app_module.db.get_image_by_id(response.json['result']['result_image_id'], 'u1')
+    assert image['category'] == 'vton_results'
+    result_path = app_module.BASE_SAVE_DIR / 'u1' / 'vton_results' / image['filename']
+    assert os.path.samefile(result_path, app_module.get_blob_path('u1', content_hash))
+    assert _ref_count(app_module, 'u1', content_hash) == 1
+
+    # 同一秒内的第二次试穿使用新的文件名，共用同一个blob
+    again = client.post('/api/vton/tryon', json={
+        'human_image': 'char_person.png', 'garment_image': 'clothes_shirt.png', 'seed': 7
+    })
+    assert again.status_code == 200, again.json
+    assert again.json['result']['result_filename'] != image['filename']
+    assert _ref_count(app_module, 'u1', content_hash) == 2
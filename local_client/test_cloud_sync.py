@@ -0,0 +1,71 @@
+import json
+from types import SimpleNamespace
+
+
+def _populate(db, user_dir, count):
+    (user_dir / 'clothes').mkdir(parents=True)
+    records = []
+    for index in range(count):
+        filename = f'clothes_{index:03d}.png'
+        if index % 2 == 0:
+            (user_dir / 'clothes' / filename).write_bytes(b'png-%d' % index)
+        records.append({
+            'image_id': f'i{index:03d}', 'user_id': 'u', 'filename': filename, 'original_url': None,
+            'page_info': {'url': 'https://shop.example.com/p', 'title': f'item {index}'},
+            'file_size': 5, 'width': 1, 'height': 1, 'context_info': {}, 'category': 'clothes'
+        })
+    db.save_image_records(records)
+    for index in range(0, count, 3):
+        db.add_to_favorites('u', f'i{index:03d}')
+
+
+def test_export_iterates_every_row_in_batches(db, tmp_path):
+    _populate(db, tmp_path / 'u', 23)
+
+    images = list(db.iter_user_images('u', batch_size=5))
+    assert len(images) == 23
+    assert len({image['id'] for image in images}) == 23
+    assert len(list(db.iter_user_favorites('u', batch_size=2))) == 8
+    assert list(db.iter_vton_history('u', batch_size=2)) == []
+
+    export = db.export_user_data('u')
+    assert export.counts() == {'images': 23, 'favorites': 8, 'vton_history': 0}
+
+
+def test_sync_payload_is_streamed_as_json(app_module, db, tmp_path):
+    user_dir = tmp_path / 'u'
+    _populate(db, user_dir, 7)
+    client = app_module.CloudServerClient('http://cloud.invalid', enabled=False)
+
+    chunks = list(client.iter_sync_payload(user_dir, db.export_user_data('u')))
+    assert len(chunks) > 7
+    payload = json.loads(b''.join(chunks))
+
+    assert len(payload['images_metadata']) == 7
+    assert sorted(payload['image_files']) == [f'clothes_{index:03d}.png' for index in range(0, 7, 2)]
+    assert payload['image_files']['clothes_000.png'].startswith('data:image/png;base64,')
+    assert len(payload['favorites_data']) == 3
+    assert payload['sync_statistics']['total_files_found'] == 4
+    assert payload['sync_statistics']['total_files_missing'] == 3
+    assert payload['sync_statistics']['categories_stats'] == {'clothes': 7}
+
+
+def test_sync_saves_the_records_that_can_be_saved(app_module, monkeypatch):
+    monkeypatch.setattr(app_module.requests, 'get', lambda url, timeout: SimpleNamespace(
+        status_code=200, content=url.encode()))
+    with app_module.db.connection('u') as conn:
+        conn.execute('''
+            CREATE TRIGGER reject_bad BEFORE INSERT ON images WHEN NEW.filename = 'clothes_bad.png'
+            BEGIN SELECT RAISE(ABORT, 'rejected'); END
+        ''')
+
+    images = {'clothes': [
+        {'filename': f'clothes_{name}.png', 'url': f'https://cloud.example.com/{name}', 'category': category}
+        for name, category in (('a', 'clothes'), ('bad', 'clothes'), ('b', 'char'), ('evil', '../..'))
+    ]}
+    success, message, failures = app_module.sync_images_from_server('u', images, max_workers=1)
+
+    assert success
+    assert sorted(image['filename'] for image in app_module.db.get_user_images('u')) == ['clothes_a.png', 'clothes_b.png']
+    assert sorted(failure['filename'] for failure in failures) == ['clothes_bad.png', 'clothes_evil.png']
+    assert 'rejected' in next(failure['error'] for failure in failures if failure['filename'] == 'clothes_bad.png')
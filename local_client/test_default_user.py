@@ -0,0 +1,20 @@
+from concurrent.futures import ThreadPoolExecutor
+
+
+def test_default_user_is_resolved_once(db):
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        ids = set(executor.map(lambda _: db.get_default_user_id(), range(32)))
+    assert len(ids) == 1
+
+    statements = []
+    with db.connection() as conn:
+        conn.set_trace_callback(statements.append)
+        try:
+            assert db.get_default_user_id() in ids
+        finally:
+            conn.set_trace_callback(None)
+    assert statements == []
+
+    with db.connection() as conn:
+        count = conn.execute("SELECT COUNT(*) FROM users WHERE username = 'default_user'").fetchone()[0]
+    assert count == 1
@@ -0,0 +1,56 @@
+import sys
+
+import pytest
+
+
+def test_filters_and_domain_facets(db):
+    app_module = sys.modules['app']
+    db.save_image_records([
+        {'image_id': image_id, 'user_id': 'u', 'filename': f'clothes_{image_id}.png', 'original_url': None,
+         'page_info': {'url': url}, 'file_size': size, 'width': width, 'height': width,
+         'context_info': {}, 'category': 'clothes'}
+        for image_id, url, size, width in [
+            ('a', 'https://www.Shop.example.com/item/1', 100, 200),
+            ('b', 'https://shop.example.com/item/2', 5000, 800),
+            ('c', 'https://other.example.org/p', 300, 1200),
+            ('d', None, 100, 200),
+        ]
+    ])
+    db.add_to_favorites('u', 'b')
+
+    def ids(**args):
+        filters = app_module.parse_image_filters(args)
+        return sorted(image['id'] for image in db.get_user_images('u', filters=filters))
+
+    assert ids(domain='shop.example.com') == ['a', 'b']
+    assert ids(min_size='200') == ['b', 'c']
+    assert ids(min_width='500', max_width='1000') == ['b']
+    assert ids(favorited='true') == ['b']
+    assert ids(favorited='false', domain='shop.example.com') == ['a']
+    assert ids(saved_to='2000-01-01') == []
+    assert db.get_filtered_image_count('u', filters={'favorited': False}) == 3
+
+    facets = db.get_user_domain_facets('u', filters={'domain': 'shop.example.com', 'max_size': 1000})
+    assert facets == [
+        {'domain': None, 'count': 1},
+        {'domain': 'other.example.org', 'count': 1},
+        {'domain': 'shop.example.com', 'count': 1},
+    ]
+
+    with pytest.raises(ValueError):
+        app_module.parse_image_filters({'min_size': 'big'})
+
+
+def test_cursor_with_wrong_types_is_rejected(app_module):
+    client = app_module.app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = 'u'
+    valid = app_module.encode_cursor('2024-01-01 00:00:00', 'a')
+    assert client.get(f'/api/user/images?cursor={valid}').status_code == 200
+
+    for values in ([{'x': 1}, 'a'], ['2024-01-01 00:00:00', ['a']], ['2024-01-01 00:00:00', 1], [True, 'a']):
+        cursor = app_module.encode_cursor(*values)
+        for url in ('/api/user/images', '/api/images'):
+            response = client.get(f'{url}?cursor={cursor}')
+            assert response.status_code == 400
+            assert response.json['success'] is False
@@ -0,0 +1,72 @@
+from pathlib import Path
+
+import pytest
+
+
+@pytest.mark.parametrize('url', [
+    '/api/user/u1/images/clothes_a.png',
+    '/api/user/u1/images/clothes/clothes_a.png',
+    '/api/user/u1/vton_results/vton_result_a.png',
+])
+def test_images_are_cacheable_and_revalidated(app_module, url):
+    client = app_module.app.test_client()
+    (app_module.get_user_save_dir('u1', 'clothes') / 'clothes_a.png').write_bytes(b'image-bytes')
+    (app_module.get_user_save_dir('u1', 'vton_results') / 'vton_result_a.png').write_bytes(b'image-bytes')
+
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.headers['ETag']
+    assert response.headers['Last-Modified']
+    cache_control = response.cache_control
+    assert cache_control.max_age == app_module.IMAGE_CACHE_MAX_AGE
+    assert cache_control.private and cache_control.immutable
+    assert not cache_control.public
+
+    not_modified = client.get(url, headers={'If-None-Match': response.headers['ETag']})
+    assert not_modified.status_code == 304
+    assert not_modified.data == b''
+    assert client.get(url, headers={'If-Modified-Since': response.headers['Last-Modified']}).status_code == 304
+    assert client.get(url, headers={'If-None-Match': '"stale"'}).status_code == 200
+
+
+def test_recorded_images_resolve_without_probing_the_filesystem(app_module, monkeypatch):
+    database = app_module.db
+    monkeypatch.setattr(app_module, 'image_paths', app_module.ImagePathCache(database, max_size=2))
+    (app_module.get_user_save_dir('u1', 'char') / 'upload.png').write_bytes(b'image-bytes')
+    database.save_image_record('img-1', 'u1', 'upload.png', 'upload', {}, 11, 0, 0, {}, 'char')
+
+    def no_probe(path):
+        raise AssertionError(f'unexpected filesystem probe: {path}')
+    monkeypatch.setattr(Path, 'exists', no_probe)
+    monkeypatch.setattr(Path, 'is_file', no_probe)
+    monkeypatch.setattr(Path, 'mkdir', no_probe)
+
+    client = app_module.app.test_client()
+    assert client.get('/api/user/u1/images/upload.png').data == b'image-bytes'
+    assert app_module.image_paths.get('u1', 'upload.png') == 'char'
+    assert app_module.get_user_save_dir('u1', 'char') == app_module.BASE_SAVE_DIR / 'u1' / 'char'
+
+    # 删除后缓存条目失效，文件缺失时返回404
+    app_module.file_remover.submit_images('u1', [{'filename': 'upload.png', 'category': 'char'}])
+    app_module.file_remover.join()
+    assert client.get('/api/user/u1/images/upload.png').status_code == 404
+
+
+def test_range_requests_return_partial_content(app_module):
+    client = app_module.app.test_client()
+    content = bytes(range(256)) * 64
+    (app_module.get_user_save_dir('u1', 'vton_results') / 'vton_result_big.png').write_bytes(content)
+    url = '/api/user/u1/vton_results/vton_result_big.png'
+    etag = client.get(url).headers['ETag']
+
+    response = client.get(url, headers={'Range': 'bytes=100-199'})
+    assert response.status_code == 206
+    assert response.data == content[100:200]
+    assert response.headers['Content-Range'] == f'bytes 100-199/{len(content)}'
+    assert client.get(url, headers={'Range': 'bytes=-10'}).data == content[-10:]
+    assert client.get(url, headers={'Range': 'bytes=0-9', 'If-Range': etag}).status_code == 206
+    assert client.get(url, headers={'Range': 'bytes=0-9', 'If-Range': '"stale"'}).data == content
+
+    unsatisfiable = client.get(url, headers={'Range': f'bytes={len(content)}-'})
+    assert unsatisfiable.status_code == 416
+    assert unsatisfiable.headers['Content-Range'] == f'bytes */{len(content)}'
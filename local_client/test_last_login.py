@@ -0,0 +1,20 @@
+def test_login_only_reads_and_flushes_last_login_in_batch(db):
+    user_id = db.create_user('alice', 'alice@example.com', 'secret')
+
+    statements = []
+    with db.connection() as conn:
+        conn.set_trace_callback(statements.append)
+        try:
+            assert db.verify_user('alice', 'secret')[0] == user_id
+        finally:
+            conn.set_trace_callback(None)
+    assert all(statement.lstrip().upper().startswith('SELECT') for statement in statements), statements
+
+    # 未写入前读取用户信息也能看到新的登录时间
+    last_login = db.get_user_info(user_id)['last_login']
+    assert last_login is not None
+
+    assert db.flush_last_logins() == 1
+    with db.connection() as conn:
+        assert conn.execute('SELECT last_login FROM users WHERE user_id = ?', (user_id,)).fetchone()[0] == last_login
+    assert db.flush_last_logins() == 0
@@ -0,0 +1,105 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+CURSOR = ('2025-01-01 00:00:00', 'i')
+
+# 热点查询：调用应用实际执行这些查询的数据库方法或接口，记录其SQL后检查查询计划
+HOT_QUERIES = {
+    'get_user_images_by_category': lambda db, client: db.get_user_images('u', 'clothes', limit=20),
+    'get_user_images': lambda db, client: db.get_user_images('u', limit=20),
+    'get_user_images_after_cursor': lambda db, client: db.get_user_images('u', 'clothes', limit=20, cursor=CURSOR),
+    'get_user_images_by_domain': lambda db, client: db.get_user_images(
+        'u', limit=20, cursor=CURSOR, filters={'domain': 'shop.example.com'}),
+    'get_all_images': lambda db, client: db.get_all_images(limit=20, cursor=CURSOR),
+    'get_user_favorites': lambda db, client: db.get_user_favorites('u', limit=20),
+    'get_user_favorites_after_cursor': lambda db, client: db.get_user_favorites('u', limit=20, cursor=CURSOR),
+    'get_user_image_count': lambda db, client: db.get_user_image_count('u', 'clothes'),
+    'get_user_counters': lambda db, client: db.get_user_counters('u'),
+    'get_image_by_filename': lambda db, client: db.get_image_by_filename('u', 'clothes_x.png'),
+    'get_image_category': lambda db, client: db.get_image_category('u', 'clothes_x.png'),
+    'get_image_by_id': lambda db, client: db.get_image_by_id('i', 'u'),
+    'is_favorited': lambda db, client: db.is_favorited('u', 'i'),
+    'iter_vton_history': lambda db, client: list(db.iter_vton_history('u', batch_size=10)),
+    'vton_history_route': lambda db, client: client.get('/api/vton/history?per_page=10'),
+    'delete_image_rows': lambda db, client: db.delete_image_rows(['i'], 'u'),
+}
+
+
+def trace_statements(db, call):
+    """记录call执行的SQL（参数已代入），不包括触发器内部的语句"""
+    statements = []
+    with db.connection() as conn:
+        conn.set_trace_callback(statements.append)
+        try:
+            call()
+        finally:
+            conn.set_trace_callback(None)
+    return [s for s in statements if s.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE'))]
+
+
+@pytest.mark.parametrize('name', sorted(HOT_QUERIES))
+def test_hot_query_uses_index(db, name, monkeypatch):
+    app_module = sys.modules['app']
+    monkeypatch.setattr(app_module, 'db', db)
+    monkeypatch.setattr(app_module.db, '_default_user_id', 'u')
+    db.save_image_record('i', 'u', 'clothes_x.png', None, {'url': 'https://shop.example.com/p'},
+                         100, 10, 10, {}, 'clothes', 'a' * 64)
+    db.add_to_favorites('u', 'i')
+    client = app_module.app.test_client()
+
+    statements = trace_statements(db, lambda: HOT_QUERIES[name](db, client))
+    assert statements, f"{name}: 没有执行查询"
+    for sql in statements:
+        with db.connection() as conn:
+            plan = [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql)]
+        for detail in plan:
+            assert not detail.startswith('SCAN'), f"{name} 退化为全表扫描: {sql}\n{plan}"
+            assert 'TEMP B-TREE' not in detail, f"{name} 需要额外排序: {sql}\n{plan}"
+
+
+def test_migrations_are_versioned(db):
+    with db.connection() as conn:
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+    assert version == max(v for v, _ in sys.modules['app'].SCHEMA_MIGRATIONS)
+
+    # 重复初始化不会重新执行迁移
+    db.init_db()
+    with db.connection() as conn:
+        assert conn.execute('PRAGMA user_version').fetchone()[0] == version
+
+
+def test_init_db_skips_ddl_when_up_to_date(db):
+    statements = []
+    with db.connection() as conn:
+        conn.set_trace_callback(statements.append)
+        try:
+            db.init_db()
+        finally:
+            conn.set_trace_callback(None)
+
+    assert not [s for s in statements if 'CREATE' in s.upper() or 'sqlite_master' in s]
+
+
+def test_init_db_upgrades_legacy_database(tmp_path, db):
+    import sqlite3
+    legacy_path = tmp_path / 'legacy.db'
+    conn = sqlite3.connect(legacy_path)
+    conn.execute('''CREATE TABLE images (
+        id TEXT PRIMARY KEY, user_id TEXT NOT NULL, filename TEXT NOT NULL,
+        original_url TEXT, page_url TEXT, page_title TEXT,
+        saved_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, file_size INTEGER,
+        width INTEGER, height INTEGER, context_info TEXT, cloud_synced BOOLEAN DEFAULT FALSE)''')
+    conn.execute("INSERT INTO images (id, user_id, filename, page_url) VALUES ('i1', 'u', 'clothes_a.png', 'https://www.shop.example.com/x')")
+    conn.commit()
+    conn.close()
+
+    legacy = sys.modules['app'].ImageDatabase(str(legacy_path))
+    with legacy.connection() as conn:
+        assert conn.execute('PRAGMA user_version').fetchone()[0] == sys.modules['app'].SCHEMA_VERSION
+        assert conn.execute("SELECT category FROM images WHERE id = 'i1'").fetchone()[0] == 'clothes'
+        assert conn.execute("SELECT page_domain FROM images WHERE id = 'i1'").fetchone()[0] == 'shop.example.com'
+    assert legacy.get_user_image_count('u', 'clothes') == 1
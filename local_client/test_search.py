@@ -0,0 +1,93 @@
+import sys
+
+import pytest
+
+
+def _save(db, image_id, page_title, context_info=None, user_id='u', category='clothes'):
+    db.save_image_record(image_id, user_id, f'{category}_{image_id}.png', f'https://img.example.com/{image_id}.png',
+                         {'url': 'https://shop.example.com/item', 'title': page_title},
+                         100, 10, 10, context_info, category)
+
+
+def _plan(db, query):
+    from_sql, conditions, params, _ = db.search_clauses(query)
+    with db.connection() as conn:
+        return [row[3] for row in conn.execute(f'''
+            EXPLAIN QUERY PLAN
+            SELECT i.id FROM {from_sql}
+            WHERE {' AND '.join(conditions + ['i.user_id = ?'])}
+        ''', (*params, 'u'))]
+
+
+def test_search_uses_fulltext_index(db):
+    app_module = sys.modules['app']
+    plan = _plan(db, app_module.build_search_query('连衣裙'))
+    assert any('VIRTUAL TABLE INDEX' in detail and 'M' in detail.rsplit(':', 1)[-1] for detail in plan), plan
+    assert any(detail.startswith('SEARCH i USING') and '(id=?)' in detail for detail in plan), plan
+
+    # 只有短关键词时只扫描该用户的图片，按rowid取索引行
+    plan = _plan(db, app_module.build_search_query('衬衫'))
+    assert any(detail.startswith('SEARCH i USING') and 'user_id=?' in detail for detail in plan), plan
+    assert any(detail.endswith('VIRTUAL TABLE INDEX 0:=') for detail in plan), plan
+
+
+def test_search_ranks_and_stays_in_sync(db):
+    app_module = sys.modules['app']
+    _save(db, 'a', '夏季碎花连衣裙女装')
+    _save(db, 'b', '男士衬衫', {'alt': '白色连衣裙 模特图'})
+    _save(db, 'c', '牛仔裤')
+    _save(db, 'd', '连衣裙', user_id='other')
+
+    query = app_module.build_search_query('连衣裙')
+    results = db.search_user_images('u', query)
+    # 标题命中的权重高于上下文命中
+    assert [image['id'] for image in results] == ['a', 'b']
+    assert db.get_search_count('u', query) == 2
+    # JSON键名不进入索引
+    assert db.get_search_count('u', app_module.build_search_query('alt')) == 0
+
+    db.delete_image('a', 'u')
+    assert [image['id'] for image in db.search_user_images('u', query)] == ['b']
+
+    with pytest.raises(ValueError):
+        app_module.build_search_query('  ')
+
+
+def test_short_terms_are_searchable(db):
+    app_module = sys.modules['app']
+    _save(db, 'a', '白色衬衫')
+    _save(db, 'b', '碎花裙子', {'alt': '衬衫 搭配'})
+    _save(db, 'c', '牛仔裤')
+    _save(db, 'd', '衬衫', user_id='other')
+    _save(db, 'e', '100%棉 T恤')
+
+    def ids(text):
+        return sorted(image['id'] for image in db.search_user_images('u', app_module.build_search_query(text)))
+
+    assert ids('衬衫') == ['a', 'b']
+    assert ids('裙') == ['b']
+    assert ids('衬衫 碎花裙') == ['b']
+    assert ids('%') == ['e']
+    assert ids('t恤') == ['e']
+    assert db.get_search_count('u', app_module.build_search_query('衬衫')) == 2
+
+    # 标题更新后索引同步
+    with db.connection() as conn:
+        conn.execute("UPDATE images SET page_title = '黑色外套' WHERE id = 'a'")
+    assert ids('衬衫') == ['b']
+    assert ids('外套') == ['a']
+
+
+def test_fulltext_index_survives_vacuum(db):
+    app_module = sys.modules['app']
+    for index, image_id in enumerate(['a', 'b', 'c']):
+        _save(db, image_id, f'款式{index} 连衣裙')
+    db.delete_image_rows(['a'], 'u')
+    with db.connection() as conn:
+        conn.commit()
+        conn.execute('VACUUM')
+
+    assert sorted(image['id'] for image in db.search_user_images('u', app_module.build_search_query('连衣裙'))) == ['b', 'c']
+    db.delete_image_rows(['b'], 'u')
+    assert [image['id'] for image in db.search_user_images('u', app_module.build_search_query('连衣裙'))] == ['c']
+    assert [image['id'] for image in db.search_user_images('u', app_module.build_search_query('款式2'))] == ['c']
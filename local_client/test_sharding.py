@@ -0,0 +1,94 @@
+from pathlib import Path
+
+import pytest
+
+
+def _record(image_id, user_id, saved_title):
+    return {
+        'image_id': image_id, 'user_id': user_id, 'filename': f'clothes_{image_id}.png',
+        'original_url': None, 'page_info': {'url': 'https://shop.example.com/p', 'title': saved_title},
+        'file_size': 100, 'width': 10, 'height': 10, 'context_info': {}, 'category': 'clothes'
+    }
+
+
+def test_sharded_mode_routes_by_user(tmp_path, app_module):
+    db = app_module.ImageDatabase(str(tmp_path / 'global.db'), shard_dir=tmp_path / 'shards')
+    for user_id in ('alice', 'bob'):
+        db.shard_pool(user_id, create=True)
+    db.save_image_records([
+        _record('a1', 'alice', '碎花连衣裙'),
+        _record('a2', 'alice', '牛仔裤'),
+        _record('b1', 'bob', '白衬衫'),
+    ])
+    db.add_to_favorites('alice', 'a1')
+
+    assert db.shard_user_ids() == ['alice', 'bob']
+    assert (tmp_path / 'shards' / 'alice' / app_module.USER_DB_FILENAME).exists()
+    with db.connection() as conn:
+        assert conn.execute('SELECT COUNT(*) FROM images').fetchone()[0] == 0
+
+    assert [image['id'] for image in db.get_user_images('alice')] == ['a2', 'a1']
+    assert db.get_user_image_count('alice') == 2
+    assert db.get_user_favorite_count('alice') == 1
+    assert db.is_favorited('alice', 'a1')
+    assert db.get_user_images('bob')[0]['id'] == 'b1'
+    assert db.get_search_count('alice', app_module.build_search_query('连衣裙')) == 1
+    assert db.get_image_count() == 3
+    assert sorted(image['id'] for image in db.get_all_images(limit=2, offset=1)) == sorted(
+        image['id'] for image in db.get_all_images(limit=3)[1:])
+
+    ok, _ = db.delete_image('a1', 'alice')
+    assert ok
+    assert db.get_user_image_count('alice') == 1
+    assert db.get_user_favorite_count('alice') == 0
+
+    with pytest.raises(ValueError):
+        db.shard_path('../etc')
+
+
+def test_migrate_single_file_to_shards(tmp_path, app_module):
+    db_path = str(tmp_path / 'single.db')
+    single = app_module.ImageDatabase(db_path)
+    single.save_image_records([_record('a1', 'alice', '连衣裙'), _record('b1', 'bob', '衬衫')])
+    single.add_to_favorites('bob', 'b1')
+    single.save_tasks([{'task_id': 't1', 'user_id': 'bob', 'image_id': 'b1', 'status': 'completed',
+                        'created_at': '2025-01-01 00:00:00', 'updated_at': '2025-01-01 00:00:00'}])
+    single.pool.close_all()
+
+    sharded = app_module.ImageDatabase(db_path, shard_dir=tmp_path / 'shards')
+    report = sharded.migrate_to_shards()
+
+    assert report['bob'] == {'images': 1, 'favorites': 1, 'tasks': 1, 'vton_history': 0, 'blobs': 0}
+    assert Path(db_path + '.bak').exists()
+    assert sharded.get_user_image_count('alice') == 1
+    assert sharded.get_user_favorite_count('bob') == 1
+    assert sharded.get_task_status('t1', 'bob')['status'] == 'completed'
+    assert sharded.get_search_count('alice', app_module.build_search_query('连衣裙')) == 1
+    with sharded.connection() as conn:
+        assert conn.execute('SELECT COUNT(*) FROM images').fetchone()[0] == 0
+
+    # 重复执行不会重复复制
+    assert sharded.migrate_to_shards() == {}
+    assert sharded.get_image_count() == 2
+
+
+def test_unknown_users_do_not_create_shards(tmp_path, app_module, monkeypatch):
+    monkeypatch.setattr(app_module, 'MAX_OPEN_SHARDS', 2)
+    db = app_module.ImageDatabase(str(tmp_path / 'global.db'), shard_dir=tmp_path / 'shards')
+    user_id = db.create_user('alice', 'alice@example.com', 'secret')
+    db.save_image_records([_record('a1', user_id, '连衣裙')])
+
+    assert db.get_user_images('nobody') == []
+    assert db.get_image_category('nobody', 'clothes_a1.png') is None
+    with pytest.raises(app_module.sqlite3.OperationalError):
+        db.add_to_favorites('nobody', 'a1')
+    assert db.shard_user_ids() == [user_id]
+    assert not (tmp_path / 'shards' / 'nobody').exists()
+    assert db.get_image_count() == 1
+
+    # 超出上限时关闭最久未使用的连接池，再次访问时重新打开
+    for other in ('bob', 'carol'):
+        db.shard_pool(other, create=True)
+    assert list(db._shards) == ['bob', 'carol']
+    assert db.get_image_category(user_id, 'clothes_a1.png') == 'clothes'
+    assert list(db._shards) == ['carol', user_id]
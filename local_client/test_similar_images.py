@@ -0,0 +1,70 @@
+import base64
+import io
+import random
+import sys
+import time
+from pathlib import Path
+
+from PIL import Image, ImageDraw
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+
+def _garment(size, crop=0, seed=1):
+    rng = random.Random(seed)
+    img = Image.new('RGB', (400, 400), (240, 240, 240))
+    draw = ImageDraw.Draw(img)
+    for _ in range(12):
+        x, y = rng.randrange(0, 300), rng.randrange(0, 300)
+        draw.rectangle([x, y, x + rng.randrange(40, 120), y + rng.randrange(40, 120)],
+                       fill=tuple(rng.randrange(256) for _ in range(3)))
+    img = img.crop((crop, crop, 400 - crop, 400 - crop)).resize(size)
+    buffer = io.BytesIO()
+    img.save(buffer, 'PNG')
+    return 'data:image/png;base64,' + base64.b64encode(buffer.getvalue()).decode()
+
+
+def _wait_for_duplicate_flag(app_module, image_id):
+    for _ in range(50):
+        image = app_module.db.get_image_by_id(image_id, 'u1')
+        if image['duplicate_of']:
+            return image['duplicate_of']
+        time.sleep(0.1)
+    return None
+
+
+def test_bk_tree_matches_brute_force():
+    import app
+    rng = random.Random(7)
+    hashes = [f'{rng.getrandbits(64):016x}' for _ in range(300)]
+    tree = app.BKTree()
+    for index, value in enumerate(hashes):
+        tree.add(value, index)
+
+    query = hashes[0]
+    expected = sorted((app.hamming_distance(query, value), index) for index, value in enumerate(hashes)
+                      if app.hamming_distance(query, value) <= 24)
+    assert sorted(tree.search(query, 24)) == expected
+
+
+def test_similar_endpoint_finds_resized_and_cropped_captures(app_module):
+    original = app_module.save_image_from_data(_garment((400, 400)), 'http://a/1.png', {}, 'u1', 'clothes')
+    original['derivatives'].result(timeout=60)
+    resized = app_module.save_image_from_data(_garment((180, 180), crop=6), 'http://b/2.png', {}, 'u1', 'clothes')
+    resized['derivatives'].result(timeout=60)
+    other = app_module.save_image_from_data(_garment((400, 400), seed=99), 'http://c/3.png', {}, 'u1', 'clothes')
+    other['derivatives'].result(timeout=60)
+
+    assert _wait_for_duplicate_flag(app_module, resized['image_id']) == original['image_id']
+
+    client = app_module.app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = 'u1'
+    response = client.get(f"/api/user/images/{original['image_id']}/similar")
+    assert response.status_code == 200
+    ids = [image['id'] for image in response.json['images']]
+    assert ids == [resized['image_id']]
+    assert response.json['images'][0]['distance'] <= app_module.DUPLICATE_MAX_DISTANCE
+
+    assert client.get('/api/user/images/missing/similar').status_code == 404
+    assert client.get(f"/api/user/images/{original['image_id']}/similar?max_distance=x").status_code == 400
@@ -0,0 +1,78 @@
+import threading
+import time
+from concurrent.futures import Future
+
+
+def test_task_without_work_completes_immediately(app_module, db):
+    registry = app_module.TaskRegistry(db, persist=False)
+    task_id = registry.submit('u', 'i')
+
+    task = registry.get(task_id)
+    assert task['status'] == 'completed'
+    assert task['image_id'] == 'i'
+    # 未开启写回时不写数据库
+    assert db.get_task_status(task_id) is None
+
+
+def test_task_work_runs_on_executor(app_module, db):
+    registry = app_module.TaskRegistry(db, persist=False)
+    started = threading.Event()
+    release = threading.Event()
+
+    def work():
+        started.set()
+        release.wait(5)
+
+    task_id = registry.submit('u', 'i', work)
+    assert started.wait(5)
+    assert registry.get(task_id)['status'] == 'processing'
+
+    release.set()
+    deadline = time.monotonic() + 5
+    while registry.get(task_id)['status'] == 'processing' and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert registry.get(task_id)['status'] == 'completed'
+
+    failed_id = registry.submit('u', 'i', lambda: 1 / 0)
+    deadline = time.monotonic() + 5
+    while registry.get(failed_id)['status'] == 'processing' and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert registry.get(failed_id)['status'] == 'failed'
+
+
+def test_tracked_task_completes_independently_of_derivatives(app_module, db):
+    registry = app_module.TaskRegistry(db, flush_interval=3600)
+    future = Future()
+    task_id = registry.track('u', 'i', future)
+
+    assert registry.get(task_id)['status'] == 'completed'
+    assert registry.get(task_id)['derivatives'] == 'processing'
+    registry.flush()
+    assert db.get_task_status(task_id)['status'] == 'completed'
+
+    future.set_exception(OSError('broken image'))
+    assert registry.get(task_id)['status'] == 'completed'
+    assert registry.get(task_id)['derivatives'] == 'failed'
+
+
+def test_expired_tasks_fall_back_to_database(app_module, db):
+    registry = app_module.TaskRegistry(db, ttl=0, flush_interval=3600)
+    task_id = registry.submit('u', 'i')
+    registry.flush()
+
+    assert not registry._tasks
+    assert registry.get(task_id)['status'] == 'completed'
+
+
+def test_flush_purges_old_tasks(app_module, db):
+    registry = app_module.TaskRegistry(db, flush_interval=3600, retention_days=7)
+    with db.connection() as conn:
+        conn.execute('''
+            INSERT INTO tasks (task_id, user_id, image_id, status, created_at, updated_at)
+            VALUES ('old', 'u', 'i', 'completed', datetime('now', '-30 days'), datetime('now', '-30 days'))
+        ''')
+    task_id = registry.submit('u', 'i')
+    registry.flush()
+
+    assert db.get_task_status('old') is None
+    assert db.get_task_status(task_id)['status'] == 'completed'
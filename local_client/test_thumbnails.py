@@ -0,0 +1,86 @@
+import base64
+import io
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+from PIL import Image
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+
+def _save_source(app_module, user_id, filename, size=(1200, 800)):
+    path = app_module.get_user_save_dir(user_id, 'clothes') / filename
+    Image.new('RGB', size, (200, 10, 10)).save(path, 'PNG')
+    return path
+
+
+def test_thumbnail_is_generated_once_and_cached(app_module):
+    client = app_module.app.test_client()
+    _save_source(app_module, 'u1', 'clothes_a.png')
+
+    response = client.get('/api/user/u1/thumbnails/clothes_a.png?size=200')
+    assert response.status_code == 200
+    with Image.open(io.BytesIO(response.data)) as thumbnail:
+        assert thumbnail.format == 'WEBP'
+        assert thumbnail.size == (256, 171)
+
+    cached = app_module.get_thumbnail_path('u1', 'clothes', 'clothes_a.png', 256)
+    assert cached.exists()
+    mtime = cached.stat().st_mtime_ns
+    assert client.get('/api/user/u1/thumbnails/clothes_a.png').status_code == 200
+    assert cached.stat().st_mtime_ns == mtime
+
+    with Image.open(io.BytesIO(client.get('/api/user/u1/thumbnails/clothes_a.png?size=9999').data)) as thumbnail:
+        assert max(thumbnail.size) == 512
+    assert client.get('/api/user/u1/thumbnails/clothes_a.png?size=big').status_code == 400
+    assert client.get('/api/user/u1/thumbnails/clothes_missing.png').status_code == 404
+
+
+def test_thumbnails_are_removed_with_the_image(app_module):
+    client = app_module.app.test_client()
+    _save_source(app_module, 'u1', 'clothes_b.png')
+    client.get('/api/user/u1/thumbnails/clothes_b.png?size=128')
+    client.get('/api/user/u1/thumbnails/clothes_b.png?size=512')
+
+    app_module.file_remover.submit_images('u1', [{'filename': 'clothes_b.png', 'category': 'clothes'}])
+    app_module.file_remover.join()
+
+    assert not any(path.exists() for path in app_module.get_thumbnail_paths('u1', 'clothes', 'clothes_b.png'))
+    assert not (app_module.BASE_SAVE_DIR / 'u1' / 'clothes' / 'clothes_b.png').exists()
+
+
+def test_ingest_generates_thumbnails_in_background(app_module):
+    buffer = io.BytesIO()
+    Image.new('RGB', (900, 600), (10, 200, 10)).save(buffer, 'PNG')
+    image_data = 'data:image/png;base64,' + base64.b64encode(buffer.getvalue()).decode()
+
+    result = app_module.save_image_from_data(image_data, 'http://example.com/a.png', {}, 'u1', 'clothes')
+    derivatives = result['derivatives'].result(timeout=60)
+    assert (derivatives['width'], derivatives['height']) == (900, 600)
+    assert len(derivatives['dhash']) == 16
+
+    for size, path in zip(app_module.THUMBNAIL_SIZES, app_module.get_thumbnail_paths('u1', 'clothes', result['filename'])):
+        with Image.open(path) as thumbnail:
+            assert max(thumbnail.size) == size
+
+    # 数据库在Future的完成回调中更新，可能稍晚于result()返回
+    for _ in range(50):
+        with app_module.db.connection('u1') as conn:
+            row = conn.execute('SELECT derivatives_at FROM images WHERE id = ?', (result['image_id'],)).fetchone()
+        if row['derivatives_at'] is not None:
+            break
+        time.sleep(0.1)
+    assert row['derivatives_at'] is not None
+
+
+def test_worker_module_has_no_side_effects(tmp_path):
+    # spawn启动的工作进程只导入derivatives，不应创建应用、数据库或保存目录
+    script = "import sys, derivatives; print(sorted(m for m in ('app', 'flask', 'sqlite3') if m in sys.modules))"
+    result = subprocess.run([sys.executable, '-c', script], cwd=tmp_path, capture_output=True, text=True,
+                            env={**os.environ, 'PYTHONPATH': str(Path(__file__).parent)})
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == '[]'
+    assert list(tmp_path.iterdir()) == []
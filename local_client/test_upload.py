@@ -0,0 +1,119 @@
+import io
+import json
+import os
+import sys
+from pathlib import Path
+from urllib.parse import quote
+
+from PIL import Image
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+
+def _jpeg(size=(320, 240)):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, (30, 60, 90)).save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+
+def _staging_files(app_module):
+    staging_dir = app_module.BASE_SAVE_DIR / app_module.UPLOAD_STAGING_DIR_NAME
+    return list(staging_dir.iterdir()) if staging_dir.exists() else []
+
+
+def test_upload_is_streamed_into_the_blob_store(app_module):
+    client = app_module.app.test_client()
+    content = _jpeg()
+    with client.session_transaction() as session:
+        session['user_id'] = 'u1'
+
+    response = client.post('/api/upload-file', data={
+        'file': (io.BytesIO(content), 'shirt.JPEG'), 'category': 'clothes'
+    }, content_type='multipart/form-data')
+    assert response.status_code == 200, response.json
+    assert response.json['fileSize'] == len(content)
+
+    image = app_module.db.get_image_by_id(response.json['imageId'], 'u1')
+    assert image['filename'].endswith('.jpg')
+    assert (image['image_width'], image['image_height']) == (320, 240)
+    filepath = app_module.BASE_SAVE_DIR / 'u1' / 'clothes' / image['filename']
+    assert filepath.read_bytes() == content
+    blob_path = app_module.get_blob_path('u1', app_module.hashlib.sha256(content).hexdigest())
+    assert os.path.samefile(filepath, blob_path)
+    assert _staging_files(app_module) == []
+
+
+def test_oversized_upload_is_rejected_without_leaving_files(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, 'MAX_UPLOAD_SIZE', 1024)
+    client = app_module.app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = 'u1'
+
+    response = client.post('/api/upload-file', data={
+        'file': (io.BytesIO(b'\xff\xd8\xff' + b'0' * 4096), 'big.jpg')
+    }, content_type='multipart/form-data')
+    assert response.status_code == 413
+    assert response.json['success'] is False
+    assert _staging_files(app_module) == []
+
+    rejected = client.post('/api/upload-file', data={'file': (io.BytesIO(b'text'), 'notes.txt')},
+                           content_type='multipart/form-data')
+    assert rejected.status_code == 400
+    assert _staging_files(app_module) == []
+
+
+def test_save_image_from_bytes_and_streams(app_module):
+    content = _jpeg((64, 64))
+    from_bytes = app_module.save_image_from_data(content, 'raw', {}, 'u1', 'char')
+    from_stream = app_module.save_image_from_data(io.BytesIO(content), 'stream', {}, 'u1', 'char')
+    assert from_bytes['filename'].endswith('.jpg') and from_stream['filename'].endswith('.jpg')
+    assert from_bytes['file_size'] == from_stream['file_size'] == len(content)
+    assert os.path.samefile(from_bytes['filepath'], from_stream['filepath'])
+
+
+def test_binary_ingest_reads_metadata_from_headers(app_module):
+    client = app_module.app.test_client()
+    content = _jpeg((80, 60))
+    page_info = {'url': 'https://shop.example.com/p/1', 'title': '红色衬衫', 'imageContext': {'alt': 'red shirt'}}
+
+    response = client.post('/api/receive-image/binary', data=content, headers={
+        'Content-Type': 'image/png',
+        'X-Image-Category': 'char',
+        'X-Original-Url': quote('https://cdn.example.com/红.jpg', safe=''),
+        'X-Page-Info': quote(json.dumps(page_info), safe=''),
+    })
+    assert response.status_code == 200, response.json
+    assert response.json['category'] == 'char'
+    assert response.json['filename'].endswith('.jpg')
+    assert response.json['fileSize'] == len(content)
+
+    user_id = app_module.get_or_create_default_user()
+    image = app_module.db.get_image_by_id(response.json['imageId'], user_id)
+    assert image['original_url'] == 'https://cdn.example.com/红.jpg'
+    assert image['page_title'] == '红色衬衫'
+    assert (image['image_width'], image['image_height']) == (80, 60)
+    filepath = app_module.BASE_SAVE_DIR / user_id / 'char' / image['filename']
+    assert filepath.read_bytes() == content
+    assert _staging_files(app_module) == []
+
+
+def test_binary_ingest_rejects_bad_bodies(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, 'MAX_UPLOAD_SIZE', 1024)
+    client = app_module.app.test_client()
+
+    too_large = client.post('/api/receive-image/binary', data=b'\xff\xd8\xff' + b'0' * 4096,
+                            headers={'Content-Type': 'image/jpeg', 'X-Image-Source': 'clipboard'})
+    assert too_large.status_code == 413
+    not_image = client.post('/api/receive-image/binary', data=b'plain text',
+                            headers={'Content-Type': 'application/octet-stream'})
+    assert not_image.status_code == 400
+    empty = client.post('/api/receive-image/binary', data=b'', headers={'Content-Type': 'image/png'})
+    assert empty.status_code == 400
+    assert _staging_files(app_module) == []
+
+    # 不需要预检的类型（其他网页可直接提交）被拒绝
+    for content_type in ('text/plain', 'application/x-www-form-urlencoded', None):
+        headers = {'Content-Type': content_type} if content_type else {}
+        response = client.post('/api/receive-image/binary', data=_jpeg((8, 8)), headers=headers)
+        assert response.status_code == 415
+    assert app_module.db.get_user_image_count(app_module.get_or_create_default_user()) == 0